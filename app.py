@@ -1,7 +1,41 @@
+import atexit
+import base64
+import engine
+import functools
+import gridfs
+import hashlife
+import json
+import math
+import metrics
 import os
-from flask import Flask, jsonify, render_template, request
+import time
+import unittest
+import uuid
+import wire
+from bricks import BrickGrid
+from flask import Flask, Response, g, jsonify, render_template, request
 from grid import Grid
+from history import MAX_BYTES as HISTORY_BYTES, History
+from parallel import SlabPool
+from playback import DEPTH, RATE, LookAhead, Stream
 from pymongo import MongoClient
+from sessions import GridRegistry
+from storage import LIST_LIMIT, GridCache, GridStore, GridTooLarge
+from types import SimpleNamespace
+
+
+class TestApp(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    # Test a new grid larger than the viewer holds is refused before it is built
+    def test_initial_size_cap(self):
+        response = self.client.post('/initial_state', json={'size': MAX_VIEW_SIZE + 1})
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('error', response.get_json())
+        self.assertEqual(self.client.post('/initial_state', json={'size': 4}).status_code, 200)
+
 
 app = Flask(__name__)
 
@@ -9,17 +43,185 @@ mongo_uri = os.environ.get('MONGO_URI', 'mongodb://mongo:27017/')
 client = MongoClient(mongo_uri)
 db = client['cellular_automaton']
 grid_collection = db['grids']
+# Saved grids, the packed ones too large for a document are kept in GridFS. The last ones loaded are kept
+# decoded, up to GRID_CACHE_MB, so switching between saved grids does not read them again
+grid_fs = gridfs.GridFS(db)
+grid_cache = GridCache(int(os.environ.get('GRID_CACHE_MB', 64)) * 1024 * 1024)
+grid_store = GridStore(grid_collection, grid_fs, cache=grid_cache)
 
 n = 5
-grid = None
+
+# Most generations /next computes for one request
+MAX_STEPS = 64
+# Most generations /next jumps over at once, the octree does it in a few steps
+MAX_GENERATIONS = 4096
+# Largest grid saved as bricks that /load takes into memory for the viewer
+MAX_VIEW_SIZE = 256
+# Cookie holding the id of the client's grid
+SESSION_COOKIE = 'grid_session'
+# Sends a Server-Timing header with the time of each phase of a request (step, serialise, mongo...)
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') != '0'
+
+# Worker processes used to step large grids, 0 steps them in the web process. They are started by the first
+# grid stepped, so each Gunicorn worker gets its own, and stopped with their shared memory when the process exits
+grid_workers = int(os.environ.get('GRID_WORKERS', 0))
+pool = SlabPool(grid_workers) if grid_workers > 0 else None
+if pool is not None:
+    atexit.register(pool.close)
+
+# One grid per session, the least recently used ones are spilled to MongoDB past GRID_MEMORY_MB.
+# The registry lives in the process, so gunicorn should run one worker with several threads
+grid_memory = int(os.environ.get('GRID_MEMORY_MB', 512)) * 1024 * 1024
+# Spills of sessions that do not come back are deleted after GRID_SPILL_DAYS
+spill_days = float(os.environ.get('GRID_SPILL_DAYS', 7))
+spill_store = GridStore(db['sessions'], grid_fs, max_age=spill_days * 24 * 3600) \
+    if os.environ.get('GRID_SPILL', '1') != '0' else None
+registry = GridRegistry(grid_memory, spill_store)
+
+
+# Id of the client's session, a new one is made (and set as a cookie) for a new client
+def session_id():
+    if SESSION_COOKIE in request.cookies:
+        return request.cookies[SESSION_COOKIE]
+    if 'new_session_id' not in g:
+        g.new_session_id = uuid.uuid4().hex
+    return g.new_session_id
+
+
+@app.after_request
+def set_session_cookie(response):
+    if 'new_session_id' in g:
+        response.set_cookie(SESSION_COOKIE, g.new_session_id, httponly=True, samesite='Lax')
+    return response
+
+
+@app.before_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    metrics.start_phases()
+
+
+# Times the request and measures its body by route (the rule, so ids in the path do not make new series)
+@app.after_request
+def record_timing(response):
+    total = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.REQUEST_SECONDS.observe(total, route, request.method, str(response.status_code))
+    if not response.is_streamed:
+        metrics.RESPONSE_BYTES.observe(response.calculate_content_length() or 0, route)
+    phases = metrics.end_phases()
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = metrics.server_timing(phases, total)
+    return response
+
+
+@app.teardown_request
+def end_timing(error=None):
+    metrics.end_phases()
+
+
+# Runs a route with the client's session, holding its lock so requests for the same grid do not interleave.
+# A session evicted before its lock was taken is got again, from the store it was spilled to
+def with_session(route):
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        while True:
+            session = registry.get(session_id())
+            if session is None:
+                return jsonify({"error": "No grid for this session, start one with /initial_state or /load."}), 404
+            with session.lock:
+                if not session.evicted:
+                    return route(session, *args, **kwargs)
+    return wrapper
+
+
+# Raised for a request parameter that is not a number, answered with a 400 like the other bad requests
+class BadParameter(ValueError):
+    pass
+
+
+@app.errorhandler(BadParameter)
+def bad_parameter(error):
+    return jsonify({"error": str(error)}), 400
+
+
+# Number given for a request parameter (int or float), kept between low and high when they are given
+def number(value, name, kind=int, low=None, high=None):
+    try:
+        result = kind(value)
+    except (TypeError, ValueError, OverflowError):
+        result = None
+    if result is None or isinstance(value, bool) or not math.isfinite(result):
+        raise BadParameter(f"'{name}' must be {'an integer' if kind is int else 'a number'}, got {value!r}.")
+    if low is not None:
+        result = max(low, result)
+    if high is not None:
+        result = min(high, result)
+    return result
+
+
+# Gives the client's session a new grid, stepped with the process pool if there is one
+def set_grid(grid):
+    grid.pool = pool
+    return registry.put(session_id(), grid)
+
 
 # Helper to initialise a new Grid with a checkerboard pattern
 def initialise_grid(sizestr):
     size = int(sizestr)
-    global grid
     initial_state = [[[1 if (x + y + z) % 2 == 0 else 0 for z in range(size)] for y in range(size)] for x in range(size)]
-    grid = Grid(size, initial_state, {0:0, 1:0xff0000})
-    return [[[cell.celldict() for cell in z] for z in y] for y in grid.cells]
+    return set_grid(Grid(size, initial_state, {0:0, 1:0xff0000}))
+
+
+# Binary frames are sent when asked for with format or the Accept header, JSON stays the default
+def wants_binary():
+    data = request.get_json(silent=True) or {}
+    if 'format' in data or 'format' in request.args:
+        return data.get('format', request.args.get('format')) == 'binary'
+    return request.accept_mimetypes.best_match(['application/json', wire.MIME_TYPE]) == wire.MIME_TYPE
+
+
+# Only the cells that can be seen are sent when asked for with surface, in the body or the query string
+def wants_surface():
+    data = request.get_json(silent=True) or {}
+    return str(data.get('surface', request.args.get('surface', ''))).lower() in ('1', 'true')
+
+
+# The current grid as a JSON state or as a binary frame, only the changes if the client has the previous generation.
+# With surface, the cells hidden behind their six face neighbours are sent as empty (see wire.Surface)
+def encode_state(grid, binary, client_generation=None, surface=False):
+    with metrics.timed(metrics.SERIALISE_SECONDS, 'binary' if binary else 'json', 'encode', phase='encode'):
+        if surface:
+            if grid.surface is None:
+                grid.surface = wire.Surface()
+            view = grid.surface.update(grid)
+            return wire.encode_surface(view, client_generation) if binary else wire.surface_json(view)
+        if binary:
+            return wire.encode_frame(grid, client_generation)
+        return grid.celldicts()
+
+
+# Sends the grid as JSON or as a binary frame. When frames are given (from /next with steps)
+# they are all sent: in a {'generation', 'states'} object for JSON or one after the other for binary
+def state_response(grid, frames=None):
+    binary = wants_binary()
+    data = request.get_json(silent=True) or {}
+    if frames is None:
+        state = encode_state(grid, binary, data.get('generation'), wants_surface())
+    with metrics.timed(metrics.SERIALISE_SECONDS, 'binary' if binary else 'json', 'write', phase='write'):
+        if frames is None and not binary:
+            return jsonify(state)
+        if not binary:
+            return jsonify({'generation': grid.generation, 'states': frames})
+        body = state if frames is None else wire.join_frames(frames)
+        body, encoding = wire.compress(body, request.headers.get('Accept-Encoding'))
+    response = app.response_class(body, mimetype=wire.MIME_TYPE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    if frames is not None:
+        response.headers['X-Frame-Count'] = str(len(frames))
+    return response
 
 
 @app.route('/')
@@ -31,48 +233,160 @@ def index():
 @app.route('/initial_state', methods=['POST'])
 def get_initial_state():
     """API endpoint: generate and return the initial grid state."""
-    size = request.json.get('size', n)
-    initial_state = initialise_grid(size)
-    return jsonify(initial_state)
+    size = number((request.get_json(silent=True) or {}).get('size', n), 'size', low=1)
+    # Sessions hold grids in memory, no larger than the viewer holds
+    if size > MAX_VIEW_SIZE:
+        return jsonify({"error": f"A grid of {size}³ cells is more than the viewer holds ({MAX_VIEW_SIZE}³)."}), 413
+    session = initialise_grid(size)
+    with session.lock:
+        return state_response(session.grid)
 
 
 @app.route('/next', methods=['POST'])
-def next_step():
-    """API endpoint: advance grid to next generation and return updated state."""
-    grid.update()
-    new_state = [[[cell.celldict() for cell in z] for z in y] for y in grid.cells]
-    return jsonify(new_state)
+@with_session
+def next_step(session):
+    """API endpoint: advance grid to next generation and return updated state. With 'steps' the
+    given number of generations are returned together, taken from the look-ahead buffer when playing.
+    With 'generations' the grid jumps that many generations ahead and only the last one is returned."""
+    grid = session.grid
+    data = request.get_json(silent=True) or {}
+    if 'generations' in data:
+        session.stop_playback()
+        grid.advance(number(data['generations'], 'generations', low=1, high=MAX_GENERATIONS))
+        response = state_response(grid)
+    elif 'steps' not in data:
+        advance(session)
+        response = state_response(grid)
+    else:
+        binary, surface = wants_binary(), wants_surface()
+        client_generation = data.get('generation')
+        frames = []
+        for _ in range(number(data['steps'], 'steps', low=1, high=MAX_STEPS)):
+            advance(session)
+            frames.append(encode_state(grid, binary, client_generation, surface))
+            client_generation = grid.generation
+        response = state_response(grid, frames)
+    # Number of cells recomputed by the step, the rest of the grid could not change
+    response.headers['X-Active-Cells'] = str(grid.active_count)
+    # Once the grid repeats itself its generations are replayed instead of computed
+    if grid.cycles is not None and grid.cycles.period is not None:
+        response.headers['X-Cycle-Period'] = str(grid.cycles.period)
+    return response
+
+
+# Moves the grid one generation on, from the look-ahead buffer if there is one
+def advance(session):
+    if session.lookahead is not None:
+        snapshot = session.lookahead.next()
+        if snapshot is not None:
+            session.grid.restore(snapshot)
+            return
+    session.grid.update()
+
+
+@app.route('/play', methods=['POST'])
+@with_session
+def play(session):
+    """API endpoint: start or stop computing generations ahead while the client plays."""
+    data = request.get_json(silent=True) or {}
+    if data.get('playing'):
+        if session.lookahead is None:
+            depth = number(data.get('depth', DEPTH), 'depth', low=1, high=MAX_STEPS)
+            session.lookahead = LookAhead(session.grid, depth)
+    else:
+        session.stop_playback()
+    return jsonify({"playing": session.lookahead is not None}), 200
+
+
+@app.route('/stream')
+@with_session
+def stream_generations(session):
+    """API endpoint: push generations as server-sent events at 'rate' per second (0 for as fast as
+    they are computed). The first event gives the stream id used by /stream/<id> to change the rate
+    or stop. With format=binary each frame is a base64 wire frame holding the changes since the
+    last frame sent, otherwise the JSON state."""
+    rate = number(request.args.get('rate', RATE), 'rate', float, low=0)
+    binary = request.args.get('format') == 'binary'
+    # What the client was sent of the surface, followed from frame to frame
+    surface = wire.Surface() if wants_surface() else None
+
+    # The stream starts, and is registered with the session, once the response is read
+    def events():
+        with session.lock:
+            evicted = session.evicted
+            if not evicted:
+                source = session.grid
+                start = source.generation
+                stream = Stream(source, rate)
+                session.streams[stream.id] = stream
+        if evicted:
+            yield f"event: error\ndata: {json.dumps({'error': 'The session was evicted, open the stream again.'})}\n\n"
+            return
+        sent = None
+        try:
+            yield f"event: start\ndata: {json.dumps({'id': stream.id, 'generation': source.generation})}\n\n"
+            for snapshot in stream.frames():
+                if snapshot is None:
+                    yield ": keep alive\n\n"
+                    continue
+                if surface is not None:
+                    view = surface.update(SimpleNamespace(size=source.size, **snapshot))
+                    if binary:
+                        data = base64.b64encode(wire.encode_surface(view, view.base)).decode()
+                    else:
+                        data = json.dumps(wire.surface_json(view))
+                elif binary:
+                    data = base64.b64encode(wire.encode_snapshot(snapshot, sent)).decode()
+                else:
+                    data = json.dumps(source.celldicts(snapshot))
+                sent = snapshot
+                yield f"id: {snapshot['generation']}\nevent: frame\ndata: {data}\n\n"
+        finally:
+            stream.stop()
+            with session.lock:
+                # The grid carries on from the last generation the client got, unless it was replaced, stepped
+                # or changed meanwhile (changes stop the playback, which drops the stream from the session)
+                registered = session.streams.pop(stream.id, None) is not None
+                if registered and sent is not None and session.grid is source and source.generation == start:
+                    source.restore(sent)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/stream/<stream_id>', methods=['POST'])
+@with_session
+def control_stream(session, stream_id):
+    """API endpoint: change the rate of a stream ({'rate': x}) or stop it ({'stop': true})."""
+    stream = session.streams.get(stream_id)
+    if stream is None:
+        return jsonify({"error": f"No stream with id: {stream_id}"}), 404
+    data = request.get_json(silent=True) or {}
+    if data.get('stop'):
+        stream.stop()
+    elif 'rate' in data:
+        stream.set_rate(number(data['rate'], 'rate', float, low=0))
+    return jsonify({"rate": stream.rate, "skipped": stream.skipped, "running": stream.running}), 200
 
 
 @app.route('/save', methods=['POST'])
-def save_grid():
+@with_session
+def save_grid(session):
     """API endpoint: saves the current grid state into the MongoDB collection, inserting a new document
-    or replacing an existing one by name."""
+    or replacing an existing one by name. The arrays are stored packed and compressed (see storage.py)."""
     data = request.get_json()
     filename = data.get('filename', 'grid_state')
 
-    # Build a document
-    doc = {
-        'name': filename,
-        'size': grid.size,
-        'cells': [[[cell.cell_type for cell in z] for z in y] for y in grid.cells],
-        'colours': {str(ct): hex(col) for ct, col in grid.colours.items()},
-        'predefined_update': grid.predefined_update
-    }
-
-    # Upsert by name
-    result = grid_collection.replace_one(
-        {'name': filename},
-        doc,
-        upsert=True
-    )
+    # Upsert by name, with the recorded generations unless 'history' is false
+    with metrics.timed(metrics.MONGO_SECONDS, 'save', phase='mongo'):
+        inserted = grid_store.save(filename, session.grid, data.get('history', True))
 
-    return jsonify({"message": f"Grid '{filename}' saved.", "id": str(result.upserted_id or filename)})
+    return jsonify({"message": f"Grid '{filename}' saved.", "id": filename, "inserted": inserted})
 
 
 @app.route('/load', methods=['POST'])
 def load_grid():
-    """API endpoint: load a saved grid state from MongoDB and reinitialise the global Grid object."""
+    """API endpoint: load a saved grid state from MongoDB into the client's session."""
     try:
 
         filename = request.get_json().get('filename')
@@ -80,69 +394,165 @@ def load_grid():
         if not filename:
             return jsonify({"error": "No filename provided."}), 400
 
-        doc = grid_collection.find_one({'name': filename})
-        if not doc:
+        # Packed documents are decoded straight into the grid arrays, older ones with nested cells still load.
+        # Grids saved as bricks are viewed in memory when they are small enough, larger ones are refused
+        # before their bricks are read
+        try:
+            with metrics.timed(metrics.MONGO_SECONDS, 'load', phase='mongo'):
+                grid = grid_store.load(filename, max_brick_size=MAX_VIEW_SIZE)
+        except GridTooLarge as e:
+            return jsonify({"error": f"{e}, more than the viewer holds ({MAX_VIEW_SIZE}³)."}), 413
+        if grid is None:
             return jsonify({"error": f"No saved grid found with name: {filename}"}), 404
+        if isinstance(grid, BrickGrid):
+            with grid:
+                grid = grid.to_grid()
 
-         # Makes sure size is an integer
-        size = int(doc['size'])
-        
-        # Convert state from floats to integers
-        state = []
-        for x_plane in doc['cells']:
-            plane = []
-            for y_row in x_plane:
-                row = []
-                for z_val in y_row:
-                    # Convert float to int
-                    row.append(int(z_val))
-                plane.append(row)
-            state.append(plane)
-        
-        # Handle colours - makes them integers
-        colours = {}
-        for k, v in doc['colours'].items():
-            colours[int(k)] = int(v, 16) if v else 0
-        
-        # Makes sure that there is a colour for the empty cell
-        if 0 not in colours:
-            colours[0] = 0
-        
-        # Makes sure that predefined_update is an integer
-        predefined_update = int(doc.get('predefined_update', 0))
-
-        # Reinitialise the Grid object
-        global grid
-        grid = Grid(size, state, colours, predefined_update)
-
-        new_state = [[[cell.celldict() for cell in z] for z in y] for y in grid.cells]
-        return jsonify(new_state)
+        # Gives the session a new Grid object
+        session = set_grid(grid)
+        with session.lock:
+            return state_response(session.grid)
     
     except Exception as e:
         print(f"Error in load_grid: {str(e)}")
         return jsonify({"error": f"Failed to load grid: {str(e)}"}), 500
 
 
+@app.route('/grids')
+def list_grids():
+    """API endpoint: names and metadata of the saved grids (size, rule type, population by cell type,
+    thumbnail hash), those starting with 'prefix' if given, 'limit' at a time from 'skip'. The cells are not read."""
+    skip = number(request.args.get('skip', 0), 'skip', low=0)
+    limit = number(request.args.get('limit', LIST_LIMIT), 'limit', low=1, high=LIST_LIMIT)
+    with metrics.timed(metrics.MONGO_SECONDS, 'list', phase='mongo'):
+        grids = grid_store.list(request.args.get('prefix'), skip, limit)
+    return jsonify({"grids": grids, "skip": skip, "limit": limit}), 200
+
+
+@app.route('/grids/prefetch', methods=['POST'])
+def prefetch_grids():
+    """API endpoint: decodes the saved grids named in 'names' into the cache of loaded grids, so loading
+    them next does not go back to MongoDB. Grids saved as bricks or with a history are not cached."""
+    names = (request.get_json() or {}).get('names')
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        return jsonify({"error": "names must be a list of grid names."}), 400
+    with metrics.timed(metrics.MONGO_SECONDS, 'prefetch', phase='mongo'):
+        decoded = grid_store.prefetch(names)
+    return jsonify({"decoded": decoded, "cache": grid_cache.stats()}), 200
+
+
 @app.route('/edit-rules', methods=['POST'])
-def edit_rules():
+@with_session
+def edit_rules(session):
     """API endpoint: update the automaton rules based on user input."""
     data = request.get_json()
     new_rules = data.get('rules')
 
     if new_rules:
-        
-        # Updates the rules
-        x, y, z = new_rules.split('/')
-        stay_alive = list(map(int, x.split(',')))
-        get_alive = list(map(int, y.split(',')))
-        
-        #global grid
-        grid.edited_rules = [stay_alive, get_alive, z]
+        # Rules are S/B/N or S/B/C/N, a K neighbourhood takes its weights from 'kernel'
+        try:
+            rules, radius, states = engine.parse_rules(new_rules)
+            session.grid.edit_rules(rules, radius, states, data.get('kernel'))
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": f"Invalid rules: {e}"}), 400
+        session.stop_playback()
 
         return jsonify({"message": "Rules updated successfully"}), 200
     else:
         return jsonify({"error": "Invalid rules format"}), 400
 
 
+# Range of generations recorded for a grid and the memory they take
+def history_info(grid):
+    history = grid.history
+    if history is None:
+        return {"recording": False, "generation": grid.generation}
+    return {"recording": True, "generation": grid.generation, "first": history.first, "last": history.last,
+            "checkpoints": len(history.segments), "bytes": history.memory_usage()}
+
+
+@app.route('/history', methods=['GET', 'POST'])
+@with_session
+def grid_history(session):
+    """API endpoint: start ({'recording': true, 'max_mb': 64}) or stop ({'recording': false}) recording
+    the generations of the grid. Both methods return the generations recorded and their size."""
+    grid = session.grid
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if not data.get('recording'):
+            grid.history = None
+        elif grid.history is None:
+            max_mb = number(data.get('max_mb', HISTORY_BYTES / 1024 / 1024), 'max_mb', float, low=0)
+            max_bytes = int(max_mb * 1024 * 1024)
+            History(max_bytes).attach(grid)
+    return jsonify(history_info(grid)), 200
+
+
+@app.route('/seek', methods=['POST'])
+@with_session
+def seek(session):
+    """API endpoint: move the grid to a recorded generation ({'generation': n}) and return its state.
+    Stepping from there replaces the generations recorded after it."""
+    grid = session.grid
+    data = request.get_json(silent=True) or {}
+    if grid.history is None:
+        return jsonify({"error": "The generations of this grid are not recorded."}), 400
+    if 'generation' not in data:
+        return jsonify({"error": "No generation provided."}), 400
+    generation = number(data['generation'], 'generation')
+    if grid.history.find(generation) is None:
+        return jsonify({"error": f"Generation {generation} is not recorded.", **history_info(grid)}), 404
+
+    session.stop_playback()
+    grid.history.seek(grid, generation)
+    # The surface sent so far was followed step by step, the grid jumped
+    grid.surface = None
+    return state_response(grid)
+
+
+# Engine stepping the grid and the nodes the octree keeps
+def engine_info(grid):
+    info = {"engine": "arrays" if grid.octree is None else "octree", "octree_rules": hashlife.supports(grid)}
+    if grid.octree is not None:
+        info.update({"nodes": len(grid.octree.table), "bytes": grid.octree.memory_usage(),
+                     "max_bytes": grid.octree.max_bytes, "population": grid.octree.population})
+    return info
+
+
+@app.route('/engine', methods=['GET', 'POST'])
+@with_session
+def grid_engine(session):
+    """API endpoint: step the life rules with the memoised octree ({'engine': 'octree', 'cache_mb': 256})
+    or with the arrays ({'engine': 'arrays'}). The octree suits large sparse grids and jumps (/next with
+    'generations'), rules it cannot step (radius over 1, births with no neighbours) use the arrays."""
+    grid = session.grid
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if data.get('engine') not in ('octree', 'arrays'):
+            return jsonify({"error": "The engine is 'octree' or 'arrays'."}), 400
+        session.stop_playback()
+        if data['engine'] == 'arrays':
+            grid.octree = None
+        else:
+            cache_mb = number(data.get('cache_mb', hashlife.MAX_BYTES / 1024 / 1024), 'cache_mb', float, low=0)
+            max_bytes = int(cache_mb * 1024 * 1024)
+            grid.octree = hashlife.Universe.from_grid(grid, max_bytes)
+    return jsonify(engine_info(grid)), 200
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """API endpoint: histograms of the step, serialisation, MongoDB and request times and of the response
+    sizes, in the Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/registry')
+def registry_stats():
+    """API endpoint: number of grids in memory, their size and how many were evicted, spilled and loaded back,
+    and the same for the cache of loaded grids."""
+    return jsonify(dict(registry.stats(), cache=grid_cache.stats())), 200
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
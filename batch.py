@@ -0,0 +1,369 @@
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+class TestBatch(unittest.TestCase):
+
+    # Collection taking bulk writes, with the documents kept by name
+    class BulkCollection:
+        def __init__(self):
+            self.documents = {}
+            self.writes = []
+
+        def bulk_write(self, requests, ordered=True):
+            self.writes.append(len(requests))
+            for request in requests:
+                self.documents[request._filter['name']] = request._doc
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='batch-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_jsonl(self, name):
+        with open(os.path.join(self.directory, name)) as f:
+            return [json.loads(line) for line in f]
+
+    SPEC = {'name': 'test', 'size': 8, 'generations': 6, 'density': 0.3, 'seeds': 2,
+            'rules': ['2,3/3/M'], 'stay': ['4', '5-6'], 'get': ['4'], 'neighbourhoods': ['M', 'N']}
+
+    # Test a sweep is the product of its rules and seeds, with ids that do not depend on the order
+    def test_runs(self):
+        runs = sweep_runs(self.SPEC)
+        self.assertEqual(len(runs), (1 + 2 * 1 * 2) * 2)
+        self.assertEqual(len({run['id'] for run in runs}), len(runs))
+        self.assertEqual(runs[2]['rules'], '4/4/M')
+        spec = dict(self.SPEC, rules=[], stay=['5-6', '4'], trees='trees.json', tree_seeds=[7])
+        ids = {run['id'] for run in sweep_runs(spec)}
+        self.assertTrue(ids > {run['id'] for run in runs[2:]})
+        self.assertIn('tree', {run['kind'] for run in sweep_runs(spec)})
+        with self.assertRaises(ValueError):
+            sweep_runs(dict(self.SPEC, rules=['2/3']))
+
+    # Test every generation of every run is summarised, and the final states load back as they ended
+    def test_run_sweep(self):
+        spec = dict(self.SPEC, rules=['2,3/3/M', '26/26/M'], stay=[], trees='trees.json', tree_seeds=[1])
+        runs = run_sweep(spec, self.directory, workers=2, stats_format='csv')
+        self.assertEqual(len(runs), 5)
+        with open(os.path.join(self.directory, 'stats.csv')) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 5 * (spec['generations'] + 1))
+        summaries = {summary['id']: summary for summary in self.read_jsonl('runs.jsonl')}
+        still = [summary for summary in summaries.values() if summary.get('rules') == '26/26/M']
+        self.assertEqual(still[0]['stable_at'], 2)
+        self.assertEqual(still[0]['period'], 1)
+        tree = [summary for summary in summaries.values() if summary['kind'] == 'tree'][0]
+        self.assertIsNone(tree['stable_at'])
+        grid = read_state(os.path.join(self.directory, tree['state']))
+        self.assertEqual((grid.generation, grid.predefined_update), (spec['generations'], 1))
+        last = [row for row in rows if row['run'] == tree['id']][-1]
+        self.assertEqual(json.loads(last['population']), population(grid))
+
+    # Test an interrupted sweep only runs what it had not finished, and drops the rows of unfinished runs
+    def test_resume(self):
+        run_sweep(self.SPEC, self.directory, workers=1)
+        summaries = self.read_jsonl('runs.jsonl')
+        stats = self.read_jsonl('stats.jsonl')
+        with open(os.path.join(self.directory, 'runs.jsonl'), 'w') as f:
+            f.writelines(json.dumps(summary) + '\n' for summary in summaries[:-2])
+            f.write('{"id": "cut')
+        with open(os.path.join(self.directory, 'stats.jsonl'), 'a') as f:
+            f.write('{"run": "cut')
+        redone = run_sweep(self.SPEC, self.directory, workers=1)
+        self.assertEqual(sorted(summary['id'] for summary in redone), sorted(s['id'] for s in summaries[-2:]))
+        self.assertEqual(sorted(map(json.dumps, self.read_jsonl('stats.jsonl'))), sorted(map(json.dumps, stats)))
+        self.assertEqual(run_sweep(self.SPEC, self.directory, workers=1), [])
+
+    # Test the final states go to MongoDB in bulk writes, which a resumed sweep can repeat
+    def test_mongo(self):
+        from storage import unpack_grid
+        collection = self.BulkCollection()
+        runs = run_sweep(self.SPEC, self.directory, workers=2, collection=collection, batch_size=4)
+        self.assertEqual(collection.writes, [4, 4, 2])
+        document = collection.documents[runs[0]['state']]
+        grid = unpack_grid(document, document['blob'])
+        self.assertEqual(grid.generation, self.SPEC['generations'])
+
+
+# Fraction of live cells in the random life grids by default
+DENSITY = 0.2
+GENERATIONS = 100
+# Final states written to MongoDB in one bulk write
+BATCH_SIZE = 100
+
+
+# Runs of a sweep: every life rule with every seed, and every tree of the trees file with every tree seed.
+# Life rules are given as rule strings ("rules"), and as the product of stay alive and get alive counts
+# with neighbourhoods ("stay", "get", "neighbourhoods"). Each run has an id made from its parameters
+def sweep_runs(spec):
+    from engine import parse_rules
+    seeds = spec.get('seeds', 1)
+    seeds = list(range(seeds)) if isinstance(seeds, int) else list(seeds)
+    rules = list(spec.get('rules', []))
+    for stay, get, neighbourhood in itertools.product(spec.get('stay', []), spec.get('get', []),
+                                                      spec.get('neighbourhoods', ['M'])):
+        rules.append(f'{stay}/{get}/{neighbourhood}')
+
+    size = spec.get('size', 32)
+    generations = spec.get('generations', GENERATIONS)
+    runs = []
+    for rule, seed in itertools.product(rules, seeds):
+        # Bad rules fail the whole sweep before anything runs
+        parse_rules(rule)
+        runs.append({'kind': 'life', 'rules': rule, 'seed': seed, 'size': size, 'generations': generations,
+                     'density': spec.get('density', DENSITY)})
+    if spec.get('trees'):
+        with open(spec['trees']) as f:
+            trees = json.load(f)
+        tree_seeds = spec.get('tree_seeds', seeds)
+        tree_seeds = list(range(tree_seeds)) if isinstance(tree_seeds, int) else list(tree_seeds)
+        for (index, tree), seed in itertools.product(enumerate(trees), tree_seeds):
+            runs.append({'kind': 'tree', 'trees': spec['trees'], 'tree': tree.get('name', index), 'index': index,
+                         'seed': seed, 'generations': generations})
+    for run in runs:
+        run['stop_when_stable'] = bool(spec.get('stop_when_stable', False))
+        run['id'] = hashlib.sha1(json.dumps(run, sort_keys=True).encode()).hexdigest()[:12]
+    return runs
+
+
+# Grid a run starts from: a random life grid, or a tree of the trees file
+def start_grid(run):
+    from grid import Grid
+    from engine import parse_rules
+    if run['kind'] == 'tree':
+        from storage import read_colours
+        with open(run['trees']) as f:
+            tree = json.load(f)[run['index']]
+        return Grid(tree['size'], tree['cells'], read_colours(tree), 1, seed=run['seed'])
+    size = run['size']
+    rng = np.random.default_rng(run['seed'])
+    grid = Grid(size, (rng.random((size, size, size)) < run['density']).astype(np.uint8), {0: 0, 1: 0xff0000},
+                seed=run['seed'])
+    grid.edit_rules(*parse_rules(run['rules']))
+    return grid
+
+
+# Number of cells of every type, empty cells left out
+def population(grid):
+    counts = np.bincount(grid.state.ravel(), minlength=2)
+    return {str(cell_type): int(count) for cell_type, count in enumerate(counts) if cell_type and count}
+
+
+# Lowest and highest corner of the non-empty cells, None for an empty grid
+def bounding_box(grid):
+    corners = []
+    for axis in range(3):
+        occupied = np.flatnonzero(np.any(grid.state, axis=tuple(a for a in range(3) if a != axis)))
+        if len(occupied) == 0:
+            return None
+        corners.append((int(occupied[0]), int(occupied[-1])))
+    return [[low for low, _ in corners], [high for _, high in corners]]
+
+
+def generation_stats(run, grid):
+    return {'run': run['id'], 'generation': grid.generation, 'population': population(grid),
+            'bbox': bounding_box(grid), 'changed': None if grid.changed is None else len(grid.changed)}
+
+
+# Steps a run in a worker process. Returns the stats of every generation, the summary of the run
+# and its final state packed like a saved grid. A life grid is stable from the first generation the
+# cycle detection finds it still or repeating, trees draw new numbers every step and never are
+def execute(run):
+    from storage import pack_grid
+    start = time.perf_counter()
+    grid = start_grid(run)
+    rows = [generation_stats(run, grid)]
+    stable_at = period = None
+    while grid.generation < run['generations']:
+        grid.update()
+        rows.append(generation_stats(run, grid))
+        if stable_at is None and grid.cycles is not None and grid.cycles.period is not None:
+            stable_at, period = grid.generation, grid.cycles.period
+            if run['stop_when_stable']:
+                break
+    summary = dict(run, stable_at=stable_at, period=period, final_generation=grid.generation,
+                   population=population(grid), seconds=round(time.perf_counter() - start, 6))
+    return rows, summary, pack_grid(grid)
+
+
+STATS_FIELDS = ('run', 'generation', 'changed', 'x0', 'y0', 'z0', 'x1', 'y1', 'z1', 'population')
+
+
+# Stats of the generations in a file, one JSON object per line or one CSV row per generation.
+# Rows of runs that were not finished are dropped when a sweep resumes
+class StatsWriter:
+    def __init__(self, path, stats_format, keep):
+        self.format = stats_format
+        rows = self.read(path, keep) if os.path.exists(path) else []
+        self.file = open(path, 'w', newline='')
+        if self.format == 'csv':
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(STATS_FIELDS)
+        self.file.writelines(rows)
+        self.file.flush()
+
+    # Lines of the finished runs, a line cut by an interruption is dropped
+    def read(self, path, keep):
+        with open(path, newline='') as f:
+            lines = f.readlines()
+        if self.format == 'csv':
+            return [line for line in lines[1:] if line.endswith('\n') and line.split(',', 1)[0] in keep]
+        kept = []
+        for line in lines:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if row['run'] in keep:
+                kept.append(line)
+        return kept
+
+    def write(self, rows):
+        for row in rows:
+            if self.format == 'csv':
+                low, high = row['bbox'] or ([''] * 3, [''] * 3)
+                self.writer.writerow([row['run'], row['generation'], '' if row['changed'] is None else row['changed'],
+                                      *low, *high, json.dumps(row['population'])])
+            else:
+                self.file.write(json.dumps(row) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Ids of the runs a sweep finished, from the summaries written once a run and its state are saved
+def finished_runs(path):
+    finished = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    summary = json.loads(line)
+                except ValueError:
+                    continue
+                finished[summary['id']] = summary
+    return finished
+
+
+# Grid saved by a sweep in a state file: the JSON document of pack_grid on the first line, then its blob
+def write_state(path, document, blob):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(json.dumps(document).encode() + b'\n' + blob)
+    os.replace(path + '.tmp', path)
+
+
+def read_state(path):
+    from storage import unpack_grid
+    with open(path, 'rb') as f:
+        document = json.loads(f.readline())
+        return unpack_grid(document, f.read())
+
+
+# Runs a sweep over a process pool into the output directory: stats.jsonl (or stats.csv) with the stats of
+# every generation, runs.jsonl with the summary of every finished run, and the final states in states/, or
+# in the collection in bulk writes of batch_size documents. A run counts as finished once its summary is
+# written, after its state is saved, so a sweep started again only runs the others. Returns their summaries
+def run_sweep(spec, directory, workers=None, stats_format='jsonl', collection=None, batch_size=BATCH_SIZE,
+              log=None):
+    from bson import Binary
+    from pymongo import ReplaceOne
+    os.makedirs(os.path.join(directory, 'states'), exist_ok=True)
+    runs_path = os.path.join(directory, 'runs.jsonl')
+    finished = finished_runs(runs_path)
+    # Lines cut by an interruption are dropped with the runs they belong to
+    with open(runs_path, 'w') as f:
+        f.writelines(json.dumps(summary) + '\n' for summary in finished.values())
+    runs = [run for run in sweep_runs(spec) if run['id'] not in finished]
+    stats = StatsWriter(os.path.join(directory, 'stats.' + stats_format), stats_format, finished)
+    done = []
+    pending = []
+
+    def finish(summaries):
+        with open(runs_path, 'a') as f:
+            f.writelines(json.dumps(summary) + '\n' for summary in summaries)
+        done.extend(summaries)
+        if log is not None:
+            for summary in summaries:
+                log(f"{summary['id']} {summary['kind']:4} {summary.get('rules', summary.get('tree'))} "
+                    f"seed {summary['seed']}: stable at {summary['stable_at']}, {summary['seconds']:.2f} s")
+
+    def flush():
+        if pending:
+            collection.bulk_write([ReplaceOne({'name': summary['state']}, document, upsert=True)
+                                   for summary, document in pending], ordered=False)
+            finish([summary for summary, _ in pending])
+            pending.clear()
+
+    try:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(execute, run) for run in runs]
+            try:
+                for future in as_completed(futures):
+                    rows, summary, (document, blob) = future.result()
+                    stats.write(rows)
+                    if collection is not None:
+                        summary['state'] = f"{spec.get('name', 'sweep')}/{summary['id']}"
+                        document.update(name=summary['state'], blob=Binary(blob), sweep=spec.get('name'))
+                        pending.append((summary, document))
+                        if len(pending) >= batch_size:
+                            flush()
+                    else:
+                        summary['state'] = os.path.join('states', summary['id'] + '.grid')
+                        write_state(os.path.join(directory, summary['state']), document, blob)
+                        finish([summary])
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        if collection is not None:
+            flush()
+    finally:
+        stats.close()
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs a sweep of life rules and tree seeds over a process pool, '
+                                                 'writing the stats of every generation and the final states.')
+    parser.add_argument('spec', help='JSON file with the sweep: size, generations, density, seeds, rules, stay, '
+                                     'get, neighbourhoods, trees, tree_seeds, stop_when_stable')
+    parser.add_argument('--output', default='sweep', help='Directory of the results, a sweep started again '
+                                                          'there only runs what it had not finished')
+    parser.add_argument('--workers', type=int, help='Processes running the sweep, one per CPU by default')
+    parser.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl', help='Format of the stats')
+    parser.add_argument('--mongo', help='MongoDB URI to save the final states to instead of files')
+    parser.add_argument('--collection', default='grids', help='Collection of the final states, the grids /load '
+                                                              'opens by default')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    collection = None
+    if args.mongo:
+        from pymongo import MongoClient
+        collection = MongoClient(args.mongo)['cellular_automaton'][args.collection]
+    try:
+        done = run_sweep(spec, args.output, args.workers, args.format, collection, args.batch_size, log=print)
+    except KeyboardInterrupt:
+        print(f'Interrupted, run it again to finish the sweep in {args.output}')
+        return 130
+    print(f'{len(done)} runs finished, results in {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
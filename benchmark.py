@@ -0,0 +1,294 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+import unittest
+import numpy as np
+
+
+class TestBenchmark(unittest.TestCase):
+
+    # Test a small sweep measures every family of cases with its time, memory and payload
+    def test_run(self):
+        results = run(sizes=[8], radii=[1], repeat=1)
+        for prefix in ('update/life/M/r1/8', 'update/tree/N/r1/8', 'neighbours/M/r1/8', 'tree1_update/M/r1/8',
+                       'celldicts/8', 'frame/8', 'surface/8', 'endpoint/initial_state/8', 'endpoint/next_binary/8',
+                       'endpoint/load/8'):
+            self.assertIn(prefix, results['results'])
+        for result in results['results'].values():
+            self.assertGreater(result['seconds'], 0)
+            self.assertGreaterEqual(result['peak_bytes'], 0)
+        self.assertEqual(results['results']['celldicts/8']['payload_bytes'],
+                         len(json.dumps(life_grid(8, 'M', 1).celldicts()).encode()))
+        self.assertEqual(compare(results, results), [])
+
+    # Test slower, larger or heavier results past the threshold are regressions, and tiny times are not
+    def test_compare(self):
+        baseline = {'results': {'a': {'seconds': 0.1, 'peak_bytes': 1000, 'payload_bytes': 100},
+                                'b': {'seconds': 0.00001, 'peak_bytes': 0},
+                                'c': {'seconds': 0.1, 'peak_bytes': 0}}}
+        results = {'results': {'a': {'seconds': 0.2, 'peak_bytes': 1100, 'payload_bytes': 200},
+                               'b': {'seconds': 0.00004, 'peak_bytes': 0},
+                               'd': {'seconds': 1.0, 'peak_bytes': 0}}}
+        regressions = compare(results, baseline, threshold=0.25)
+        self.assertEqual([(r['case'], r['metric']) for r in regressions],
+                         [('a', 'seconds'), ('a', 'payload_bytes')])
+        self.assertEqual(regressions[0]['ratio'], 2.0)
+
+
+# Grid sizes, neighbourhoods and radii swept by default
+SIZES = (8, 16, 32, 64, 128)
+NEIGHBOURHOODS = ('M', 'N')
+RADII = (1, 2)
+# Timed runs of each case, the fastest one is compared
+REPEAT = 3
+# A case is a regression when it is this fraction slower, larger or heavier than the baseline
+THRESHOLD = 0.25
+# Time differences under this are noise, whatever their ratio
+MIN_SECONDS = 0.001
+# Cells looked up or updated one by one in the per cell cases
+SAMPLE = 64
+LIFE_RULES = [[2, 3, 4], [3], 'M']
+
+
+# Random life grid, a fifth of the cells alive
+def life_grid(size, neighbourhood_type, radius, seed=1):
+    from grid import Grid
+    rng = np.random.default_rng(seed)
+    grid = Grid(size, (rng.random((size, size, size)) < 0.2).astype(np.uint8), {0: 0, 1: 0xff0000})
+    grid.edited_rules = [list(LIFE_RULES[0]), list(LIFE_RULES[1]), neighbourhood_type]
+    grid.radius = radius
+    # Replayed cycles would time the replay instead of the step
+    grid.detect_cycles = False
+    return grid
+
+
+# Random tree grid with the cell types of every tree transition and random heights
+def tree_grid(size, neighbourhood_type, radius, seed=1):
+    from grid import Grid
+    rng = np.random.default_rng(seed)
+    types = np.array([0, 0, 0, 0, 0, 0, 2, 3, 4, 5, 6, 8, 9, 11, 1], dtype=np.uint8)
+    grid = Grid(size, rng.choice(types, (size, size, size)), {t: 0x123456 for t in range(13)}, 1, seed=seed)
+    grid.heights = rng.integers(0, 9, (size, size, size), dtype=np.uint8)
+    grid.edited_rules[2] = neighbourhood_type
+    grid.radius = radius
+    return grid
+
+
+# Cells sampled the same way in every run
+def sample_positions(size, count=SAMPLE, seed=1):
+    rng = random.Random(seed)
+    return [(rng.randrange(size), rng.randrange(size), rng.randrange(size)) for _ in range(count)]
+
+
+# Collection and GridFS for /save and /load: mongomock when it is installed, otherwise the dict
+# stand-ins of the storage tests. Neither needs a running MongoDB
+def local_store():
+    from storage import GridStore, TestStorage
+    try:
+        import mongomock
+    except ImportError:
+        return GridStore(TestStorage.DictCollection(), TestStorage.DictFS())
+    return GridStore(mongomock.MongoClient()['benchmark']['grids'])
+
+
+# A benchmark case: setup builds what run uses, only run is timed. run returns the bytes it produced, if any
+class Case:
+    def __init__(self, name, setup, run):
+        self.name = name
+        self.setup = setup
+        self.run = run
+
+
+def update_cases(sizes, neighbourhoods, radii):
+    for family, make in (('life', life_grid), ('tree', tree_grid)):
+        for nt in neighbourhoods:
+            for radius in radii:
+                for size in sizes:
+                    def setup(make=make, size=size, nt=nt, radius=radius):
+                        return make(size, nt, radius)
+                    yield Case(f'update/{family}/{nt}/r{radius}/{size}', setup, lambda grid: grid.update())
+
+
+def neighbour_cases(sizes, neighbourhoods, radii):
+    for nt in neighbourhoods:
+        for radius in radii:
+            for size in sizes:
+                def setup(size=size):
+                    return life_grid(size, 'M', 1), sample_positions(size)
+
+                def lookup(state, nt=nt, radius=radius):
+                    grid, positions = state
+                    for x, y, z in positions:
+                        grid.get_neighbours(x, y, z, radius, nt)
+                yield Case(f'neighbours/{nt}/r{radius}/{size}', setup, lookup)
+
+
+def tree1_update_cases(sizes, neighbourhoods, radii):
+    from cell import Cell
+    for nt in neighbourhoods:
+        for radius in radii:
+            for size in sizes:
+                def setup(size=size, nt=nt, radius=radius):
+                    grid = tree_grid(size, nt, radius)
+                    cells = grid.cell_list()
+                    return [(cells[x][y][z], grid.get_neighbours(x, y, z, radius, nt, cells))
+                            for x, y, z in sample_positions(size)]
+
+                def update(pairs):
+                    draws = random.Random(1)
+                    for cell, neighbours in pairs:
+                        Cell(cell.cell_type, cell.position, cell.colour, 1).tree1_update(neighbours, rand=draws.random)
+                yield Case(f'tree1_update/{nt}/r{radius}/{size}', setup, update)
+
+
+def serialisation_cases(sizes):
+    import wire
+    for size in sizes:
+        def setup(size=size):
+            return life_grid(size, 'M', 1)
+        yield Case(f'celldicts/{size}', setup, lambda grid: json.dumps(grid.celldicts()).encode())
+        yield Case(f'frame/{size}', setup, lambda grid: wire.encode_frame(grid))
+        yield Case(f'surface/{size}', setup, lambda grid: wire.encode_surface(wire.Surface().update(grid)))
+
+
+# The Flask routes through the test client, with the grids saved in a local store
+def endpoint_cases(sizes):
+    # Spilling evicted sessions would need MongoDB
+    os.environ.setdefault('GRID_SPILL', '0')
+    import app
+
+    def post(client, route, body):
+        response = client.post(route, json=body)
+        if response.status_code != 200:
+            raise RuntimeError(f'{route} answered {response.status_code}: {response.get_data(as_text=True)[:200]}')
+        return response.get_data()
+
+    for size in sizes:
+        def new_client():
+            app.grid_store = local_store()
+            return app.app.test_client()
+
+        def started(size=size):
+            client = new_client()
+            post(client, '/initial_state', {'size': size})
+            return client
+
+        def saved(size=size):
+            client = started(size)
+            post(client, '/save', {'filename': 'benchmark'})
+            return client
+
+        yield Case(f'endpoint/initial_state/{size}', new_client,
+                   lambda client, size=size: post(client, '/initial_state', {'size': size}))
+        yield Case(f'endpoint/next/{size}', started, lambda client: post(client, '/next', {}))
+        yield Case(f'endpoint/next_binary/{size}', started, lambda client: post(client, '/next', {'format': 'binary'}))
+        yield Case(f'endpoint/save/{size}', started, lambda client: post(client, '/save', {'filename': 'benchmark'}))
+        yield Case(f'endpoint/load/{size}', saved, lambda client: post(client, '/load', {'filename': 'benchmark'}))
+
+
+def cases(sizes=SIZES, neighbourhoods=NEIGHBOURHOODS, radii=RADII):
+    yield from update_cases(sizes, neighbourhoods, radii)
+    yield from neighbour_cases(sizes, neighbourhoods, radii)
+    yield from tree1_update_cases(sizes, neighbourhoods, radii)
+    yield from serialisation_cases(sizes)
+    yield from endpoint_cases(sizes)
+
+
+# Fastest and median time of the runs, the peak memory traced during one more run and the bytes it produced
+def measure(case, repeat=REPEAT):
+    times = []
+    for _ in range(repeat):
+        state = case.setup()
+        start = time.perf_counter()
+        case.run(state)
+        times.append(time.perf_counter() - start)
+
+    # Tracing slows the run down, so it is not timed
+    state = case.setup()
+    tracemalloc.start()
+    try:
+        payload = case.run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    result = {'seconds': min(times), 'median_seconds': statistics.median(times), 'peak_bytes': peak}
+    if payload is not None:
+        result['payload_bytes'] = len(payload)
+    return result
+
+
+def run(sizes=SIZES, neighbourhoods=NEIGHBOURHOODS, radii=RADII, repeat=REPEAT, only=None, log=None):
+    results = {}
+    for case in cases(sizes, neighbourhoods, radii):
+        if only and not any(case.name.startswith(prefix) for prefix in only):
+            continue
+        results[case.name] = measure(case, repeat)
+        if log is not None:
+            result = results[case.name]
+            log(f"{case.name:40} {result['seconds'] * 1000:10.2f} ms {result['peak_bytes'] / 1024:12.0f} KiB"
+                + (f" {result['payload_bytes']:12} bytes" if 'payload_bytes' in result else ''))
+    return {'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                     'processor': platform.processor(), 'cpus': os.cpu_count(), 'repeat': repeat,
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+
+# Cases slower, with a higher peak or a larger payload than in the baseline by more than the threshold.
+# Cases missing from either side are not compared
+def compare(results, baseline, threshold=THRESHOLD):
+    regressions = []
+    for name, result in results['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        for metric in ('seconds', 'peak_bytes', 'payload_bytes'):
+            if metric not in result or not old.get(metric):
+                continue
+            if metric == 'seconds' and result[metric] - old[metric] < MIN_SECONDS:
+                continue
+            ratio = result[metric] / old[metric]
+            if ratio > 1 + threshold:
+                regressions.append({'case': name, 'metric': metric, 'baseline': old[metric], 'result': result[metric],
+                                    'ratio': round(ratio, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Times the grid steps, neighbour lookups, serialisation and '
+                                                 'endpoints, and compares them with a baseline.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES))
+    parser.add_argument('--neighbourhoods', nargs='+', default=list(NEIGHBOURHOODS), choices=NEIGHBOURHOODS)
+    parser.add_argument('--radii', type=int, nargs='+', default=list(RADII))
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--only', nargs='+', help='Only the cases whose name starts with one of these')
+    parser.add_argument('--output', default='benchmark.json', help='File the results are written to')
+    parser.add_argument('--baseline', help='Results to compare with, regressions make the exit status 1')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.neighbourhoods, args.radii, args.repeat, args.only, log=print)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"Regression in {regression['case']} {regression['metric']}: "
+                  f"{regression['baseline']} -> {regression['result']} (x{regression['ratio']})")
+        if regressions:
+            return 1
+        print(f'No regression over {args.threshold:.0%} against {args.baseline}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
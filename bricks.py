@@ -0,0 +1,454 @@
+import argparse
+import engine
+import itertools
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+
+
+class TestBricks(unittest.TestCase):
+
+    def random_grid(self, size, seed, fill=0.3):
+        from grid import Grid
+        state = np.zeros((size, size, size), dtype=np.uint8)
+        rng = np.random.default_rng(seed)
+        state[3:size - 4, 5:size - 2, 1:size - 6] = rng.random((size - 7, size - 7, size - 7)) < fill
+        return Grid(size, state, {0: 0, 1: 0x00ff00})
+
+    # Test bricks stepped with their halos give the same grid as the arrays, with a partial brick at the far faces
+    def test_matches_dense(self):
+        for rules, radius, states in [([[2, 3, 4], [3], 'M'], 1, 2), ([[1, 2], [1, 3], 'N'], 2, 2),
+                                      ([[4, 5], [4], 'M'], 1, 4), ([[], [], 'M'], 1, 2)]:
+            grid = self.random_grid(21, 1)
+            grid.edit_rules(rules, radius, states)
+            with BrickGrid.from_grid(grid, brick=8) as bricks:
+                for _ in range(4):
+                    grid.update()
+                    bricks.update()
+                    types, colours = bricks.arrays()
+                    self.assertTrue(np.array_equal(types, grid.state))
+                    self.assertTrue(np.array_equal(np.array(bricks.palette)[colours], grid.colour_state))
+                self.assertEqual(bricks.generation, 4)
+                self.assertEqual(bricks.population(), np.count_nonzero(grid.state == 1))
+
+    # Test bricks with no live cell are neither stored nor stepped, and the cache keeps to its limit
+    def test_sparse(self):
+        with BrickGrid(128, {0: 0, 1: 0xff0000}, brick=16, cache_bytes=4 * 2 * 16 ** 3) as bricks:
+            bricks.edited_rules = [[2, 3, 4], [3], 'M']
+            block = np.zeros((4, 4, 4), dtype=np.uint8)
+            block[1:3, 1:3, 1:3] = 1
+            bricks.set_region((30, 62, 94), block, np.ones(block.shape, dtype=np.uint8))
+            self.assertEqual(bricks.stored(), 8)
+            for _ in range(3):
+                bricks.update()
+            self.assertLessEqual(bricks.stored(), 27)
+            self.assertLessEqual(bricks.stepped, 64)
+            self.assertLessEqual(bricks.cache.nbytes, bricks.cache.max_bytes)
+            self.assertLess(bricks.file_bytes(), 128 ** 3)
+            types, _ = bricks.region((28, 60, 92), (36, 68, 100))
+            self.assertEqual(np.count_nonzero(types), bricks.population())
+
+    # Test a grid larger than the brick file starts with grows it, and a closed grid removes its files
+    def test_growth(self):
+        grid = self.random_grid(40, 2, fill=0.6)
+        bricks = BrickGrid.from_grid(grid, brick=8)
+        self.assertEqual(bricks.stored(), 125)
+        self.assertGreaterEqual(bricks.front.slots, 125)
+        self.assertTrue(np.array_equal(bricks.arrays()[0], grid.state))
+        directory = bricks.directory
+        bricks.close()
+        self.assertFalse(os.path.exists(directory))
+
+    # Test the command line steps a random soup as bricks, saves it, and carries on from the saved grid
+    def test_main(self):
+        from storage import GridStore, TestStorage
+        store = GridStore(TestStorage.DictCollection(), TestStorage.DictFS())
+        args = ['large', '--size', '200', '--brick', '16', '--soup', '20', '--rules', '4/4/M', '--generations', '2']
+        self.assertEqual(main(args, store, log=lambda line: None), 0)
+        document = store.collection.documents['large']
+        self.assertEqual((document['format'], document['size'], document['generation']), ('bricks', 200, 2))
+        self.assertEqual(main(['large', '--resume', '--generations', '1'], store, log=lambda line: None), 0)
+        with store.load('large') as bricks:
+            self.assertEqual((bricks.generation, bricks.edited_rules), (3, [[4], [4], 'M']))
+            self.assertEqual(sum(store.collection.documents['large']['population'].values()), bricks.population())
+        self.assertEqual(main(['large', '--rules', '4/4/K'], store, log=lambda line: None), 2)
+
+
+# Side of the cubes of cells the grid is tiled into
+BRICK = 32
+# Bytes of bricks read from the files kept in memory by default
+CACHE_BYTES = 64 * 1024 * 1024
+
+
+# File of brick slots mapped into memory, each slot holds the types and colour indices of one brick.
+# Slots are reused once freed and the file doubles when it is full
+class BrickFile:
+    def __init__(self, path, brick, slots=64):
+        self.path = path
+        self.brick = brick
+        self.slots = 0
+        self.free = []
+        self.used = 0
+        self.array = None
+        self.grow(slots)
+
+    def grow(self, slots):
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+        with open(self.path, 'ab') as f:
+            f.truncate(slots * 2 * self.brick ** 3)
+        self.array = np.memmap(self.path, dtype=np.uint8, mode='r+', shape=(slots, 2) + (self.brick,) * 3)
+        self.free.extend(range(slots - 1, self.slots - 1, -1))
+        self.slots = slots
+
+    def allocate(self):
+        if not self.free:
+            self.grow(2 * self.slots)
+        self.used += 1
+        return self.free.pop()
+
+    def release(self, slot):
+        self.free.append(slot)
+        self.used -= 1
+
+    # Frees every slot, the file keeps its size for the next generation
+    def clear(self):
+        self.free = list(range(self.slots - 1, -1, -1))
+        self.used = 0
+
+    def read(self, slot):
+        return self.array[slot, 0], self.array[slot, 1]
+
+    def write(self, slot, types, colours):
+        self.array[slot, 0] = types
+        self.array[slot, 1] = colours
+
+    def close(self):
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+
+
+# Least recently used bricks read from a file, copied so the pages of the file can be dropped
+class BrickCache:
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bricks = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key, file, slot):
+        brick = self.bricks.get(key)
+        if brick is not None:
+            self.bricks.move_to_end(key)
+            return brick
+        brick = tuple(np.array(array) for array in file.read(slot))
+        size = sum(array.nbytes for array in brick)
+        while self.bricks and self.nbytes + size > self.max_bytes:
+            _, old = self.bricks.popitem(last=False)
+            self.nbytes -= sum(array.nbytes for array in old)
+        if size <= self.max_bytes:
+            self.bricks[key] = brick
+            self.nbytes += size
+        return brick
+
+    def clear(self):
+        self.bricks.clear()
+        self.nbytes = 0
+
+
+# Life grid too large for memory, tiled into bricks of brick³ cells kept in a memory-mapped file. Bricks with
+# no live cell are not stored, and a generation only steps the bricks next to a stored one, each with a halo
+# of its neighbours, into a second file the grid then swaps with. Only the bricks around the one being stepped
+# and the brick cache are in memory. Steps the life rules like Grid.update_array, cells of a type above 1
+# that are not part of a Generations rule count as live bricks but are never changed
+class BrickGrid:
+    def __init__(self, size, colours, brick=BRICK, cache_bytes=CACHE_BYTES, directory=None):
+        self.size = size
+        self.brick = brick
+        self.colours = colours
+        self.count = -(-size // brick)
+        self.edited_rules = [[], [], 'M']
+        self.radius = 1
+        self.states = 2
+        self.kernel = None
+        self.predefined_update = 0
+        self.generation = 0
+        self.palette = []
+        for colour in colours.values():
+            self.palette_index(colour)
+        # Bricks stepped by the last generation
+        self.stepped = 0
+
+        # The files are removed with the directory when the grid made it
+        self.owns_directory = directory is None
+        self.directory = tempfile.mkdtemp(prefix='bricks-') if directory is None else directory
+        self.front = BrickFile(os.path.join(self.directory, 'front.bin'), brick)
+        self.back = BrickFile(os.path.join(self.directory, 'back.bin'), brick)
+        # Slot in the front file of every stored brick by its (x, y, z) brick coordinates
+        self.index = {}
+        # Stored bricks with live cells, the others only keep the colours their dead cells are reborn with
+        self.live = set()
+        self.cache = BrickCache(cache_bytes)
+
+    @classmethod
+    def from_grid(cls, grid, brick=BRICK, cache_bytes=CACHE_BYTES, directory=None):
+        bricks = cls(grid.size, dict(grid.colours), brick, cache_bytes, directory)
+        bricks.edited_rules = [list(grid.edited_rules[0]), list(grid.edited_rules[1]), grid.edited_rules[2]]
+        bricks.radius, bricks.states, bricks.kernel = grid.radius, grid.states, grid.kernel
+        bricks.generation = grid.generation
+        bricks.palette = list(grid.palette)
+        bricks.set_region((0, 0, 0), grid.state, grid.colour_index)
+        return bricks
+
+    # Grid holding every cell in memory, for bricks small enough to be viewed
+    def to_grid(self):
+        from grid import Grid
+        types, colours = self.arrays()
+        grid = Grid(self.size, np.zeros(types.shape, dtype=np.uint8), dict(self.colours))
+        grid.state, grid.colour_index = types, colours
+        grid.palette = list(self.palette)
+        grid.edited_rules = [list(self.edited_rules[0]), list(self.edited_rules[1]), self.edited_rules[2]]
+        grid.radius, grid.states, grid.kernel = self.radius, self.states, self.kernel
+        grid.generation = self.generation
+        return grid
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.front.close()
+        self.back.close()
+        self.cache.clear()
+        if self.owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def palette_index(self, colour):
+        if colour not in self.palette:
+            if len(self.palette) == 256:
+                raise ValueError("A grid can only hold 256 colours")
+            self.palette.append(colour)
+        return self.palette.index(colour)
+
+    # Number of bricks stored, the others have neither live cells nor colours
+    def stored(self):
+        return len(self.index)
+
+    # Bytes of the two brick files on disk
+    def file_bytes(self):
+        return sum(os.path.getsize(file.path) for file in (self.front, self.back))
+
+    def population(self):
+        return sum(int(np.count_nonzero(self.brick_arrays(key)[0] == 1)) for key in self.index)
+
+    # Types and colour indices of a stored brick, None for an empty one
+    def brick_arrays(self, key):
+        slot = self.index.get(key)
+        if slot is None:
+            return None
+        return self.cache.get(key, self.front, slot)
+
+    # Writes a block of cells with its lowest corner at origin, bricks left without live cells are dropped
+    def set_region(self, origin, types, colours):
+        end = [o + n for o, n in zip(origin, types.shape)]
+        for key in self.keys_between(origin, end):
+            brick = self.brick_arrays(key)
+            brick_types, brick_colours = (np.zeros((self.brick,) * 3, dtype=np.uint8) for _ in range(2))
+            if brick is not None:
+                brick_types[:], brick_colours[:] = brick
+            inside, outside = self.overlap(key, origin, end)
+            brick_types[inside] = types[outside]
+            brick_colours[inside] = colours[outside]
+            self.store(key, brick_types, brick_colours)
+
+    # Types and colour indices of the cells from start (included) to end (excluded)
+    def region(self, start, end):
+        shape = tuple(e - s for s, e in zip(start, end))
+        types, colours = np.zeros(shape, dtype=np.uint8), np.zeros(shape, dtype=np.uint8)
+        for key in self.keys_between(start, end):
+            brick = self.brick_arrays(key)
+            if brick is not None:
+                inside, outside = self.overlap(key, start, end)
+                types[outside] = brick[0][inside]
+                colours[outside] = brick[1][inside]
+        return types, colours
+
+    def arrays(self):
+        return self.region((0, 0, 0), (self.size,) * 3)
+
+    # Brick coordinates of the bricks holding cells from start to end
+    def keys_between(self, start, end):
+        ranges = [range(max(s, 0) // self.brick, -(-min(e, self.size) // self.brick)) for s, e in zip(start, end)]
+        return itertools.product(*ranges)
+
+    # Slices of a brick, and of a block from start to end, where they overlap
+    def overlap(self, key, start, end):
+        inside, outside = [], []
+        for k, s, e in zip(key, start, end):
+            lo, hi = max(k * self.brick, s), min((k + 1) * self.brick, e)
+            inside.append(slice(lo - k * self.brick, hi - k * self.brick))
+            outside.append(slice(lo - s, hi - s))
+        return tuple(inside), tuple(outside)
+
+    def store(self, key, types, colours, file=None):
+        file = file or self.front
+        index, live = (self.index, self.live) if file is self.front else (self.next_index, self.next_live)
+        slot = index.pop(key, None)
+        live.discard(key)
+        # Dead cells keep their colour indices for the rules that don't recolour births, so only bricks with
+        # neither live cells nor colours are dropped
+        if not types.any() and not colours.any():
+            if slot is not None:
+                file.release(slot)
+            self.cache.bricks.pop(key, None)
+            return
+        if slot is None:
+            slot = file.allocate()
+        file.write(slot, types, colours)
+        index[key] = slot
+        if types.any():
+            live.add(key)
+        if file is self.front:
+            self.cache.bricks.pop(key, None)
+
+    # Radius of the neighbourhood, the halo each brick is stepped with
+    def halo(self):
+        return engine.kernel_radius(self.kernel) if self.kernel is not None else self.radius
+
+    # Bricks that can have live cells next generation: the ones with live cells and their neighbours,
+    # or all of them when empty cells are born with no live neighbour
+    def candidates(self):
+        stay_alive, get_alive, _ = engine.life_rules(self.edited_rules[0], self.edited_rules[1])
+        if 0 in get_alive:
+            return list(itertools.product(range(self.count), repeat=3))
+        reach = -(-self.halo() // self.brick)
+        keys = set()
+        for x, y, z in self.live:
+            for dx, dy, dz in itertools.product(range(-reach, reach + 1), repeat=3):
+                key = (x + dx, y + dy, z + dz)
+                if all(0 <= k < self.count for k in key):
+                    keys.add(key)
+        return sorted(keys)
+
+    # Types and colour indices of a brick with halo cells of its neighbours on every side,
+    # cells outside of the grid are empty
+    def with_halo(self, key, halo):
+        start = [k * self.brick - halo for k in key]
+        return self.region(start, [s + self.brick + 2 * halo for s in start])
+
+    # Steps every brick that can change into the back file, then swaps the files
+    def update(self):
+        red = self.palette_index(engine.RED)
+        decay = None
+        if self.states > 2:
+            decay = [self.palette_index(colour) for colour in engine.decay_colours(self.states)]
+        halo = self.halo()
+        inner = (slice(halo, halo + self.brick),) * 3
+        self.back.clear()
+        self.next_index = {}
+        self.next_live = set()
+        self.stepped = 0
+        candidates = self.candidates()
+        for key in candidates:
+            types, colours = self.with_halo(key, halo)
+            new_types, new_colours = engine.life_step(types, colours, self.edited_rules[0], self.edited_rules[1],
+                                                      self.radius, self.edited_rules[2], red, self.states,
+                                                      self.kernel, decay)
+            new_types, new_colours = new_types[inner], new_colours[inner]
+            # Cells of the last bricks past the far faces of the grid stay empty
+            for axis, k in enumerate(key):
+                beyond = self.size - k * self.brick
+                if beyond < self.brick:
+                    index = [slice(None)] * 3
+                    index[axis] = slice(beyond, None)
+                    new_types[tuple(index)] = 0
+                    new_colours[tuple(index)] = 0
+            self.store(key, new_types, new_colours, self.back)
+            self.stepped += 1
+        # Bricks out of reach of live cells keep their colours as they are
+        stepped = set(candidates)
+        for key in self.index:
+            if key not in stepped:
+                self.store(key, *self.brick_arrays(key), self.back)
+        self.front, self.back = self.back, self.front
+        self.index, self.live = self.next_index, self.next_live
+        self.cache.clear()
+        self.generation += 1
+
+
+# Fills a cube of soup side cells at the centre of the grid with live cells at random, a brick thick slab at
+# a time so the soup never has to fit in memory whole
+def soup(bricks, side, fill, seed=None, colour=0xff0000):
+    rng = np.random.default_rng(seed)
+    side = min(side, bricks.size)
+    start = (bricks.size - side) // 2
+    index = bricks.palette_index(colour)
+    for x in range(start, start + side, bricks.brick):
+        shape = (min(bricks.brick, start + side - x), side, side)
+        types = (rng.random(shape) < fill).astype(np.uint8)
+        bricks.set_region((x, start, start), types, types * np.uint8(index))
+
+
+# Steps a life grid too large for memory as bricks and saves it to MongoDB, the way /save saves a grid in
+# memory. It starts from a random soup, or from the brick grid saved under the same name with --resume
+def main(argv=None, store=None, log=print):
+    parser = argparse.ArgumentParser(description='Steps a life grid larger than memory as bricks and saves it '
+                                                 'to MongoDB brick by brick.')
+    parser.add_argument('name', help='Name the grid is saved under, /load opens it up to 256³ cells')
+    parser.add_argument('--size', type=int, default=512, help='Cells a side of the grid')
+    parser.add_argument('--brick', type=int, default=BRICK, help='Cells a side of the bricks')
+    parser.add_argument('--rules', default='4/4/M', help='Life rules, as given to /edit-rules')
+    parser.add_argument('--soup', type=int, default=64, help='Cells a side of the random soup at the centre')
+    parser.add_argument('--fill', type=float, default=0.3, help='Share of live cells in the soup')
+    parser.add_argument('--seed', type=int, help='Seed of the soup')
+    parser.add_argument('--generations', type=int, default=0, help='Generations stepped before saving')
+    parser.add_argument('--resume', action='store_true', help='Carry on from the brick grid saved as name')
+    parser.add_argument('--cache-mb', type=int, default=CACHE_BYTES // (1024 * 1024), help='Brick cache size')
+    parser.add_argument('--mongo', default=os.environ.get('MONGO_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--collection', default='grids', help='Collection of the saved grids')
+    args = parser.parse_args(argv)
+
+    if store is None:
+        import gridfs
+        from pymongo import MongoClient
+        from storage import GridStore
+        db = MongoClient(args.mongo)['cellular_automaton']
+        store = GridStore(db[args.collection], gridfs.GridFS(db))
+    cache_bytes = args.cache_mb * 1024 * 1024
+
+    if args.resume:
+        bricks = store.load(args.name, brick_cache=cache_bytes)
+        if not isinstance(bricks, BrickGrid):
+            log(f"No grid saved as bricks under the name {args.name}")
+            return 1
+    else:
+        try:
+            rules, radius, states = engine.parse_rules(args.rules)
+        except ValueError as e:
+            log(f"Bad rules {args.rules}: {e}")
+            return 2
+        if rules[2] == 'K':
+            log("Kernels are not taken on the command line, use M or N")
+            return 2
+        bricks = BrickGrid(args.size, {0: 0, 1: 0xff0000}, args.brick, cache_bytes)
+        bricks.edited_rules, bricks.radius, bricks.states = rules, radius, states
+        soup(bricks, args.soup, args.fill, args.seed)
+
+    with bricks:
+        for _ in range(args.generations):
+            bricks.update()
+            log(f"generation {bricks.generation}: {bricks.stepped} bricks stepped, {bricks.stored()} stored")
+        store.save_bricks(args.name, bricks)
+        log(f"Saved {args.name}: {bricks.size}³ cells in {bricks.stored()} bricks, generation {bricks.generation}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -79,10 +79,21 @@ class TestCell(unittest.TestCase):
         result = self.cell.location(self.neighbours, [-1, 0, 0])
         self.assertEqual(result, (1, 0))  # Neighbour at [-1, 0, 0] should be cell_type 1 and height 0
 
+    # Test update picks the rule from predefined_update
+    def test_update_dispatch(self):
+        self.cell.update(self.neighbours, [], [3])
+        self.assertEqual(self.cell.cell_type, 1)  # Gets alive with 3 live neighbours
+        tree = Cell(cell_type=0, position=[0, 1, 0], predefined_update=1)
+        tree.update([Cell(cell_type=3, position=[-1, 1, 0])])
+        self.assertEqual(tree.cell_type, 2)  # Wood grows next to the first left wood
+
 
 
 
 class Cell:
+    # No per cell __dict__, a grid can hold a lot of cells
+    __slots__ = ('cell_type', 'colour', 'position', 'predefined_update', 'height')
+
     def __init__(self, cell_type, position, colour=0, predefined_update=0):
         self.cell_type = cell_type
         self.colour = colour #colour when alive, if dead it is not rendered
@@ -92,11 +103,14 @@ class Cell:
         # To limit the tree height (just to make sure)
         self.height = 0
 
-        # Chooses which update function to use based on the file loaded
+    # Chooses which update function to use based on the file loaded
+    def update(self, neighbours, stay_alive=[], get_alive=[]):
         if self.predefined_update == 0:
-            self.update = self.update_edited_rules
+            self.update_edited_rules(neighbours, stay_alive, get_alive)
         elif self.predefined_update == 1:
-            self.update = self.tree1_update
+            self.tree1_update(neighbours, stay_alive, get_alive)
+        else:
+            raise AttributeError(f"No update for predefined_update {self.predefined_update}")
 
     # Used to colour and cell type information for the scene
     def celldict(self):
@@ -140,9 +154,11 @@ class Cell:
                 return cell.cell_type, cell.height
         return 0, 0
 
-    def tree1_update(self, neighbours, stay_alive=[], get_alive=[]):
+    # rand can be given to replay the random draws of the vectorised tree update
+    def tree1_update(self, neighbours, stay_alive=[], get_alive=[], rand=None):
         brown = 0xdc7633
         green = 0x2ecc71
+        rand = rand or random.random
 
         if self.cell_type != 0: return
 
@@ -171,11 +187,11 @@ class Cell:
         # Trunk
         if cell_under == 2:
             # It stops
-            if (height > 6 or random.random() > .8) and not height < 3:
+            if (height > 6 or rand() > .8) and not height < 3:
                 self.cell_type = 4
                 self.colour = brown
             # It goes to the left
-            elif random.random() < .2:
+            elif rand() < .2:
                 self.cell_type = 3
                 self.colour = brown
                 self.height = height
@@ -195,7 +211,7 @@ class Cell:
         # Leaf on x 
         elif cell_xneg in [4, 5, 8] or cell_xpos in [4, 5, 8]:
             # It stops on 6 coninues on 5
-            if random.random() < .3 or heightbx > 2:
+            if rand() < .3 or heightbx > 2:
                 self.cell_type = 6
                 self.colour = green
             else:
@@ -204,7 +220,7 @@ class Cell:
                 self.height = heightbx + 1
         # Leaf down on x
         elif cell_xbdownpos in [9, 6] or cell_xbdownneg in [9, 6]:
-            if random.random() > .91:
+            if rand() > .91:
                 self.cell_type = 6
                 self.colour = green
             else:
@@ -215,7 +231,7 @@ class Cell:
         # Leaf on z
         elif cell_zneg in [4, 8, 5] or cell_zpos in [4, 8, 5]:
             # It stops on 9 coninues on 8
-            if random.random() < .3 or heightbz > 2:
+            if rand() < .3 or heightbz > 2:
                 self.cell_type = 9
                 self.colour = green
             else:
@@ -224,7 +240,7 @@ class Cell:
                 self.height = heightbz + 1
         # Leaf down on z (this is where gravity is simulated using probabilities)
         elif cell_zbdownpos in [9, 6] or cell_zbdownneg in [9, 6]:
-            if random.random() > .91:
+            if rand() > .91:
                 self.cell_type = 9
                 self.colour = green
             else:
@@ -238,7 +254,7 @@ class Cell:
 
         # Top of tree
         elif cell_xneg == 11 or cell_xpos == 11 or cell_zneg == 11 or cell_zpos == 11 and cell_under != 0:
-            if random.random() > .8:
+            if rand() > .8:
                 self.cell_type = 11
                 self.colour = green
             else:
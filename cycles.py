@@ -0,0 +1,233 @@
+import numpy as np
+import unittest
+from collections import deque
+
+
+class TestCycles(unittest.TestCase):
+
+    def grid(self, state, rules):
+        from grid import Grid
+        grid = Grid(len(state), state, {0: 0, 1: 0xff0000})
+        grid.edited_rules = rules
+        return grid
+
+    # Random block of cells in the middle of a larger grid, it does not change enough to be busy
+    def block_grid(self, seed):
+        rng = np.random.default_rng(seed)
+        state = np.zeros((20, 20, 20), dtype=int)
+        state[8:12, 8:12, 8:12] = rng.random((4, 4, 4)) < 0.5
+        return self.grid(state.tolist(), [[2, 3], [3], 'M'])
+
+    # Test the hash kept from the changed cells is the hash of the whole grid
+    def test_incremental_hash(self):
+        grid = self.block_grid(2)
+        grid.update()
+        for _ in range(6):
+            grid.update()
+            self.assertEqual(grid.cycles.hash, grid_hash(packed(grid)))
+
+    # Test a grid that dies out is found to be still and its next generations are served without stepping
+    def test_still(self):
+        size = 6
+        state = [[[1 if (x + y + z) % 2 == 0 else 0 for z in range(size)] for y in range(size)] for x in range(size)]
+        grid = self.grid(state, [[3], [3], 'M'])
+        for _ in range(6):
+            grid.update()
+        self.assertEqual(grid.cycles.period, 1)
+        grid.update()
+        self.assertEqual(grid.active_count, 0)
+        self.assertEqual(len(grid.changed), 0)
+
+    # Small oscillators, as a grid and its rules, with their period
+    def oscillators(self):
+        plus = np.zeros((11, 11, 11), dtype=int)
+        plus[5, 5, 4:7] = plus[5, 4:7, 5] = 1
+        square = np.zeros((11, 11, 11), dtype=int)
+        square[5, 5:7, 5:7] = 1
+        return [(self.grid(plus.tolist(), [[2, 3], [2], 'N']), 2),
+                (self.grid(square.tolist(), [[3], [4], 'M']), 6)]
+
+    # Test cycles are found and the served generations are the ones stepping would give
+    def test_period(self):
+        for grid, period in self.oscillators():
+            stepped = grid.copy()
+            stepped.detect_cycles = False
+            for _ in range(30):
+                grid.update()
+                stepped.update()
+                self.assertTrue(np.array_equal(grid.state, stepped.state))
+                self.assertTrue(np.array_equal(grid.colour_state, stepped.colour_state))
+            self.assertEqual(grid.cycles.period, period)
+            self.assertEqual(grid.active_count, 0)
+
+    # Test changing the rules ends a cycle
+    def test_rules_change(self):
+        grid, period = self.oscillators()[0]
+        for _ in range(12):
+            grid.update()
+        self.assertEqual(grid.cycles.period, period)
+        grid.edited_rules = [[1, 2], [1], 'N']
+        grid.update()
+        self.assertIsNone(grid.cycles.period)
+        self.assertGreater(grid.active_count, 0)
+
+    # Test busy generations are not hashed and the hash is taken again once the grid calms down
+    def test_busy(self):
+        rng = np.random.default_rng(4)
+        grid = self.grid((rng.random((10, 10, 10)) < 0.3).astype(int).tolist(), [[2, 3], [3], 'M'])
+        grid.update()
+        grid.update()
+        self.assertIsNone(grid.cycles.values)
+        grid.edited_rules = [[], [], 'M']
+        grid.update()
+        grid.edited_rules = [[0], [7], 'M']
+        for _ in range(3):
+            grid.update()
+        self.assertEqual(grid.cycles.hash, grid_hash(packed(grid)))
+        self.assertEqual(grid.cycles.period, 1)
+
+    # Test a hash that matches without the cells matching is not taken for a cycle
+    def test_collision(self):
+        grid = self.block_grid(3)
+        for _ in range(4):
+            grid.update()
+        detector = grid.cycles
+        self.assertFalse(detector.repeats(1))
+        self.assertFalse(detector.repeats(2))
+
+
+# Longest cycle looked for, the changes of this many generations are kept to serve it
+MAX_PERIOD = 16
+# Generations changing more than this fraction of the cells are not hashed, replaying that many changes
+# saves little over stepping the grid
+BUSY_LIMIT = 0.1
+
+# splitmix64 constants
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def mix(x):
+    x = x + GOLDEN
+    x = (x ^ (x >> np.uint64(30))) * MIX1
+    x = (x ^ (x >> np.uint64(27))) * MIX2
+    return x ^ (x >> np.uint64(31))
+
+
+# Zobrist keys for cells holding values, hashed from the flat index and the value instead of
+# drawn into a table, so they take no memory
+def cell_hashes(indices, values):
+    return mix(mix(np.asarray(indices, dtype=np.uint64)) ^ np.asarray(values, dtype=np.uint64))
+
+
+# Keys of cells going from old to new values XORed together, the index is only hashed once
+def change_hash(indices, old, new):
+    keys = mix(np.asarray(indices, dtype=np.uint64))
+    return int(np.bitwise_xor.reduce(mix(keys ^ old.astype(np.uint64)) ^ mix(keys ^ new.astype(np.uint64)),
+                                     initial=0))
+
+
+# Type, colour index and height of every cell (or of the cells at the flat indices) in one value
+def packed(grid, indices=None):
+    arrays = [grid.state.ravel(), grid.colour_index.ravel(), grid.heights.ravel()]
+    if indices is not None:
+        arrays = [array[indices] for array in arrays]
+    return arrays[0].astype(np.uint32) | arrays[1].astype(np.uint32) << 8 | arrays[2].astype(np.uint32) << 16
+
+
+def grid_hash(values):
+    return int(np.bitwise_xor.reduce(cell_hashes(np.arange(len(values)), values), initial=0))
+
+
+# Keeps a hash of a life grid up to date from the cells each step changed and looks for it among the last
+# generations. Once the grid repeats, the next generations are the changes recorded since, replayed in turn
+class CycleDetector:
+    def __init__(self, grid):
+        self.reset(grid)
+
+    def reset(self, grid):
+        self.values = packed(grid)
+        self.hash = grid_hash(self.values)
+        self.generation = grid.generation
+        self.rules = step_rules(grid)
+        # Hashes of the last generations, oldest first, and the changes that led to each of them
+        self.recent = deque([self.hash], maxlen=MAX_PERIOD)
+        self.deltas = deque(maxlen=MAX_PERIOD)
+        # Length of the cycle the grid is in, 1 for a grid that stopped changing, None if it is not in one
+        self.period = None
+
+    # Updates the hash after the grid stepped or was restored, then looks for the same hash in the last generations
+    def record(self, grid):
+        # Life cells only change colour when they are born, so the cells whose type changed are the only ones
+        # that can differ. Without them, only the cells the step recomputed can
+        if grid.changed is not None:
+            indices = grid.changed
+        elif grid.active is not None:
+            indices = grid.active
+        else:
+            indices = np.arange(grid.state.size)
+
+        if len(indices) > BUSY_LIMIT * grid.state.size:
+            # The hash is taken again from the whole grid once it calms down
+            self.values = None
+            self.period = None
+            return
+        if (self.values is None or grid.generation != self.generation + 1 or step_rules(grid) != self.rules
+                or len(self.values) != grid.state.size):
+            self.reset(grid)
+            return
+
+        new = packed(grid, indices)
+        old = self.values[indices]
+        differs = old != new
+        indices, old, new = indices[differs], old[differs], new[differs]
+        self.values[indices] = new
+        self.hash ^= change_hash(indices, old, new)
+        self.deltas.append((indices, old, new))
+        self.generation = grid.generation
+
+        self.period = None
+        for period, previous in enumerate(reversed(self.recent), 1):
+            if previous == self.hash and self.repeats(period):
+                self.period = period
+                break
+        self.recent.append(self.hash)
+
+    # Checks the cells changed in the last period generations are back to where they were, in case of a hash collision
+    def repeats(self, period):
+        deltas = list(self.deltas)[-period:]
+        indices = np.concatenate([delta[0] for delta in deltas])
+        if len(indices) == 0:
+            return True
+        old = np.concatenate([delta[1] for delta in deltas])
+        indices, first = np.unique(indices, return_index=True)
+        return bool(np.array_equal(self.values[indices], old[first]))
+
+    def memory_usage(self):
+        values = self.values.nbytes if self.values is not None else 0
+        return values + sum(sum(array.nbytes for array in delta) for delta in self.deltas)
+
+    # True when the next generation of the grid can be replayed instead of stepped
+    def cycling(self, grid):
+        return self.period is not None and step_rules(grid) == self.rules and grid.generation == self.generation
+
+    # Steps the grid by applying the changes of the generation one period back
+    def replay(self, grid):
+        indices, old, new = self.deltas[-self.period]
+        grid.state.flat[indices] = new & 0xff
+        grid.colour_index.flat[indices] = (new >> 8) & 0xff
+        grid.heights.flat[indices] = new >> 16
+        grid.changed = indices[(old & 0xff) != (new & 0xff)].astype(np.int64)
+        grid.active = indices
+        grid.active_count = 0
+
+
+# Rules a grid steps with, the cycle only holds while they stay the same
+def step_rules(grid):
+    return (grid.predefined_update, list(grid.edited_rules[0]), list(grid.edited_rules[1]), grid.edited_rules[2],
+            grid.radius, grid.states, grid.kernel)
+
+
+if __name__ == '__main__':
+    unittest.main()
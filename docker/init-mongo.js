@@ -1,43 +1,43 @@
 // Switch to the cellular_automaton database
 db = db.getSiblingDB('cellular_automaton');
 
-// Create the grids collection if it doesn't exist
+// Create the grids collection if it doesn't exist, with the index on the names the app lists and loads by
 db.createCollection('grids');
+db.grids.createIndex({ name: 1 }, { unique: true });
 
 // Load the trees.json file and insert it into the database
 var treesData = cat('/docker-entrypoint-initdb.d/trees.json');
 var trees = JSON.parse(treesData);
 
-// Insert each tree configuration from the array
-trees.forEach(function(tree) {
-    // Converts everything to integers
+// One upsert by name for each tree configuration, all written in a single bulk write.
+// The cells are left as they are parsed, the app reads them as integers whatever their number type
+var upserts = trees.map(function(tree) {
     tree.size = NumberInt(tree.size);
     tree.predefined_update = NumberInt(tree.predefined_update);
-    
-    if (tree.cells) {
-        for (var x = 0; x < tree.cells.length; x++) {
-            for (var y = 0; y < tree.cells[x].length; y++) {
-                for (var z = 0; z < tree.cells[x][y].length; z++) {
-                    tree.cells[x][y][z] = NumberInt(tree.cells[x][y][z]);
+    tree.rule_type = tree.predefined_update == 1 ? 'tree' : tree.predefined_update == 0 ? 'life' : 'cells';
+
+    // Population by cell type, listed by the app without reading the cells
+    var population = {};
+    (tree.cells || []).forEach(function(plane) {
+        plane.forEach(function(row) {
+            row.forEach(function(cellType) {
+                if (cellType != 0) {
+                    population[cellType] = (population[cellType] || 0) + 1;
                 }
-            }
-        }
-    }
-    
-    // Check if a document with this name already exists
-    var existing = db.grids.findOne({ name: tree.name });
-    
-    if (!existing) {
-        db.grids.insert(tree);
-        print('Inserted tree configuration: ' + tree.name);
-    } else {
-        // Update existing document
-        db.grids.replaceOne(
-            { name: tree.name },
-            tree
-        );
-        print('Updated tree configuration: ' + tree.name);
-    }
+            });
+        });
+    });
+    Object.keys(population).forEach(function(cellType) {
+        population[cellType] = NumberInt(population[cellType]);
+    });
+    tree.population = population;
+
+    return { replaceOne: { filter: { name: tree.name }, replacement: tree, upsert: true } };
 });
 
-print('MongoDB initialisation completed.');
\ No newline at end of file
+if (upserts.length > 0) {
+    var result = db.grids.bulkWrite(upserts, { ordered: false });
+    print('Inserted ' + result.upsertedCount + ' and updated ' + result.modifiedCount + ' tree configurations.');
+}
+
+print('MongoDB initialisation completed.');
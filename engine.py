@@ -0,0 +1,659 @@
+import functools
+import itertools
+import json
+import numpy as np
+import random
+import unittest
+
+
+class TestEngine(unittest.TestCase):
+
+    # Builds a random legacy Grid so both update paths can be compared
+    def random_grid(self, size, seed):
+        from grid import Grid
+        rng = random.Random(seed)
+        state = [[[1 if rng.random() < 0.4 else 0 for _ in range(size)] for _ in range(size)] for _ in range(size)]
+        return Grid(size, state, {0: 0, 1: 0x00ff00})
+
+    # Test neighbour offsets match the sizes given by Grid.get_neighbours
+    def test_neighbour_offsets(self):
+        self.assertEqual(len(neighbour_offsets(1, 'M')), 26)
+        self.assertEqual(len(neighbour_offsets(1, 'N')), 6)
+        self.assertEqual(len(neighbour_offsets(2, 'M')), 124)
+        self.assertEqual(len(neighbour_offsets(2, 'N')), 24)
+        self.assertEqual(neighbour_offsets(1, 'X'), [])
+
+    # Test neighbour counting treats cells outside the grid as empty
+    def test_count_neighbours_edges(self):
+        live = np.ones((3, 3, 3), dtype=bool)
+        counts = count_neighbours(live, 1, 'M')
+        self.assertEqual(counts[0, 0, 0], 7)
+        self.assertEqual(counts[1, 1, 1], 26)
+        counts = count_neighbours(live, 1, 'N')
+        self.assertEqual(counts[0, 0, 0], 3)
+        self.assertEqual(counts[1, 1, 1], 6)
+
+    # Test neighbour counting against Grid.get_neighbours for larger radii
+    def test_count_neighbours_matches_get_neighbours(self):
+        grid = self.random_grid(6, 1)
+        live = grid.state == 1
+        for neighbourhood_type in ['M', 'N']:
+            for radius in [1, 2, 3]:
+                counts = count_neighbours(live, radius, neighbourhood_type)
+                for x, y, z in [(0, 0, 0), (2, 3, 1), (5, 5, 5), (3, 0, 4)]:
+                    neighbours = grid.get_neighbours(x, y, z, radius, neighbourhood_type)
+                    expected = sum(1 for n in neighbours if n.cell_type == 1)
+                    self.assertEqual(counts[x, y, z], expected)
+
+    # Test the vectorised step gives the same grid as the per cell update
+    def test_life_step_matches_cells(self):
+        rules = [[[], [], 'M'], [[2, 3], [3], 'M'], [[4, 5], [5], 'M'],
+                 [[1, 2], [1, 3], 'N'], [[], [2], 'N'], [[3], [], 'M']]
+        for seed, edited_rules in enumerate(rules):
+            grid = self.random_grid(7, seed)
+            expected = self.random_grid(7, seed)
+            grid.edited_rules = edited_rules
+            expected.edited_rules = edited_rules
+            for _ in range(3):
+                grid.update()
+                expected.update_cells()
+                self.assertEqual([[[c.cell_type for c in z] for z in y] for y in grid.cells],
+                                 [[[c.cell_type for c in z] for z in y] for y in expected.cells])
+                self.assertEqual([[[c.colour for c in z] for z in y] for y in grid.cells],
+                                 [[[c.colour for c in z] for z in y] for y in expected.cells])
+
+    # Test cell types other than dead and alive are left untouched
+    def test_life_step_keeps_other_types(self):
+        types = np.zeros((3, 3, 3), dtype=np.uint8)
+        types[1, 1, 1] = 2
+        types[0, 1, 1] = types[2, 1, 1] = types[1, 0, 1] = 1
+        colours = np.zeros(types.shape, dtype=np.uint32)
+        new_types, _ = life_step(types, colours, [], [])
+        self.assertEqual(new_types[1, 1, 1], 2)
+
+    # Test a kernel of ones counts the same as the Moore neighbourhood, and weights scale the counts
+    def test_kernel_counts(self):
+        live = self.random_grid(6, 2).state == 1
+        kernel = np.ones((5, 5, 5), dtype=np.int32)
+        kernel[2, 2, 2] = 0
+        self.assertTrue(np.array_equal(kernel_sums(live, kernel), count_neighbours(live, 2, 'M')))
+        self.assertTrue(np.array_equal(kernel_sums(live, 3 * kernel), 3 * count_neighbours(live, 2, 'M')))
+        self.assertEqual(count_range(kernel=-kernel), (-124, 0))
+        with self.assertRaises(ValueError):
+            kernel_sums(live, np.ones((2, 2, 2)))
+
+    # Test the sparse step visits every cell a large neighbourhood reaches and matches the full step
+    def test_life_step_at_large_radius(self):
+        for neighbourhood_type in ['M', 'N']:
+            types = (self.random_grid(9, 3).state == 1).astype(np.uint8)
+            colours = np.zeros(types.shape, dtype=np.uint8)
+            changed = np.flatnonzero(types)
+            for _ in range(3):
+                expected, _ = life_step(types, colours, [5, 6, 7], [6, 7], 2, neighbourhood_type, 1, states=4)
+                active = active_cells(changed, types.shape, 2, neighbourhood_type)
+                changed = life_step_at(types, colours, active, [5, 6, 7], [6, 7], 2, neighbourhood_type, 1, states=4)
+                self.assertTrue(np.array_equal(types, expected))
+
+    # Test live cells of a Generations rule decay through the extra states, take their colours and do not count
+    def test_generations_decay(self):
+        types = np.zeros((3, 3, 3), dtype=np.uint8)
+        types[1, 1, 1] = 1
+        colours = np.zeros(types.shape, dtype=np.uint8)
+        decay = [7, 8]
+        for expected in [2, 3, 0, 0]:
+            types, colours = life_step(types, colours, [1], [9], red=9, states=4, decay=decay)
+            self.assertEqual(types[1, 1, 1], expected)
+            self.assertEqual(np.count_nonzero(types == 1), 0)
+            if expected:
+                self.assertEqual(colours[1, 1, 1], decay[expected - 2])
+        next_types, births = life_table((1,), (1,), 4)
+        self.assertEqual(list(next_types[:5, 1]), [1, 1, 3, 0, 4])
+        self.assertEqual(list(next_types[:2, 0]), [0, 2])
+        self.assertFalse(next_types.flags.writeable)
+
+    # Test rules are read with ranges, states, radii and kernels, and bad ones are refused
+    def test_parse_rules(self):
+        self.assertEqual(parse_rules('2,3/3/M'), ([[2, 3], [3], 'M'], 1, 2))
+        self.assertEqual(parse_rules('4/4/5/M2'), ([[4], [4], 'M'], 2, 5))
+        self.assertEqual(parse_rules('5-7, 9/6-7/n3'), ([[5, 6, 7, 9], [6, 7], 'N'], 3, 2))
+        self.assertEqual(parse_rules('//K'), ([[], [], 'K'], 1, 2))
+        for text in ['2/3', '2/3/X', '2/3/M0', 'a/3/M', '2/3/1/M', f'2/3/{MAX_STATES + 1}/M']:
+            with self.assertRaises(ValueError):
+                parse_rules(text)
+
+    # Builds a grid with random tree cells and heights to reach every tree transition
+    def random_tree_grid(self, size, seed):
+        from grid import Grid
+        rng = random.Random(seed)
+        types = [0, 0, 0, 0, 0, 0, 2, 3, 4, 5, 6, 8, 9, 11, 1]
+        state = [[[rng.choice(types) for _ in range(size)] for _ in range(size)] for _ in range(size)]
+        grid = Grid(size, state, {t: 0x123456 for t in range(13)}, 1, seed=seed)
+        grid.heights = np.array([[[rng.randint(0, 8) for _ in range(size)] for _ in range(size)] for _ in range(size)],
+                                dtype=np.uint8)
+        return grid
+
+    # Random generator that keeps the last draws it handed out, so the cells can replay them
+    class RecordedRandom:
+        def __init__(self, rng):
+            self.rng = rng
+            self.draws = None
+
+        def random(self, shape):
+            self.draws = self.rng.random(shape)
+            return self.draws
+
+    # Steps a tree grid and, alongside it, its cells with Cell.tree1_update and the same draws, and checks the
+    # types, heights and colours stay equal
+    def assertTreeStepsMatchCells(self, grid, generations):
+        from cell import Cell
+        cells = grid.cell_list()
+        grid.rng = self.RecordedRandom(grid.rng)
+        for _ in range(generations):
+            changed = grid.changed
+            grid.update()
+            draws = grid.rng.draws
+            # Only the active cells drew, the others never grow
+            if draws.ndim == 2:
+                active = active_cells(changed, grid.state.shape, *grid.neighbourhood())
+                full = np.zeros((TREE_DRAWS,) + grid.state.shape)
+                full.reshape(TREE_DRAWS, -1)[:, active] = draws
+                draws = full
+            new_cells = [[[None] * grid.size for _ in range(grid.size)] for _ in range(grid.size)]
+            for x, y, z in itertools.product(range(grid.size), repeat=3):
+                old = cells[x][y][z]
+                cell = Cell(old.cell_type, old.position, old.colour, old.predefined_update)
+                replay = iter(draws[:, x, y, z].tolist())
+                neighbours = grid.get_neighbours(x, y, z, grid.radius, grid.edited_rules[2], cells)
+                cell.tree1_update(neighbours, rand=lambda: next(replay))
+                new_cells[x][y][z] = cell
+            cells = new_cells
+            self.assertTrue(np.array_equal(grid.state, [[[c.cell_type for c in z] for z in y] for y in cells]))
+            self.assertTrue(np.array_equal(grid.heights, [[[c.height for c in z] for z in y] for y in cells]))
+            self.assertTrue(np.array_equal(np.array(grid.palette)[grid.colour_index],
+                                           [[[c.colour for c in z] for z in y] for y in cells]))
+
+    # Test the vectorised tree step gives the same transitions as Cell.tree1_update
+    def test_tree_step_matches_cells(self):
+        for seed in range(6):
+            grid = self.random_tree_grid(6, seed)
+            if seed % 2:
+                grid.edited_rules[2] = 'N'
+            self.assertTreeStepsMatchCells(grid, 3)
+
+    # Test the trees from trees.json grow the same way as the cell rule
+    def test_tree_step_trees_json(self):
+        from grid import Grid
+        with open('trees.json') as f:
+            doc = json.load(f)[0]
+        colours = {int(k): int(v, 16) for k, v in doc['colours'].items()}
+        colours[0] = 0
+        grid = Grid(doc['size'], doc['cells'], colours, 1, seed=3)
+        self.assertTreeStepsMatchCells(grid, 12)
+        self.assertGreater(np.count_nonzero(grid.state >= 5), 0)
+
+    # Test a seed always grows the same tree
+    def test_tree_step_seeded(self):
+        first = self.random_tree_grid(6, 7)
+        second = self.random_tree_grid(6, 7)
+        for _ in range(4):
+            first.update()
+            second.update()
+        self.assertTrue(np.array_equal(first.state, second.state))
+        self.assertTrue(np.array_equal(first.heights, second.heights))
+
+
+DEFAULT_STAY_ALIVE = [2, 3]
+DEFAULT_GET_ALIVE = [3]
+# Most types a Generations rule can decay through, each one takes a colour of the palette
+MAX_STATES = 32
+# Neighbourhoods with more cells than this are counted from running sums rather than gathered cell by cell
+GATHER_LIMIT = 26
+RED = 0xff0000
+BROWN = 0xdc7633
+GREEN = 0x2ecc71
+
+# Number of random draws a tree cell can use in one generation
+TREE_DRAWS = 2
+# Neighbour positions looked at by the tree rule
+TREE_LOOKUPS = [(0, -1, 0), (-1, 0, 0), (1, 0, 0), (-1, 1, 0), (1, 1, 0),
+                (0, 0, -1), (0, 0, 1), (0, 1, -1), (0, 1, 1)]
+
+
+# Returns the (dx, dy, dz) offsets of a neighbourhood, without the cell itself
+def neighbour_offsets(radius=1, neighbourhood_type='M'):
+    offsets = []
+    if neighbourhood_type not in ('M', 'N'):
+        return offsets
+    for i in range(-radius, radius + 1):
+        for j in range(-radius, radius + 1):
+            for k in range(-radius, radius + 1):
+                if (i, j, k) == (0, 0, 0):
+                    continue
+                if neighbourhood_type == 'N' and abs(i) + abs(j) + abs(k) > radius:
+                    continue
+                offsets.append((i, j, k))
+    return offsets
+
+
+# Counts for every cell how many of its neighbours are set in the mask,
+# cells outside of the grid count as empty. Past radius 1 the counts are taken from
+# running sums, so their cost grows with the radius (N) or not at all (M) instead of with radius³
+def count_neighbours(mask, radius=1, neighbourhood_type='M'):
+    if radius > 1 and neighbourhood_type == 'M':
+        return (box_sums(mask, radius) - mask).astype(np.uint16)
+    if radius > 1 and neighbourhood_type == 'N':
+        return diamond_sums(mask, radius).astype(np.uint16)
+    sx, sy, sz = mask.shape
+    padded = np.pad(mask.astype(np.uint16), radius)
+    counts = np.zeros(mask.shape, dtype=np.uint16)
+    for i, j, k in neighbour_offsets(radius, neighbourhood_type):
+        counts += padded[radius + i:radius + i + sx,
+                         radius + j:radius + j + sy,
+                         radius + k:radius + k + sz]
+    return counts
+
+
+# Sums of the values from -radius to +radius along an axis, from a cumulative sum
+def line_sums(values, radius, axis):
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (radius + 1, radius)
+    totals = np.cumsum(np.pad(values, pad), axis=axis, dtype=np.int32)
+    n = values.shape[axis]
+    upper = [slice(None)] * values.ndim
+    lower = [slice(None)] * values.ndim
+    upper[axis] = slice(2 * radius + 1, 2 * radius + 1 + n)
+    lower[axis] = slice(0, n)
+    return totals[tuple(upper)] - totals[tuple(lower)]
+
+
+# Sums over the cube of side 2 * radius + 1 around every cell, the cell included. The cube is separable,
+# so it is three line sums whatever the radius
+def box_sums(values, radius):
+    sums = values.astype(np.int32)
+    for axis in range(3):
+        sums = line_sums(sums, radius, axis)
+    return sums
+
+
+# Sums over the Von Neumann neighbourhood (|dx| + |dy| + |dz| <= radius) of every cell, the cell excluded.
+# Each column of the octahedron along z is a line sum, so it takes (radius + 1)² shifted additions
+def diamond_sums(values, radius):
+    sx, sy, sz = values.shape
+    values = values.astype(np.int32)
+    padded = np.pad(values, ((radius, radius), (radius, radius), (0, 0)))
+    lines = [line_sums(padded, width, 2) for width in range(radius + 1)]
+    sums = np.zeros(values.shape, dtype=np.int32)
+    for i in range(-radius, radius + 1):
+        for j in range(-(radius - abs(i)), radius - abs(i) + 1):
+            sums += lines[radius - abs(i) - abs(j)][radius + i:radius + i + sx, radius + j:radius + j + sy]
+    return sums - values
+
+
+# Weighted counts of the neighbours set in the mask, the kernel is centred on the cell
+def kernel_sums(mask, kernel):
+    kernel = kernel_array(kernel)
+    radius = kernel.shape[0] // 2
+    sx, sy, sz = mask.shape
+    padded = np.pad(mask.astype(np.int32), radius)
+    sums = np.zeros(mask.shape, dtype=np.int32)
+    for (i, j, k), weight in zip(np.argwhere(kernel).tolist(), kernel[kernel != 0].tolist()):
+        sums += weight * padded[i:i + sx, j:j + sy, k:k + sz]
+    return sums
+
+
+# Kernel of neighbour weights as an array with an odd side, its radius is half of it
+def kernel_array(kernel):
+    kernel = np.asarray(kernel, dtype=np.int32)
+    if kernel.ndim != 3 or len(set(kernel.shape)) != 1 or kernel.shape[0] % 2 == 0:
+        raise ValueError("A kernel is a cube of weights with an odd side")
+    return kernel
+
+
+def kernel_radius(kernel):
+    return kernel_array(kernel).shape[0] // 2
+
+
+# Values of an array at position + offset, cells outside of the grid
+# or of the neighbourhood read as empty like Cell.location
+def shifted(values, offset, offsets):
+    result = np.zeros_like(values)
+    if offset not in offsets:
+        return result
+    src = []
+    dst = []
+    for d, n in zip(offset, values.shape):
+        src.append(slice(max(d, 0), n + min(d, 0)))
+        dst.append(slice(max(-d, 0), n + min(-d, 0)))
+    result[tuple(dst)] = values[tuple(src)]
+    return result
+
+
+# Flat indices of the given cells in the grid padded by radius on every side
+# and the flat distance of every neighbour offset in that padded grid
+def padded_indices(indices, shape, radius, offsets):
+    padded_shape = [n + 2 * radius for n in shape]
+    coords = np.unravel_index(indices, shape)
+    centres = np.ravel_multi_index([c + radius for c in coords], padded_shape)
+    steps = [(i * padded_shape[1] + j) * padded_shape[2] + k for i, j, k in offsets]
+    return centres, steps
+
+
+# Cells whose next state can differ from their current one: the changed cells
+# and every cell that has one of them in its neighbourhood. Large neighbourhoods
+# mark the whole cube around the changes from running sums
+def active_cells(changed, shape, radius=1, neighbourhood_type='M'):
+    offsets = neighbour_offsets(radius, neighbourhood_type)
+    if len(offsets) > GATHER_LIMIT:
+        marks = np.zeros(shape, dtype=np.uint8)
+        marks.flat[changed] = 1
+        return np.flatnonzero(box_sums(marks, radius))
+    centres, steps = padded_indices(changed, shape, radius, offsets)
+    marks = np.zeros([n + 2 * radius for n in shape], dtype=bool)
+    flat = marks.ravel()
+    flat[centres] = True
+    for step in steps:
+        flat[centres - step] = True
+    interior = marks[radius:radius + shape[0], radius:radius + shape[1], radius:radius + shape[2]]
+    return np.flatnonzero(interior)
+
+
+# Values of the cells at the given flat indices for every neighbour offset,
+# cells outside of the grid read as empty
+def gathered(values, indices, offsets, radius=1):
+    flat = np.pad(values, radius).ravel()
+    centres, steps = padded_indices(indices, values.shape, radius, offsets)
+    return {offset: flat[centres + step] for offset, step in zip(offsets, steps)}
+
+
+# Same as count_neighbours but only for the cells at the given flat indices. Past GATHER_LIMIT
+# neighbours, counting the whole grid from running sums is cheaper than gathering every neighbour
+def count_neighbours_at(mask, indices, radius=1, neighbourhood_type='M'):
+    if len(neighbour_offsets(radius, neighbourhood_type)) > GATHER_LIMIT:
+        return count_neighbours(mask, radius, neighbourhood_type).ravel()[indices]
+    counts = np.zeros(len(indices), dtype=np.uint16)
+    offsets = neighbour_offsets(radius, neighbourhood_type)
+    for values in gathered(mask.astype(np.uint8), indices, offsets, radius).values():
+        counts += values
+    return counts
+
+
+# Turns empty rules into the Cell.update_default rules
+def life_rules(stay_alive, get_alive):
+    if stay_alive == [] and get_alive == []:
+        return DEFAULT_STAY_ALIVE, DEFAULT_GET_ALIVE, False
+    return stay_alive, get_alive, True
+
+
+# Reads a rule written S/B/N or S/B/C/N: the neighbour counts to stay alive and to get alive as lists
+# and ranges ("2,3", "4-6", or nothing), the number of states of a Generations rule (2 when left out) and the
+# neighbourhood, M (Moore) or N (Von Neumann) followed by its radius (1 when left out), or K for a kernel of
+# weights given next to the rule. Returns [stay_alive, get_alive, neighbourhood_type], radius and states
+def parse_rules(text):
+    parts = [part.strip() for part in text.split('/')]
+    if len(parts) not in (3, 4):
+        raise ValueError("Rules are written S/B/N or S/B/C/N")
+    neighbourhood = parts[-1].upper()
+    if neighbourhood[:1] not in ('M', 'N', 'K'):
+        raise ValueError("The neighbourhood is M (Moore), N (Von Neumann) or K (kernel)")
+    neighbourhood_type = neighbourhood[0]
+    radius = parse_count(neighbourhood[1:] or '1', 'radius')
+    states = parse_count(parts[2], 'number of states') if len(parts) == 4 else 2
+    if radius < 1 or not 2 <= states <= MAX_STATES:
+        raise ValueError(f"The radius is at least 1 and a rule has 2 to {MAX_STATES} states")
+    return [parse_counts(parts[0]), parse_counts(parts[1]), neighbourhood_type], radius, states
+
+
+def parse_count(text, name):
+    try:
+        return int(text)
+    except ValueError:
+        raise ValueError(f"Invalid {name}: {text!r}") from None
+
+
+# Neighbour counts in a list of counts and ranges, sorted and without repeats
+def parse_counts(text):
+    counts = set()
+    for part in filter(None, (part.strip() for part in text.split(','))):
+        low, _, high = part.partition('-')
+        low = parse_count(low, 'neighbour count')
+        high = parse_count(high, 'neighbour count') if high else low
+        counts.update(range(low, high + 1))
+    return sorted(counts)
+
+
+# Transition table of a life-like rule, compiled once per rule: the next type of a cell and whether it is born,
+# indexed by its type and its neighbour count minus the lowest count. With more than 2 states (a Generations
+# rule) live cells that do not stay alive decay through the types 2 to states - 1 before they die, and only
+# type 1 counts as a neighbour. Types from states up are left as they are
+@functools.lru_cache(maxsize=64)
+def life_table(stay_alive, get_alive, states=2, min_count=0, max_count=26):
+    counts = np.arange(min_count, max_count + 1)
+    stay = np.isin(counts, stay_alive)
+    born = np.isin(counts, get_alive)
+    next_types = np.repeat(np.arange(256, dtype=np.uint8)[:, None], len(counts), axis=1)
+    next_types[0] = np.where(born, 1, 0)
+    next_types[1] = np.where(stay, 1, 2 if states > 2 else 0)
+    for state in range(2, states):
+        next_types[state] = (state + 1) % states
+    births = np.zeros(next_types.shape, dtype=bool)
+    births[0] = born
+    next_types.flags.writeable = False
+    births.flags.writeable = False
+    return next_types, births
+
+
+# Lowest and highest neighbour count of a neighbourhood or a kernel
+def count_range(radius=1, neighbourhood_type='M', kernel=None):
+    if kernel is None:
+        return 0, len(neighbour_offsets(radius, neighbourhood_type))
+    kernel = kernel_array(kernel)
+    return int(kernel[kernel < 0].sum()), int(kernel[kernel > 0].sum())
+
+
+# Table of a rule as given to the grid, the default rules when both lists are empty
+def compiled_rule(stay_alive, get_alive, radius=1, neighbourhood_type='M', states=2, kernel=None):
+    stay_alive, get_alive, recolour = life_rules(stay_alive, get_alive)
+    min_count, max_count = count_range(radius, neighbourhood_type, kernel)
+    next_types, births = life_table(tuple(stay_alive), tuple(get_alive), states, min_count, max_count)
+    return next_types, births, min_count, recolour
+
+
+# Colours of the decaying types 2 to states - 1 of a Generations rule, fading from red
+def decay_colours(states):
+    colours = []
+    for state in range(2, states):
+        fade = int(0xe0 * (state - 1) / (states - 1))
+        colours.append(RED | fade << 8 | fade)
+    return colours
+
+
+# Life transitions for cells of any shape given their neighbour counts, looked up in the compiled table.
+# New cells are only recoloured for edited rules like in Cell.update_edited_rules, decaying cells take
+# the colour of their type when decay colours are given.
+# The colours can be RGB values or palette indices as long as red is given the same way
+def life_rule(types, colours, counts, table, red=RED, decay=None):
+    next_types, births, min_count, recolour = table
+    at = (types, counts.astype(np.intp) - min_count)
+    new_types = next_types[at]
+
+    new_colours = colours
+    if recolour:
+        new_colours = colours.copy()
+        new_colours[births[at]] = red
+    if decay:
+        if new_colours is colours:
+            new_colours = colours.copy()
+        decaying = new_types >= 2
+        lookup = np.zeros(256, dtype=colours.dtype)
+        lookup[2:2 + len(decay)] = decay
+        decaying &= new_types < 2 + len(decay)
+        new_colours[decaying] = lookup[new_types[decaying]]
+    return new_types, new_colours
+
+
+# Neighbour counts of a life rule, weighted by the kernel when there is one
+def life_counts(types, radius=1, neighbourhood_type='M', kernel=None):
+    if kernel is not None:
+        return kernel_sums(types == 1, kernel)
+    return count_neighbours(types == 1, radius, neighbourhood_type)
+
+
+# Advances a life-like grid by one generation, same rules as Cell.update_edited_rules
+def life_step(types, colours, stay_alive=[], get_alive=[], radius=1, neighbourhood_type='M', red=RED,
+              states=2, kernel=None, decay=None):
+    table = compiled_rule(stay_alive, get_alive, radius, neighbourhood_type, states, kernel)
+    counts = life_counts(types, radius, neighbourhood_type, kernel)
+    return life_rule(types, colours, counts, table, red, decay)
+
+
+# Advances only the cells at the given flat indices, the arrays are changed in place.
+# Returns the flat indices of the cells that changed
+def life_step_at(types, colours, indices, stay_alive=[], get_alive=[], radius=1, neighbourhood_type='M',
+                 red=RED, states=2, kernel=None, decay=None):
+    table = compiled_rule(stay_alive, get_alive, radius, neighbourhood_type, states, kernel)
+    if kernel is not None:
+        counts = kernel_sums(types == 1, kernel).ravel()[indices]
+    else:
+        counts = count_neighbours_at(types == 1, indices, radius, neighbourhood_type)
+    old_types = types.flat[indices]
+    old_colours = colours.flat[indices]
+    new_types, new_colours = life_rule(old_types, old_colours, counts, table, red, decay)
+    types.flat[indices] = new_types
+    colours.flat[indices] = new_colours
+    return indices[new_types != old_types]
+
+
+# Tree transitions for cells of any shape, same as Cell.tree1_update.
+# at(offset) gives the types and heights of the neighbour at offset and live
+# counts the leaf neighbours. u1 is used where the cell rule calls random the
+# first time and u2 the second time. brown and green are given like the colours
+def tree_rule(types, colours, at, live, u1, u2, brown=BROWN, green=GREEN):
+    def is_in(values, targets):
+        return np.isin(values, targets)
+
+    under, h1 = at((0, -1, 0))
+    xneg, h2x = at((-1, 0, 0))
+    xpos, h3x = at((1, 0, 0))
+    xbdownpos, _ = at((-1, 1, 0))
+    xbdownneg, _ = at((1, 1, 0))
+    zneg, h2z = at((0, 0, -1))
+    zpos, h3z = at((0, 0, 1))
+    zbdownpos, _ = at((0, 1, -1))
+    zbdownneg, _ = at((0, 1, 1))
+    height = np.maximum(h1, np.maximum(h2x, h3x))
+    heightbx = np.maximum(h2x, h3x)
+    heightbz = np.maximum(h2z, h3z)
+
+    new_types = types.copy()
+    new_colours = colours.copy()
+    new_heights = np.zeros(types.shape, dtype=np.int16)
+
+    # Only empty cells grow, each one takes the first transition that matches
+    remaining = types == 0
+
+    def take(condition):
+        nonlocal remaining
+        chosen = remaining & condition
+        remaining = remaining & ~condition
+        return chosen
+
+    def grow(mask, cell_type, colour=None, height=None):
+        new_types[mask] = cell_type
+        if colour is not None:
+            new_colours[mask] = colour
+        if height is not None:
+            new_heights[mask] = height[mask]
+
+    # Trunk
+    trunk = take(under == 2)
+    stop = trunk & (height > 6) | trunk & (u1 > .8) & (height >= 3)
+    left = trunk & ~stop & (u2 < .2)
+    grow(stop, 4, brown)
+    grow(left, 3, brown, height)
+    grow(trunk & ~stop & ~left, 2, brown, height + 1)
+
+    # First left wood
+    grow(take(xneg == 3), 2, brown, height + 1)
+
+    # Leaf on x
+    leaf = take(is_in(xneg, [4, 5, 8]) | is_in(xpos, [4, 5, 8]))
+    leaf_stop = leaf & ((u1 < .3) | (heightbx > 2))
+    grow(leaf_stop, 6, green)
+    grow(leaf & ~leaf_stop, 5, green, heightbx + 1)
+
+    # Leaf down on x
+    leaf = take(is_in(xbdownpos, [9, 6]) | is_in(xbdownneg, [9, 6]))
+    grow(leaf & (u1 > .91), 6, green, heightbx + 1)
+    grow(leaf & (u1 <= .91), 7, green, heightbx + 1)
+
+    # Leaf on z
+    leaf = take(is_in(zneg, [4, 8, 5]) | is_in(zpos, [4, 8, 5]))
+    leaf_stop = leaf & ((u1 < .3) | (heightbz > 2))
+    grow(leaf_stop, 9, green)
+    grow(leaf & ~leaf_stop, 8, green, heightbz + 1)
+
+    # Leaf down on z
+    leaf = take(is_in(zbdownpos, [9, 6]) | is_in(zbdownneg, [9, 6]))
+    grow(leaf & (u1 > .91), 9, green, heightbz + 1)
+    grow(leaf & (u1 <= .91), 10, green, heightbz + 1)
+
+    # Top of tree, the colour is kept like in the cell rule
+    grow(take(under == 4), 11)
+
+    # Top of tree, the last check only applies to zpos like in the cell rule
+    top = take((xneg == 11) | (xpos == 11) | (zneg == 11) | ((zpos == 11) & (under != 0)))
+    grow(top & (u1 > .8), 11, green)
+    grow(top & (u1 <= .8), 12, green)
+
+    # Makes it look like a tree
+    grow(take(live > 5), 12, green)
+
+    return new_types, new_heights, new_colours
+
+
+# Mask of the leaf cells counted by the tree rule
+def leaves(types):
+    return (types >= 5) & (types <= 10)
+
+
+# Advances a tree grid by one generation, same transitions as Cell.tree1_update.
+# draws holds TREE_DRAWS uniform numbers per cell
+def tree_step(types, heights, colours, draws, radius=1, neighbourhood_type='M', brown=BROWN, green=GREEN):
+    offsets = set(neighbour_offsets(radius, neighbourhood_type))
+
+    def at(offset):
+        return shifted(types, offset, offsets), shifted(heights, offset, offsets).astype(np.int16)
+
+    live = count_neighbours(leaves(types), radius, neighbourhood_type)
+    new_types, new_heights, new_colours = tree_rule(types, colours, at, live, draws[0], draws[1], brown, green)
+    return new_types, new_heights.astype(heights.dtype), new_colours
+
+
+# Advances only the tree cells at the given flat indices, the arrays are changed in place.
+# Heights only last one generation so the ones set at the previous step are cleared.
+# draws holds TREE_DRAWS uniform numbers per index. Returns the flat indices of the cells that changed
+def tree_step_at(types, heights, colours, indices, previous, draws, radius=1, neighbourhood_type='M',
+                 brown=BROWN, green=GREEN):
+    lookups = [offset for offset in TREE_LOOKUPS if offset in neighbour_offsets(radius, neighbourhood_type)]
+    near_types = gathered(types, indices, lookups)
+    near_heights = gathered(heights, indices, lookups)
+    empty = np.zeros(len(indices), dtype=np.int16)
+
+    def at(offset):
+        if offset not in near_types:
+            return empty, empty
+        return near_types[offset], near_heights[offset].astype(np.int16)
+
+    live = count_neighbours_at(leaves(types), indices, radius, neighbourhood_type)
+    old_types = types.flat[indices]
+    new_types, new_heights, new_colours = tree_rule(old_types, colours.flat[indices], at, live, draws[0], draws[1],
+                                                    brown, green)
+    heights.flat[previous] = 0
+    types.flat[indices] = new_types
+    colours.flat[indices] = new_colours
+    heights.flat[indices] = new_heights
+    return indices[new_types != old_types]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,13 @@
 from cell import Cell
+from cycles import CycleDetector, step_rules
+import copy
+import engine
+import hashlife
+import json
+import metrics
+import numpy as np
 import os
+import time
 from concurrent.futures import ThreadPoolExecutor,  as_completed
 import unittest
 
@@ -31,36 +39,457 @@ class TestGrid(unittest.TestCase):
         # In a Von Neumann neighborhood with radius 1, there should be fewer neighbours than Moore, typically 6
         self.assertEqual(len(neighbours), 6)
 
+    # Test cells read and write straight into the grid arrays
+    def test_cell_views(self):
+        cell = self.grid.cells[1][2][3]
+        self.assertEqual(cell.position, [1, 2, 3])
+        cell.cell_type = 1
+        cell.colour = 0x00ff00
+        self.assertEqual(self.grid.state[1, 2, 3], 1)
+        self.assertEqual(self.grid.colour_state[1, 2, 3], 0x00ff00)
+        self.assertEqual(self.grid.cells[-3][2][3].celldict(), {'cell_type': 1, 'colour': 0x00ff00})
+        with self.assertRaises(IndexError):
+            self.grid.cells[4]
+
+    # Test the grid only uses a few bytes per cell
+    def test_memory_usage(self):
+        self.assertLessEqual(self.grid.memory_usage(), 3 * self.size ** 3 + 4 * 256)
+
+    # Test a copy steps on its own and a snapshot puts the grid back as it was
+    def test_copy_and_snapshot(self):
+        self.grid.cells[1][1][1].cell_type = 1
+        self.grid.edited_rules = [[], [1], 'N']
+        snapshot = self.grid.snapshot()
+        copied = self.grid.copy()
+        copied.update()
+        self.assertEqual(self.grid.generation, 0)
+        self.assertEqual(self.grid.cells[1][1][2].cell_type, 0)
+        self.assertEqual(copied.cells[1][1][2].cell_type, 1)
+        self.grid.update()
+        self.grid.restore(snapshot)
+        self.assertEqual(self.grid.generation, 0)
+        self.assertEqual(self.grid.cells[1][1][2].cell_type, 0)
+        self.assertEqual(self.grid.cells[1][1][1].cell_type, 1)
+
+    # Test stepping only the active cells gives the same grid as full sweeps
+    def test_active_update_matches_full(self):
+        rng = np.random.default_rng(4)
+        state = (rng.random((12, 12, 12)) < 0.2).astype(int).tolist()
+        for rules in [[[2, 3], [3], 'M'], [[1, 2], [1], 'N'], [[], [], 'M']]:
+            sparse = Grid(12, state, self.colours)
+            full = Grid(12, state, self.colours)
+            sparse.edited_rules = full.edited_rules = rules
+            sparse.active_limit = 1.0
+            full.active_limit = 0
+            counts = []
+            for _ in range(8):
+                sparse.update()
+                full.update()
+                counts.append(sparse.active_count)
+                self.assertTrue(np.array_equal(sparse.state, full.state))
+                self.assertTrue(np.array_equal(sparse.colour_state, full.colour_state))
+            self.assertEqual(counts[0], 12 ** 3)
+            self.assertLess(min(counts), 12 ** 3)
+
+    # Test Generations rules, large radii and kernels step the active cells the same way as full sweeps
+    def test_edit_rules(self):
+        rng = np.random.default_rng(5)
+        state = (rng.random((12, 12, 12)) < 0.2).astype(int).tolist()
+        kernel = np.zeros((5, 5, 5), dtype=int)
+        kernel[2] = 1
+        kernel[2, 2, 2] = 0
+        for rules, radius, states, weights in [([[4], [4], 'M'], 1, 5, None), ([[5, 6, 7], [6, 7], 'N'], 3, 3, None),
+                                              ([[9, 10, 11], [10, 11], 'M'], 2, 2, None),
+                                              ([[2, 3], [3], 'K'], 1, 4, kernel)]:
+            sparse = Grid(12, state, self.colours)
+            full = Grid(12, state, self.colours)
+            for grid in (sparse, full):
+                grid.edit_rules(rules, radius, states, weights)
+            sparse.active_limit = 1.0
+            full.active_limit = 0
+            for _ in range(6):
+                sparse.update()
+                full.update()
+                self.assertTrue(np.array_equal(sparse.state, full.state))
+                self.assertTrue(np.array_equal(sparse.colour_state, full.colour_state))
+            self.assertLess(full.state.max(), states)
+        with self.assertRaises(ValueError):
+            sparse.edit_rules([[2], [3], 'K'])
+        with self.assertRaises(ValueError):
+            sparse.edit_rules([[2], [3], 'M'], kernel=np.ones((2, 2, 2)))
+        self.assertEqual(sparse.edited_rules, [[2, 3], [3], 'K'])
+
+    # Test a grid that stops changing has no active cells
+    def test_active_update_still_grid(self):
+        self.grid.update()
+        self.grid.update()
+        self.assertEqual(self.grid.active_count, 0)
+
+    # Test a grid stepped by the octree, one generation or many at once, matches the arrays stepped
+    def test_octree_update(self):
+        state = np.zeros((24, 24, 24), dtype=int)
+        state[10:14, 10:14, 10:14] = np.random.default_rng(6).random((4, 4, 4)) < 0.5
+        octree = Grid(24, state.tolist(), self.colours)
+        arrays = Grid(24, state.tolist(), self.colours)
+        octree.edited_rules = arrays.edited_rules = [[2, 3, 4], [3], 'M']
+        octree.octree = hashlife.Universe.from_grid(octree)
+        for generations in (1, 1, 6, 1):
+            octree.advance(generations)
+            arrays.advance(generations)
+            self.assertEqual(octree.generation, arrays.generation)
+            self.assertTrue(np.array_equal(octree.state, arrays.state))
+            self.assertTrue(np.array_equal(octree.colour_state, arrays.colour_state))
+        octree.edited_rules = arrays.edited_rules = [[1], [1, 2], 'N']
+        octree.update()
+        arrays.update()
+        self.assertTrue(np.array_equal(octree.state, arrays.state))
+
+    # Test the octree steps on without the arrays, which are only filled once read, and a copy stepped ahead
+    # is restored without reloading the octree
+    def test_octree_lazy_arrays(self):
+        state = np.zeros((24, 24, 24), dtype=int)
+        state[10:14, 10:14, 10:14] = np.random.default_rng(7).random((4, 4, 4)) < 0.5
+        octree = Grid(24, state.tolist(), self.colours)
+        arrays = Grid(24, state.tolist(), self.colours)
+        octree.edited_rules = arrays.edited_rules = [[2, 3, 4], [3], 'M']
+        octree.octree = hashlife.Universe.from_grid(octree)
+        octree.update()
+        octree.octree.load = None
+        for _ in range(2):
+            octree.update()
+        self.assertEqual(octree.octree_ahead, 3)
+        ahead = octree.copy()
+        ahead.update()
+        octree.restore(ahead.snapshot())
+        octree.update()
+        for _ in range(5):
+            arrays.update()
+        self.assertEqual(octree.octree_ahead, 1)
+        self.assertTrue(np.array_equal(octree.changed, arrays.changed))
+        self.assertTrue(np.array_equal(octree.state, arrays.state))
+        self.assertTrue(np.array_equal(octree.colour_state, arrays.colour_state))
+
+    # Test the active tree steps still match Cell.tree1_update
+    def test_active_tree_update(self):
+        with open('trees.json') as f:
+            doc = json.load(f)[0]
+        colours = {int(k): int(v, 16) for k, v in doc['colours'].items()}
+        colours[0] = 0
+        grid = Grid(doc['size'], doc['cells'], colours, 1, seed=5)
+        grid.tree_check = True
+        for _ in range(10):
+            grid.update()
+        self.assertLess(grid.active_count, grid.size ** 3 * grid.active_limit)
+
+
+# A cell of a grid that reads and writes straight into the grid arrays
+class CellView(Cell):
+    __slots__ = ('grid', 'index')
+
+    def __init__(self, grid, x, y, z):
+        self.grid = grid
+        self.index = (x, y, z)
+
+    @property
+    def cell_type(self):
+        return int(self.grid.state[self.index])
+
+    @cell_type.setter
+    def cell_type(self, cell_type):
+        self.grid.state[self.index] = cell_type
+        self.grid.changed = None
+
+    @property
+    def colour(self):
+        return self.grid.palette[self.grid.colour_index[self.index]]
+
+    @colour.setter
+    def colour(self, colour):
+        self.grid.colour_index[self.index] = self.grid.palette_index(colour)
+
+    @property
+    def height(self):
+        return int(self.grid.heights[self.index])
+
+    @height.setter
+    def height(self, height):
+        self.grid.heights[self.index] = height
+        self.grid.changed = None
+
+    @property
+    def position(self):
+        return list(self.index)
+
+    @property
+    def predefined_update(self):
+        return self.grid.predefined_update
+
+
+# grid.cells[x][y][z] without keeping a Cell for every position
+class GridView:
+    def __init__(self, grid, index=()):
+        self.grid = grid
+        self.index = index
+
+    def __len__(self):
+        return self.grid.size
+
+    def __getitem__(self, i):
+        i = range(self.grid.size)[i]
+        if len(self.index) == 2:
+            return CellView(self.grid, *self.index, i)
+        return GridView(self.grid, self.index + (i,))
+
 
 class Grid:
-    def __init__(self, size, initial_state, colours, predefined_update=0):
+    def __init__(self, size, initial_state, colours, predefined_update=0, seed=None):
+        # Generations the octree has stepped past the arrays, they are brought up to date when next read
+        self.octree_ahead = 0
+        # True while the octree holds the cells of the arrays, so it steps on without taking them again
+        self.octree_synced = False
+        self._octree = None
         # Save the edited rules if the user edits them
         self.edited_rules = [[], [], 'M']
+        self.radius = 1
+        # States of a Generations rule, live cells decay through the types 2 to states - 1 before dying
+        self.states = 2
+        # Weights of the neighbours of a K rule, a cube with an odd side, None for the M and N neighbourhoods
+        self.kernel = None
         self.size = size
         self.colours = colours
         self.predefined_update = predefined_update
 
-        # Creates the grids of cells
-        self.cells = [[[Cell(initial_state[x][y][z], 
-                             [x,y,z], 
-                             self.colours[initial_state[x][y][z]],
-                             self.predefined_update) for z in range(size)] for y in range(size)] for x in range(size)]
+        # One random generator per grid so a seed always grows the same tree
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        # Checks every vectorised tree step against Cell.tree1_update (slow)
+        self.tree_check = False
+
+        # The grid is stored as compact arrays, colours are indices into a small palette
+        self.palette = []
+        colour_indices = np.zeros(256, dtype=np.uint8)
+        for cell_type, colour in self.colours.items():
+            colour_indices[cell_type] = self.palette_index(colour)
+        self.state = np.array(initial_state, dtype=np.uint8).reshape(size, size, size)
+        for cell_type in np.unique(self.state).tolist():
+            if cell_type not in self.colours:
+                raise KeyError(cell_type)
+        self.colour_index = colour_indices[self.state]
+        self.heights = np.zeros((size, size, size), dtype=np.uint8)
+
+        # Flat indices of the cells changed by the last step, None when every cell has to be recomputed
+        self.changed = None
+        self.step_rules = None
+        # Above this fraction of active cells the whole grid is swept instead
+        self.active_limit = 0.1
+        # Number of cells recomputed by the last step
+        self.active_count = 0
+        # Flat indices of the cells recomputed by the last step, None after a full sweep
+        self.active = None
+        # parallel.SlabPool used for full sweeps, None to step in this process
+        self.pool = None
+        # Number of steps since the grid was created
+        self.generation = 0
+        # history.History recording the generations, None when they are not recorded
+        self.history = None
+        # Life grids look for cycles and replay them instead of stepping, the tree rule draws new numbers every step
+        self.detect_cycles = True
+        self.cycles = None
+        # wire.Surface following the cells sent to a client that only wants the ones it can see
+        self.surface = None
+        # hashlife.Universe stepping the life rules in its place, None to step the arrays
+        self.octree = None
+
+    # The arrays, the changes of the last step and the octree are read through properties: while the octree steps
+    # the grid the arrays are only filled from it when something reads them, usually to encode a frame.
+    # Writing them means the octree has to take them again
+
+    @property
+    def state(self):
+        if self.octree_ahead:
+            self.densify()
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        if self.octree_ahead:
+            self.densify()
+        self._state = state
+        self.octree_synced = False
+
+    @property
+    def colour_index(self):
+        if self.octree_ahead:
+            self.densify()
+        return self._colour_index
+
+    @colour_index.setter
+    def colour_index(self, colour_index):
+        if self.octree_ahead:
+            self.densify()
+        self._colour_index = colour_index
+        self.octree_synced = False
+
+    # None after the cells were written outside of a step, the octree then takes them again
+    @property
+    def changed(self):
+        if self.octree_ahead:
+            self.densify()
+        return self._changed
+
+    @changed.setter
+    def changed(self, changed):
+        if self.octree_ahead:
+            self.densify()
+        self._changed = changed
+        if changed is None:
+            self.octree_synced = False
+
+    @property
+    def octree(self):
+        return self._octree
+
+    @octree.setter
+    def octree(self, universe):
+        if self.octree_ahead:
+            self.densify()
+        self._octree = universe
+        self.octree_synced = False
+
+    # Fills the arrays with the cells of the octree, after the generations it stepped without them
+    def densify(self):
+        generations, self.octree_ahead = self.octree_ahead, 0
+        state, self._colour_index = self._octree.arrays()
+        # Only a single step leaves the changes the active cells of the next one are found from
+        self._changed = np.flatnonzero(state != self._state) if generations == 1 else None
+        self._state = state
+
+    # Index of a colour in the palette, new colours are added to it
+    def palette_index(self, colour):
+        if colour not in self.palette:
+            if len(self.palette) == 256:
+                raise ValueError("A grid can only hold 256 colours")
+            self.palette.append(colour)
+        return self.palette.index(colour)
+
+    # RGB colour of every cell
+    @property
+    def colour_state(self):
+        return np.array(self.palette, dtype=np.uint32)[self.colour_index]
+
+    @colour_state.setter
+    def colour_state(self, colours):
+        values, indices = np.unique(colours, return_inverse=True)
+        lookup = np.array([self.palette_index(int(colour)) for colour in values], dtype=np.uint8)
+        self.colour_index = lookup[indices].reshape(np.shape(colours))
+        self.changed = None
+
+    # Cells are views on the arrays, built when they are accessed
+    @property
+    def cells(self):
+        return GridView(self)
+
+    # Copies the cells back into the arrays
+    @cells.setter
+    def cells(self, cells):
+        self.state = np.array([[[cell.cell_type for cell in z] for z in y] for y in cells], dtype=np.uint8)
+        self.colour_state = np.array([[[cell.colour for cell in z] for z in y] for y in cells], dtype=np.uint32)
+        self.heights = np.array([[[cell.height for cell in z] for z in y] for y in cells], dtype=np.uint8)
+        self.changed = None
+
+    # Plain Cells copied from the arrays, for the per cell updates that visit every neighbour
+    def cell_list(self):
+        types = self.state.tolist()
+        colours = self.colour_index.tolist()
+        heights = self.heights.tolist()
+        cells = [[[None for _ in range(self.size)] for _ in range(self.size)] for _ in range(self.size)]
+        for x in range(self.size):
+            for y in range(self.size):
+                for z in range(self.size):
+                    cell = Cell(types[x][y][z], [x, y, z], self.palette[colours[x][y][z]], self.predefined_update)
+                    cell.height = heights[x][y][z]
+                    cells[x][y][z] = cell
+        return cells
+
+    # Copy of the grid state, including the random generator, that can be put back with restore. The root of a
+    # synced octree goes with it, its nodes never change so the grid restored steps on without reloading them
+    def snapshot(self):
+        octree = None
+        if self._octree is not None and self.octree_synced:
+            octree = (self._octree.root, self._octree.generation)
+        return {'state': self.state.copy(),
+                'colour_index': self.colour_index.copy(),
+                'heights': self.heights.copy(),
+                'palette': list(self.palette),
+                'generation': self.generation,
+                'changed': None if self.changed is None else self.changed.copy(),
+                'step_rules': self.step_rules,
+                'active_count': self.active_count,
+                'rng': self.rng.bit_generator.state,
+                'octree': octree}
+
+    def restore(self, snapshot):
+        # The arrays are replaced, whatever the octree stepped past them is dropped
+        self.octree_ahead = 0
+        self.state = snapshot['state'].copy()
+        self.colour_index = snapshot['colour_index'].copy()
+        self.heights = snapshot['heights'].copy()
+        self.palette = list(snapshot['palette'])
+        self.generation = snapshot['generation']
+        self.changed = None if snapshot['changed'] is None else snapshot['changed'].copy()
+        self.step_rules = snapshot['step_rules']
+        self.active_count = snapshot['active_count']
+        self.active = None
+        self.rng.bit_generator.state = snapshot['rng']
+        octree = snapshot.get('octree')
+        if octree is not None and self._octree is not None and octree[0].level == self._octree.level:
+            self._octree.root, self._octree.generation = octree
+            self.octree_synced = True
+        self.recorded()
+
+    # Independent grid with the same state and rules, it does not share any array with this one
+    def copy(self):
+        snapshot = self.snapshot()
+        grid = Grid.__new__(Grid)
+        grid.__dict__.update(self.__dict__)
+        grid.__dict__.pop('buffers', None)
+        grid.history = None
+        grid.cycles = None
+        grid.surface = None
+        grid.octree = None if self.octree is None else self.octree.copy()
+        grid.edited_rules = copy.deepcopy(self.edited_rules)
+        grid.colours = dict(self.colours)
+        grid.rng = np.random.default_rng()
+        grid.restore(snapshot)
+        return grid
+
+    # Bytes used by the arrays holding the grid
+    def memory_usage(self):
+        return self._state.nbytes + self._colour_index.nbytes + self.heights.nbytes + 4 * len(self.palette)
+
+    # Used to send the whole grid, or a snapshot of it, to the scene without building the cells
+    def celldicts(self, snapshot=None):
+        snapshot = snapshot or {'state': self.state, 'colour_index': self.colour_index, 'palette': self.palette}
+        palette = snapshot['palette']
+        return [[[{'cell_type': t, 'colour': palette[c]} for t, c in zip(tz, cz)] for tz, cz in zip(ty, cy)]
+                for ty, cy in zip(snapshot['state'].tolist(), snapshot['colour_index'].tolist())]
     
-    # Returns all cells give a neighbourhood  
-    def get_neighbours(self, x, y, z, radius=1, neighbourhood_type='M'):
+    # Returns all cells give a neighbourhood, from cells when it is given
+    def get_neighbours(self, x, y, z, radius=1, neighbourhood_type='M', cells=None):
+        cells = cells or self.cells
         neighbours = []
         if neighbourhood_type == 'M':  # Moore neighbourhood
             for i in range(max(0, x-radius), min(self.size, x+radius+1)):
                 for j in range(max(0, y-radius), min(self.size, y+radius+1)):
                     for k in range(max(0, z-radius), min(self.size, z+radius+1)):
                         if (i, j, k) != (x, y, z):
-                            neighbours.append(self.cells[i][j][k])
+                            neighbours.append(cells[i][j][k])
         elif neighbourhood_type == 'N':  # Von Neumann neighbourhood
             for i in range(max(0, x-radius), min(self.size, x+radius+1)):
                 for j in range(max(0, y-radius), min(self.size, y+radius+1)):
                     for k in range(max(0, z-radius), min(self.size, z+radius+1)):
                         if (i, j, k) != (x, y, z) and (abs(i-x) + abs(j-y) + abs(k-z) <= radius):
-                            neighbours.append(self.cells[i][j][k])
+                            neighbours.append(cells[i][j][k])
         return neighbours
 
     # Sequential update function
@@ -78,30 +507,221 @@ class Grid:
 
         self.cells = new_cells"""
     
-    def batch_update(self, start_x, end_x):
+    def batch_update(self, start_x, end_x, cells=None):
         #Update a slice of the grid from start_x to end_x (exclusive)
+        cells = cells or self.cells
         new_cells_slice = [[[None for _ in range(self.size)] for _ in range(self.size)] for _ in range(start_x, end_x)]
         
         for x in range(start_x, end_x):
             for y in range(self.size):
                 for z in range(self.size):
-                    neighbours = self.get_neighbours(x, y, z, neighbourhood_type=self.edited_rules[2])
-                    new_cell = Cell(self.cells[x][y][z].cell_type,
-                                    self.cells[x][y][z].position,
-                                    self.cells[x][y][z].colour,
-                                    self.cells[x][y][z].predefined_update)
+                    neighbours = self.get_neighbours(x, y, z, self.radius, self.edited_rules[2], cells)
+                    new_cell = Cell(cells[x][y][z].cell_type,
+                                    cells[x][y][z].position,
+                                    cells[x][y][z].colour,
+                                    cells[x][y][z].predefined_update)
                     new_cell.update(neighbours, self.edited_rules[0], self.edited_rules[1])
                     new_cells_slice[x - start_x][y][z] = new_cell
                     
         return new_cells_slice
 
-    # Concurrent update method
+    # batch_update with the time it took
+    def timed_batch_update(self, start_x, end_x, cells=None):
+        start = time.perf_counter()
+        new_cells_slice = self.batch_update(start_x, end_x, cells)
+        return time.perf_counter() - start, new_cells_slice
+
+    # Changes the life rules to [stay_alive, get_alive, neighbourhood_type] with the given radius, states and
+    # kernel. The rule is checked and its transition table compiled here rather than on the next step
+    def edit_rules(self, rules, radius=1, states=2, kernel=None):
+        if (rules[2] == 'K') != (kernel is not None):
+            raise ValueError("A kernel is given with the K neighbourhood and only with it")
+        if not 2 <= states <= engine.MAX_STATES:
+            raise ValueError(f"A rule has 2 to {engine.MAX_STATES} states")
+        if kernel is not None:
+            kernel = engine.kernel_array(kernel).tolist()
+        engine.compiled_rule(rules[0], rules[1], radius, rules[2], states, kernel)
+        self.edited_rules = [list(rules[0]), list(rules[1]), rules[2]]
+        self.radius = radius
+        self.states = states
+        self.kernel = kernel
+
+    # Radius and type of the neighbourhood a cell is stepped from, the cube around the kernel for K rules
+    def neighbourhood(self):
+        if self.kernel is not None:
+            return engine.kernel_radius(self.kernel), 'M'
+        return self.radius, self.edited_rules[2]
+
+    # Palette indices of the colours of the decaying types of a Generations rule, None for two states
+    def decay_colours(self):
+        if self.states <= 2:
+            return None
+        return [self.palette_index(colour) for colour in engine.decay_colours(self.states)]
+
+    # Flat indices of the cells to recompute, None when the whole grid has to be swept.
+    # Only cells near the last changes can change, unless the rules changed
+    def active_cells(self):
+        rules = step_rules(self)
+        if self.changed is None or rules != self.step_rules:
+            self.step_rules = rules
+            return None
+        limit = self.active_limit * self.state.size
+        if len(self.changed) > limit:
+            return None
+        active = engine.active_cells(self.changed, self.state.shape, *self.neighbourhood())
+        if len(active) > limit:
+            return None
+        return active
+
+    # Vectorised update for the life rules, the cell types are stepped as arrays
+    def update_array(self):
+        red = self.palette_index(engine.RED)
+        decay = self.decay_colours()
+        active = self.active_cells()
+        if active is None:
+            if self.pool is not None:
+                new_state, self.colour_index = self.pool.life_step(self)
+            else:
+                new_state, self.colour_index = engine.life_step(self.state, self.colour_index,
+                                                                self.edited_rules[0], self.edited_rules[1],
+                                                                self.radius, self.edited_rules[2], red,
+                                                                self.states, self.kernel, decay)
+            self.changed = np.flatnonzero(new_state != self.state)
+            self.state = new_state
+            self.active_count = self.state.size
+            self.active = None
+        else:
+            self.changed = engine.life_step_at(self.state, self.colour_index, active,
+                                               self.edited_rules[0], self.edited_rules[1],
+                                               self.radius, self.edited_rules[2], red,
+                                               self.states, self.kernel, decay)
+            self.active_count = len(active)
+            self.active = active
+
+    # Steps the life rules with the octree, which takes the arrays again when they were changed outside of it.
+    # The arrays are left behind until they are read. The cells the octree computed rather than found memoised
+    # are counted as active
+    def update_octree(self, generations=1):
+        red = self.palette_index(engine.RED)
+        universe = self.octree
+        if not universe.steps_like(self, red):
+            universe = self.octree = hashlife.Universe.from_grid(self, universe.max_bytes)
+        elif not self.octree_synced or universe.generation != self.generation:
+            universe.load(self.state, self.colour_index)
+            universe.generation = self.generation
+        computed = universe.computed
+        universe.step(generations)
+        self.octree_ahead += generations
+        self.octree_synced = True
+        self.step_rules = step_rules(self)
+        self.active_count = universe.computed - computed
+        self.active = None
+
+    # Vectorised update for the tree growth rule
+    def update_tree(self):
+        brown, green = self.palette_index(engine.BROWN), self.palette_index(engine.GREEN)
+        active = self.active_cells()
+        state, heights, colours = self.state, self.heights, self.colour_index
+        # The check needs the old grid, so the active cells are stepped on copies
+        if self.tree_check:
+            state, heights, colours = state.copy(), heights.copy(), colours.copy()
+
+        if active is None:
+            draws = self.rng.random((engine.TREE_DRAWS,) + state.shape)
+            if self.pool is not None:
+                state, heights, colours = self.pool.tree_step(self, draws)
+            else:
+                state, heights, colours = engine.tree_step(state, heights, colours, draws,
+                                                           self.radius, self.edited_rules[2], brown, green)
+            changed = np.flatnonzero(state != self.state)
+            self.active_count = state.size
+        else:
+            active_draws = self.rng.random((engine.TREE_DRAWS, len(active)))
+            changed = engine.tree_step_at(state, heights, colours, active, self.changed, active_draws,
+                                          self.radius, self.edited_rules[2], brown, green)
+            self.active_count = len(active)
+
+        if self.tree_check:
+            # Cells outside of the active region never grow so their draws are not used
+            if active is not None:
+                draws = np.zeros((engine.TREE_DRAWS,) + state.shape)
+                draws.reshape(engine.TREE_DRAWS, -1)[:, active] = active_draws
+            self.check_tree_update(draws, state, heights, colours)
+        self.state, self.heights, self.colour_index = state, heights, colours
+        self.changed = changed
+        self.active = active
+
+    # Replays the same random draws through Cell.tree1_update and compares the results
+    def check_tree_update(self, draws, new_state, new_heights, new_colours):
+        cells = self.cell_list()
+        for x in range(self.size):
+            for y in range(self.size):
+                for z in range(self.size):
+                    old = cells[x][y][z]
+                    cell = Cell(old.cell_type, old.position, old.colour, self.predefined_update)
+                    replay = iter(draws[:, x, y, z].tolist())
+                    neighbours = self.get_neighbours(x, y, z, self.radius, self.edited_rules[2], cells)
+                    cell.tree1_update(neighbours, rand=lambda: next(replay))
+                    got = (new_state[x, y, z], self.palette[new_colours[x, y, z]], new_heights[x, y, z])
+                    if (cell.cell_type, cell.colour, cell.height) != got:
+                        raise RuntimeError(f"Tree update differs at {[x, y, z]}: "
+                                           f"expected {(cell.cell_type, cell.colour, cell.height)}, got {got}")
+
+    # Uses the arrays for the life and tree rules and the cells for any other update
     def update(self):
+        start = time.perf_counter()
+        if self.predefined_update == 0 and self.octree is not None and hashlife.supports(self):
+            self.update_octree()
+            mode = 'octree'
+        elif self.cycles is not None and self.cycles.cycling(self):
+            self.cycles.replay(self)
+            mode = 'replay'
+        else:
+            if self.predefined_update == 0:
+                self.update_array()
+            elif self.predefined_update == 1:
+                self.update_tree()
+            else:
+                self.update_cells()
+            mode = 'active' if self.active is not None else 'full' if self.pool is None else 'pool'
+        rule = {0: 'life', 1: 'tree'}.get(self.predefined_update, 'cells')
+        metrics.observe(metrics.STEP_SECONDS, time.perf_counter() - start, rule, mode, phase='step')
+        self.generation += 1
+        with metrics.timed(metrics.RECORD_SECONDS, phase='record'):
+            self.recorded()
+
+    # Steps several generations, in one jump when the octree can step the rules. The generations in between
+    # are not seen by the history and the cycle detection
+    def advance(self, generations):
+        if self.octree is None or not hashlife.supports(self) or (self.cycles is not None and
+                                                                   self.cycles.cycling(self)):
+            for _ in range(generations):
+                self.update()
+            return
+        self.update_octree(generations)
+        self.generation += generations
+        self.recorded()
+
+    # Brings the history and the cycle detection up to date with a new generation
+    def recorded(self):
+        if self.history is not None:
+            self.history.record(self)
+        if self.octree is not None and hashlife.supports(self):
+            # The octree memoises repeated generations itself, looking for cycles would read the arrays every step
+            self.cycles = None
+        elif self.cycles is not None:
+            self.cycles.record(self)
+        elif self.detect_cycles and self.predefined_update == 0:
+            self.cycles = CycleDetector(self)
+
+    # Concurrent update method
+    def update_cells(self):
 
         new_cells = [[[None for _ in range(self.size)] for _ in range(self.size)] for _ in range(self.size)]
+        cells = self.cell_list()
         
-        # Number of chunks to split the grid into for parallelisation
-        num_chunks = os.cpu_count() 
+        # Number of chunks to split the grid into for parallelisation, at least one plane each
+        num_chunks = min(os.cpu_count(), self.size)
         chunk_size = self.size // num_chunks
         
         # ThreadPoolExecutor to parallelise updates
@@ -110,17 +730,22 @@ class Grid:
             for i in range(num_chunks):
                 start_x = i * chunk_size
                 end_x = (i + 1) * chunk_size if i != num_chunks - 1 else self.size
-                future = executor.submit(self.batch_update, start_x, end_x)
+                future = executor.submit(self.timed_batch_update, start_x, end_x, cells)
                 future_to_start[future] = start_x
 
             # Collect results
+            chunk_seconds = []
             for future in as_completed(future_to_start):
-                new_cells_slice = future.result()
+                seconds, new_cells_slice = future.result()
+                chunk_seconds.append(seconds)
                 start_x = future_to_start[future]
                 for x in range(len(new_cells_slice)):
                     new_cells[start_x + x] = new_cells_slice[x]
         
+        metrics.observe_chunks('threads', chunk_seconds)
         self.cells = new_cells
+        self.active_count = self.state.size
+        self.active = None
 
     
 if __name__ == '__main__':
@@ -0,0 +1,461 @@
+import copy
+import engine
+import itertools
+import numpy as np
+import threading
+import unittest
+
+
+class TestHashLife(unittest.TestCase):
+
+    def dense_grid(self, state, rules):
+        from grid import Grid
+        grid = Grid(len(state), state, {0: 0, 1: 0x00ff00})
+        grid.edited_rules = rules
+        grid.detect_cycles = False
+        return grid
+
+    # Test the octree gives the same types and colours as the dense engine, up to the faces of the grid
+    def test_matches_dense(self):
+        rng = np.random.default_rng(5)
+        for size, rules in [(20, [[2, 3, 4], [3], 'M']), (13, [[1, 2], [1, 3], 'N']), (16, [[], [], 'M'])]:
+            state = (rng.random((size, size, size)) < 0.15).astype(int).tolist()
+            dense = self.dense_grid(state, rules)
+            universe = Universe.from_grid(dense)
+            for _ in range(6):
+                dense.update()
+                universe.step(1)
+                types, colours = universe.arrays()
+                self.assertTrue(np.array_equal(types, dense.state))
+                self.assertTrue(np.array_equal(colours, dense.colour_index))
+
+    # Test a jump of many generations gives the generation the dense engine reaches one step at a time
+    def test_jump(self):
+        state = np.zeros((40, 40, 40), dtype=int)
+        state[18:22, 18:22, 18:22] = np.random.default_rng(6).random((4, 4, 4)) < 0.6
+        dense = self.dense_grid(state.tolist(), [[2, 3, 4], [3], 'M'])
+        universe = Universe.from_grid(dense)
+        for _ in range(9):
+            dense.update()
+        universe.step(9)
+        self.assertEqual(universe.generation, 9)
+        types, colours = universe.arrays()
+        self.assertTrue(np.array_equal(types, dense.state))
+        self.assertTrue(np.array_equal(colours, dense.colour_index))
+
+    # Test a pattern in a huge sparse universe behaves as in a small dense grid around it
+    def test_huge_universe(self):
+        rules = [[1, 2], [1, 3], 'N']
+        pattern = np.zeros((24, 24, 24), dtype=int)
+        pattern[10:14, 11:13, 10:14] = np.random.default_rng(7).random((4, 2, 4)) < 0.7
+        dense = self.dense_grid(pattern.tolist(), rules)
+        for _ in range(8):
+            dense.update()
+
+        points = np.argwhere(pattern == 1) + 500
+        universe = Universe.from_points(1024, points, rules, red=1)
+        universe.step(8)
+        self.assertEqual(universe.population, int((dense.state == 1).sum()))
+        types, _ = universe.arrays(500, 524)
+        self.assertTrue(np.array_equal(types, dense.state))
+        self.assertLess(universe.memory_usage(), 8 * 1024 * 1024)
+
+    # Test a period two oscillator is only computed once, the next periods are memoised results
+    def test_memoised(self):
+        plus = np.zeros((32, 32, 32), dtype=int)
+        plus[16, 16, 15:18] = plus[16, 15:18, 16] = 1
+        dense = self.dense_grid(plus.tolist(), [[2, 3], [2], 'N'])
+        universe = Universe.from_grid(dense)
+        universe.step(3)
+        first = universe.arrays()[0]
+        universe.step(2)
+        self.assertTrue(np.array_equal(universe.arrays()[0], first))
+        computed = universe.computed
+        universe.step(2)
+        self.assertTrue(np.array_equal(universe.arrays()[0], first))
+        self.assertEqual(universe.computed, computed)
+
+    # Test the cache is emptied of the nodes the universe does not use anymore once it is over its limit
+    def test_collect(self):
+        rng = np.random.default_rng(8)
+        state = (rng.random((24, 24, 24)) < 0.2).astype(int).tolist()
+        dense = self.dense_grid(state, [[2, 3, 4], [3], 'M'])
+        universe = Universe.from_grid(dense, max_bytes=128 * 1024)
+        for _ in range(5):
+            dense.update()
+            universe.step(1)
+            self.assertLessEqual(len(universe.table), universe.nodes_in_use() + 1)
+        self.assertTrue(np.array_equal(universe.arrays()[0], dense.state))
+
+    # Test the results are kept between steps once the nodes in use alone are over the limit
+    def test_collect_over_limit(self):
+        plus = np.zeros((32, 32, 32), dtype=int)
+        plus[16, 16, 15:18] = plus[16, 15:18, 16] = 1
+        dense = self.dense_grid(plus.tolist(), [[2, 3], [2], 'N'])
+        universe = Universe.from_grid(dense, max_bytes=1)
+        for _ in range(6):
+            universe.step(1)
+        self.assertGreater(universe.collect_at, universe.max_bytes)
+        computed = universe.computed
+        for _ in range(4):
+            universe.step(1)
+        self.assertEqual(universe.computed, computed)
+
+    # Test a copy stepped by another thread while the universe collects matches the universe
+    def test_copy_threads(self):
+        rng = np.random.default_rng(9)
+        state = (rng.random((24, 24, 24)) < 0.2).astype(int).tolist()
+        universe = Universe.from_grid(self.dense_grid(state, [[2, 3, 4], [3], 'M']), max_bytes=64 * 1024)
+        ahead = universe.copy()
+        self.assertIs(ahead.lock, universe.lock)
+        thread = threading.Thread(target=ahead.step, args=(6,))
+        thread.start()
+        for _ in range(6):
+            universe.step(1)
+        thread.join()
+        self.assertEqual(ahead.generation, universe.generation)
+        self.assertTrue(np.array_equal(ahead.arrays()[0], universe.arrays()[0]))
+
+    # Test the rules the octree cannot step are refused
+    def test_supports(self):
+        grid = self.dense_grid(np.zeros((4, 4, 4), dtype=int).tolist(), [[2, 3], [3], 'M'])
+        self.assertTrue(supports(grid))
+        grid.radius = 2
+        self.assertFalse(supports(grid))
+        grid.radius = 1
+        grid.edited_rules = [[2], [0, 3], 'M']
+        self.assertFalse(supports(grid))
+        grid.edited_rules = [[2], [3], 'M']
+        grid.states = 3
+        self.assertFalse(supports(grid))
+
+
+# Leaves are cubes of 2 ** LEAF cells stepped with the dense engine
+LEAF = 3
+LEAF_SIZE = 1 << LEAF
+# Bytes of nodes and memoised results kept by default, unused ones are collected past it
+MAX_BYTES = 256 * 1024 * 1024
+# Rough bytes taken by a node besides its leaf cells, and by a memoised result
+NODE_BYTES = 200
+RESULT_BYTES = 100
+# Children order, the x bit first like the grid arrays
+OCTANTS = list(itertools.product((0, 1), repeat=3))
+
+_uids = itertools.count()
+
+
+# True for the grids the octree can step: two state life rules with radius 1 and empty cells that stay empty
+# on their own
+def supports(grid):
+    stay_alive, get_alive, _ = engine.life_rules(grid.edited_rules[0], grid.edited_rules[1])
+    return (grid.predefined_update == 0 and grid.radius == 1 and grid.edited_rules[2] in ('M', 'N')
+            and grid.states == 2 and 0 not in get_alive)
+
+
+# Canonical node of the octree, equal cubes are the same node. Cells are stored as type | colour index << 8
+class Node:
+    __slots__ = ('uid', 'level', 'children', 'leaf', 'population', 'bounds', 'results')
+
+    def __init__(self, level, children=None, leaf=None):
+        self.uid = next(_uids)
+        self.level = level
+        self.children = children
+        self.leaf = leaf
+        if leaf is not None:
+            self.population = int(np.count_nonzero((leaf & 0xff) == 1))
+        else:
+            self.population = sum(child.population for child in children)
+        # Lowest and highest corner of the live cells, computed when first needed
+        self.bounds = None
+        # Centre of the node advanced by a number of generations, by the number of generations
+        self.results = {}
+
+
+# Grid of life cells stored as a hash-consed octree, advanced with memoised results (Hashlife) so
+# repeated regions and repeated generations are only computed once. The cube of the given size at the
+# origin behaves exactly like a Grid of that size: cells outside of it are empty and never born
+class Universe:
+    def __init__(self, size, rules, red, max_bytes=MAX_BYTES):
+        self.size = size
+        self.rules = [list(rules[0]), list(rules[1]), rules[2]]
+        self.red = red
+        self.max_bytes = max_bytes
+        # Bytes past which the unused nodes are collected, raised above max_bytes while the nodes in use take most
+        # of it, and the most bytes a step added since the last collection
+        self.collect_at = max_bytes
+        self.step_bytes = 0
+        # Held while stepping or collecting, shared with the copies since they share the memoised results
+        self.lock = threading.RLock()
+        self.table = {}
+        self.empty = {}
+        self.bytes = 0
+        self.generation = 0
+        # Cells computed by the dense engine so far, memoised results are not counted again
+        self.computed = 0
+        self.level = max(LEAF + 1, int(np.ceil(np.log2(max(size, 2)))))
+        self.root = self.empty_node(self.level)
+
+    @classmethod
+    def from_grid(cls, grid, max_bytes=MAX_BYTES):
+        universe = cls(grid.size, grid.edited_rules, grid.palette_index(engine.RED), max_bytes)
+        universe.generation = grid.generation
+        universe.load(grid.state, grid.colour_index)
+        return universe
+
+    # Universe with live cells at the given points, for universes too large to be held as arrays
+    @classmethod
+    def from_points(cls, size, points, rules, red, colour=0, max_bytes=MAX_BYTES):
+        universe = cls(size, rules, red, max_bytes)
+        points = np.asarray(points, dtype=np.int64).reshape(-1, 3)
+        leaves = {}
+        for corner in np.unique(points >> LEAF, axis=0):
+            leaves[tuple(corner.tolist())] = np.zeros((LEAF_SIZE,) * 3, dtype=np.uint16)
+        for point in points:
+            x, y, z = (point & (LEAF_SIZE - 1)).tolist()
+            leaves[tuple((point >> LEAF).tolist())][x, y, z] = 1 | colour << 8
+        universe.root = universe.build(universe.level, (0, 0, 0), leaves)
+        return universe
+
+    # True when the universe steps the cells the way the grid does, its memoised results hold for the grid
+    def steps_like(self, grid, red):
+        return (self.size == grid.size and self.red == red and
+                self.rules == [list(grid.edited_rules[0]), list(grid.edited_rules[1]), grid.edited_rules[2]])
+
+    # Universe sharing the nodes and their results, that can be stepped on its own (by another thread). It shares
+    # the lock too, so one of them collecting never clears the results the other is stepping with
+    def copy(self):
+        universe = copy.copy(self)
+        universe.table = dict(self.table)
+        universe.empty = dict(self.empty)
+        return universe
+
+    # Replaces the cells with dense type and colour index arrays
+    def load(self, types, colours):
+        side = 1 << self.level
+        values = np.zeros((side, side, side), dtype=np.uint16)
+        n = types.shape[0]
+        values[:n, :n, :n] = types.astype(np.uint16) | colours.astype(np.uint16) << 8
+        blocks = values.reshape(side >> LEAF, LEAF_SIZE, side >> LEAF, LEAF_SIZE, side >> LEAF, LEAF_SIZE)
+        occupied = np.argwhere(blocks.any(axis=(1, 3, 5)))
+        leaves = {}
+        for x, y, z in occupied.tolist():
+            leaves[(x, y, z)] = values[x << LEAF:(x + 1) << LEAF, y << LEAF:(y + 1) << LEAF,
+                                       z << LEAF:(z + 1) << LEAF].copy()
+        self.root = self.build(self.level, (0, 0, 0), leaves)
+
+    # Node of a level with its corner at the given leaf coordinates, from a dict of leaf arrays by coordinates
+    def build(self, level, corner, leaves):
+        if level == LEAF:
+            leaf = leaves.get(corner)
+            return self.empty_node(LEAF) if leaf is None else self.leaf(leaf)
+        span = 1 << (level - LEAF - 1)
+        if not any(all(c <= l < c + 2 * span for c, l in zip(corner, key)) for key in leaves):
+            return self.empty_node(level)
+        return self.join([self.build(level - 1, (corner[0] + a * span, corner[1] + b * span, corner[2] + c * span),
+                                     leaves) for a, b, c in OCTANTS])
+
+    # Canonical nodes
+
+    def leaf(self, values):
+        key = values.tobytes()
+        node = self.table.get(key)
+        if node is None:
+            values = values.copy()
+            values.flags.writeable = False
+            node = self.table[key] = Node(LEAF, leaf=values)
+            self.bytes += NODE_BYTES + values.nbytes
+        return node
+
+    def join(self, children):
+        key = tuple(child.uid for child in children)
+        node = self.table.get(key)
+        if node is None:
+            node = self.table[key] = Node(children[0].level + 1, children=tuple(children))
+            self.bytes += NODE_BYTES
+        return node
+
+    def empty_node(self, level):
+        if level not in self.empty:
+            if level == LEAF:
+                self.empty[level] = self.leaf(np.zeros((LEAF_SIZE,) * 3, dtype=np.uint16))
+            else:
+                self.empty[level] = self.join([self.empty_node(level - 1)] * 8)
+        return self.empty[level]
+
+    # Dense cells of a node
+    def values(self, node):
+        if node.leaf is not None:
+            return node.leaf
+        half = 1 << (node.level - 1)
+        values = np.zeros((2 * half,) * 3, dtype=np.uint16)
+        for (a, b, c), child in zip(OCTANTS, node.children):
+            if child is not self.empty[child.level]:
+                values[a * half:(a + 1) * half, b * half:(b + 1) * half, c * half:(c + 1) * half] = self.values(child)
+        return values
+
+    # Node for dense cells whose side is a power of two, at least a leaf
+    def node(self, values):
+        side = values.shape[0]
+        if side == LEAF_SIZE:
+            return self.leaf(values)
+        half = side // 2
+        return self.join([self.node(values[a * half:(a + 1) * half, b * half:(b + 1) * half, c * half:(c + 1) * half])
+                          for a, b, c in OCTANTS])
+
+    # Stepping
+
+    # Node of the next level down at the centre of a node
+    def centre(self, node):
+        if node.level == LEAF + 1:
+            quarter = LEAF_SIZE // 2
+            return self.leaf(self.values(node)[quarter:-quarter, quarter:-quarter, quarter:-quarter])
+        return self.join([child.children[7 - i] for i, child in enumerate(node.children)])
+
+    # Centre of a node advanced by some generations, at most a quarter of the side of the node
+    def advance(self, node, generations):
+        if node.population == 0 or generations == 0:
+            return self.centre(node)
+        result = node.results.get(generations)
+        if result is not None:
+            return result
+
+        if node.level == LEAF + 1:
+            result = self.advance_dense(node, generations)
+        else:
+            # The 4 x 4 x 4 grandchildren, then the 27 overlapping cubes of the next level down made of them
+            grandchildren = np.empty((4, 4, 4), dtype=object)
+            for (a, b, c), child in zip(OCTANTS, node.children):
+                for (d, e, f), grandchild in zip(OCTANTS, child.children):
+                    grandchildren[2 * a + d, 2 * b + e, 2 * c + f] = grandchild
+            # Advances the cubes in two halves, each of them at most a quarter of their side
+            second = min(generations, 1 << (node.level - 3))
+            first = generations - second
+            middles = np.empty((3, 3, 3), dtype=object)
+            for i, j, k in itertools.product(range(3), repeat=3):
+                cube = self.join([grandchildren[i + a, j + b, k + c] for a, b, c in OCTANTS])
+                middles[i, j, k] = self.advance(cube, first)
+            result = self.join([self.advance(self.join([middles[i + a, j + b, k + c] for a, b, c in OCTANTS]), second)
+                                for i, j, k in OCTANTS])
+        node.results[generations] = result
+        self.bytes += RESULT_BYTES
+        return result
+
+    # Steps the cells of a node with the dense engine, the centre is not reached by the edges of the array
+    def advance_dense(self, node, generations):
+        values = self.values(node)
+        types, colours = (values & 0xff).astype(np.uint8), (values >> 8).astype(np.uint8)
+        for _ in range(generations):
+            types, colours = engine.life_step(types, colours, self.rules[0], self.rules[1], 1, self.rules[2], self.red)
+        self.computed += types.size * generations
+        quarter = LEAF_SIZE // 2
+        centre = types.astype(np.uint16) | colours.astype(np.uint16) << 8
+        return self.leaf(centre[quarter:-quarter, quarter:-quarter, quarter:-quarter])
+
+    # Root one level up with the current root at its centre
+    def embed(self, node):
+        empty = self.empty_node(node.level - 1)
+        return self.join([self.join([node.children[i] if j == 7 - i else empty for j in range(8)])
+                          for i in range(8)])
+
+    # Lowest and highest corner of the live cells of a node, None when it has none
+    def live_bounds(self, node):
+        if node.population == 0:
+            return None
+        if node.bounds is None:
+            if node.leaf is not None:
+                live = np.argwhere((node.leaf & 0xff) == 1)
+                node.bounds = (live.min(axis=0), live.max(axis=0))
+            else:
+                half = 1 << (node.level - 1)
+                corners = [(np.array(octant) * half + low, np.array(octant) * half + high)
+                           for octant, child in zip(OCTANTS, node.children)
+                           if child.population for low, high in [self.live_bounds(child)]]
+                node.bounds = (np.min([low for low, _ in corners], axis=0), np.max([high for _, high in corners], axis=0))
+        return node.bounds
+
+    # Empties the cells outside of the cube of the grid, the node has its corner at origin
+    def clip(self, node, origin=(0, 0, 0)):
+        side = 1 << node.level
+        if node.population == 0 or all(o + side <= self.size for o in origin):
+            return node
+        if any(o >= self.size for o in origin):
+            return self.empty_node(node.level)
+        if node.leaf is not None:
+            values = node.leaf.copy()
+            inside = [max(0, self.size - o) for o in origin]
+            values[inside[0]:] = 0
+            values[:, inside[1]:] = 0
+            values[:, :, inside[2]:] = 0
+            return self.leaf(values)
+        half = side // 2
+        return self.join([self.clip(child, (origin[0] + a * half, origin[1] + b * half, origin[2] + c * half))
+                          for (a, b, c), child in zip(OCTANTS, node.children)])
+
+    # Advances the universe by some generations. Several are done at once while the live cells are far enough
+    # from the faces of the cube not to reach them, one at a time with the cells outside emptied otherwise
+    def step(self, generations):
+        with self.lock:
+            while generations > 0:
+                bounds = self.live_bounds(self.root)
+                if bounds is None:
+                    self.generation += generations
+                    break
+                margin = int(min(bounds[0].min(), self.size - 1 - bounds[1].max()))
+                jump = max(1, min(generations, margin, 1 << (self.level - 1)))
+                before = self.bytes
+                root = self.advance(self.embed(self.root), jump)
+                self.root = root if margin >= jump else self.clip(root)
+                self.generation += jump
+                generations -= jump
+                self.step_bytes = max(self.step_bytes, self.bytes - before)
+                if self.bytes > self.collect_at:
+                    self.collect()
+
+    # Garbage collection
+
+    def reachable(self):
+        seen = {}
+        stack = [self.root] + list(self.empty.values())
+        while stack:
+            node = stack.pop()
+            if node.uid not in seen:
+                seen[node.uid] = node
+                if node.children is not None:
+                    stack.extend(node.children)
+        return seen
+
+    def nodes_in_use(self):
+        return len(self.reachable())
+
+    # Drops the nodes the root does not use and every memoised result. When the nodes left take over half of
+    # max_bytes, collecting again once they reach it would throw the results away every step, so the next
+    # collection waits until the results take twice what the largest step added
+    def collect(self):
+        with self.lock:
+            used = self.reachable()
+            self.table = {key: node for key, node in self.table.items() if node.uid in used}
+            self.bytes = 0
+            for node in self.table.values():
+                node.results.clear()
+                self.bytes += NODE_BYTES + (node.leaf.nbytes if node.leaf is not None else 0)
+            self.collect_at = self.max_bytes
+            if self.bytes > self.max_bytes // 2:
+                self.collect_at = max(self.max_bytes, self.bytes + 2 * self.step_bytes)
+            self.step_bytes = 0
+
+    def memory_usage(self):
+        return self.bytes
+
+    @property
+    def population(self):
+        return self.root.population
+
+    # Types and colour indices of the cube from start to end on every axis, the whole grid by default
+    def arrays(self, start=0, end=None):
+        end = self.size if end is None else end
+        values = self.values(self.root)[start:end, start:end, start:end]
+        return (values & 0xff).astype(np.uint8), (values >> 8).astype(np.uint8)
+
+
+if __name__ == '__main__':
+    unittest.main()
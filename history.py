@@ -0,0 +1,337 @@
+import io
+import json
+import numpy as np
+import unittest
+
+
+class TestHistory(unittest.TestCase):
+
+    def life_grid(self, size=12):
+        from grid import Grid
+        rng = np.random.default_rng(1)
+        state = np.zeros((size, size, size), dtype=int)
+        state[4:8, 4:8, 4:8] = rng.random((4, 4, 4)) < 0.5
+        grid = Grid(size, state.tolist(), {0: 0, 1: 0xff0000})
+        grid.edited_rules = [[2, 3, 4], [3], 'M']
+        return grid
+
+    def tree_grid(self):
+        from grid import Grid
+        state = np.zeros((9, 9, 9), dtype=int)
+        state[4, 0, 4] = 2
+        return Grid(9, state.tolist(), {t: 0x00ff00 for t in range(13)}, predefined_update=1, seed=2)
+
+    def assertSameArrays(self, grid, snapshot):
+        self.assertEqual(grid.generation, snapshot['generation'])
+        for name in ('state', 'colour_index', 'heights'):
+            self.assertTrue(np.array_equal(getattr(grid, name), snapshot[name]), name)
+        self.assertEqual(grid.palette, snapshot['palette'])
+
+    # Records a grid for some generations and keeps a snapshot of each one to compare with
+    def record(self, grid, generations, history=None):
+        grid.history = history or History()
+        grid.history.record(grid)
+        snapshots = [grid.snapshot()]
+        for _ in range(generations):
+            grid.update()
+            snapshots.append(grid.snapshot())
+        return snapshots
+
+    # Test seeking to any recorded generation, backwards and forwards, gives the grid it had then
+    def test_seek(self):
+        for grid in (self.life_grid(), self.tree_grid()):
+            snapshots = self.record(grid, 30, History())
+            self.assertGreater(len(grid.history.segments), 1)
+            for generation in (0, 17, 3, 30, 29, 12):
+                grid.history.seek(grid, generation)
+                self.assertSameArrays(grid, snapshots[generation])
+
+    # Test stepping after a seek continues the same way and replaces the recorded future
+    def test_step_after_seek(self):
+        grid = self.tree_grid()
+        snapshots = self.record(grid, 12)
+        grid.history.seek(grid, 5)
+        for generation in range(6, 13):
+            grid.update()
+            self.assertSameArrays(grid, snapshots[generation])
+        grid.history.seek(grid, 8)
+        grid.edited_rules = [[], [], 'N']
+        grid.update()
+        self.assertEqual(grid.history.last, 9)
+        with self.assertRaises(ValueError):
+            grid.history.seek(grid, 10)
+
+    # Test a recorded generation takes memory for the cells it changed, not for the whole grid
+    def test_delta_size(self):
+        grid = self.life_grid(size=32)
+        self.record(grid, 20)
+        segments = grid.history.segments
+        deltas = [delta for segment in segments for delta in segment.deltas]
+        delta_bytes = sum(segment.delta_bytes for segment in segments)
+        self.assertEqual(len(deltas), 20)
+        self.assertEqual(delta_bytes, 7 * sum(len(delta[0]) for delta in deltas) + DELTA_OVERHEAD * 20)
+        self.assertLess(delta_bytes, 20 * grid.memory_usage() / 10)
+        self.assertLessEqual(len(segments) - 1, delta_bytes / segments[0].arrays.nbytes)
+
+    # Test the oldest generations are dropped once the history is over its size
+    def test_max_bytes(self):
+        grid = self.life_grid()
+        snapshots = self.record(grid, 60, History(max_bytes=4 * grid.memory_usage()))
+        history = grid.history
+        self.assertGreater(history.first, 0)
+        self.assertEqual(history.last, 60)
+        self.assertLessEqual(history.memory_usage(), history.max_bytes + history.segments[-1].memory_usage())
+        with self.assertRaises(ValueError):
+            history.seek(grid, 0)
+        history.seek(grid, history.first)
+        self.assertSameArrays(grid, snapshots[history.first])
+
+    # Test a grid restored further on starts a new segment and the generations skipped cannot be sought
+    def test_jump(self):
+        grid = self.life_grid()
+        copied = grid.copy()
+        self.record(grid, 2)
+        for _ in range(5):
+            copied.update()
+        grid.restore(copied.snapshot())
+        self.assertEqual([(s.start, s.end) for s in grid.history.segments], [(0, 2), (5, 5)])
+        with self.assertRaises(ValueError):
+            grid.history.seek(grid, 3)
+
+    # Test a packed history comes back with the same generations
+    def test_pack(self):
+        grid = self.tree_grid()
+        snapshots = self.record(grid, 20)
+        history = unpack_history(pack_history(grid.history))
+        history.attach(grid)
+        for generation in (20, 0, 11):
+            history.seek(grid, generation)
+            self.assertSameArrays(grid, snapshots[generation])
+
+
+# Bytes of history kept by default, the oldest generations are dropped past it
+MAX_BYTES = 64 * 1024 * 1024
+# Rough bytes taken by a delta besides its cells, mostly the generator state
+DELTA_OVERHEAD = 256
+
+
+# The grid arrays stacked in one copy, in the order the deltas hold their values
+def stack(grid):
+    return np.stack([grid.state, grid.colour_index, grid.heights]).astype(np.uint8)
+
+
+# Full copy of the grid arrays at a generation, followed by the changes of the generations after it.
+# The changed cells and step rules let the grid carry on with the same sparse steps after a seek
+class Segment:
+    def __init__(self, start, arrays, palette, rng, changed, step_rules):
+        self.start = start
+        self.arrays = arrays
+        self.palette = palette
+        self.rng = rng
+        self.changed = changed
+        self.step_rules = step_rules
+        # (flat indices, (3, n) values, palette if it changed, generator state, step rules) for each
+        # generation, the step rules are None when the grid had no changed cells to go from
+        self.deltas = []
+        self.delta_bytes = 0
+
+    # Last generation of the segment
+    @property
+    def end(self):
+        return self.start + len(self.deltas)
+
+    def memory_usage(self):
+        changed = self.changed.nbytes if self.changed is not None else 0
+        return self.arrays.nbytes + changed + self.delta_bytes
+
+
+# Generations of a grid kept as checkpoints and the cells changed by each step, to seek back and forth.
+# A checkpoint is taken once the deltas since the last one take as much memory as a checkpoint, so
+# replaying never costs more than copying the grid twice and memory follows the number of changed cells
+class History:
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.segments = []
+        # Grid arrays, palette and generation of the last one recorded or sought, the deltas are taken against it
+        self.head = None
+        self.palette = None
+        self.position = None
+
+    @property
+    def first(self):
+        return self.segments[0].start if self.segments else None
+
+    @property
+    def last(self):
+        return self.segments[-1].end if self.segments else None
+
+    def memory_usage(self):
+        head = self.head.nbytes if self.head is not None else 0
+        return head + sum(segment.memory_usage() for segment in self.segments)
+
+    # Records the generation the grid is at, called by the grid after each step or restore
+    def record(self, grid):
+        generation = grid.generation
+        if generation == self.position:
+            return
+        if self.position is None or generation != self.position + 1 or grid.state.shape != self.head.shape[1:]:
+            self.restart(grid)
+            return
+        self.truncate()
+
+        # Only the cells the step recomputed can differ from the head
+        flat = self.head.reshape(3, -1)
+        arrays = (grid.state.ravel(), grid.colour_index.ravel(), grid.heights.ravel())
+        if grid.active is None:
+            differs = (arrays[0] != flat[0]) | (arrays[1] != flat[1]) | (arrays[2] != flat[2])
+            indices = np.flatnonzero(differs)
+        else:
+            active = grid.active
+            differs = ((arrays[0][active] != flat[0, active]) | (arrays[1][active] != flat[1, active])
+                       | (arrays[2][active] != flat[2, active]))
+            indices = active[differs]
+        indices = indices.astype(np.uint32)
+        values = np.stack([array[indices] for array in arrays]).astype(np.uint8)
+        changed = indices[flat[0, indices] != values[0]]
+        flat[:, indices] = values
+
+        palette = None
+        if grid.palette != self.palette:
+            palette = self.palette = list(grid.palette)
+        rng = grid.rng.bit_generator.state
+        step_rules = None if grid.changed is None else grid.step_rules
+        segment = self.segments[-1]
+        segment.deltas.append((indices, values, palette, rng, step_rules))
+        segment.delta_bytes += indices.nbytes + values.nbytes + DELTA_OVERHEAD
+        self.position = generation
+
+        if segment.delta_bytes >= segment.arrays.nbytes:
+            changed = None if step_rules is None else changed.astype(np.int64)
+            self.segments.append(Segment(generation, self.head.copy(), list(self.palette), rng, changed, step_rules))
+        self.limit()
+
+    # Starts a new segment at the generation of the grid, dropping what was recorded from there on
+    def restart(self, grid):
+        if self.position is not None:
+            self.position = min(self.position, grid.generation - 1)
+            self.truncate()
+        self.head = stack(grid)
+        self.palette = list(grid.palette)
+        self.position = grid.generation
+        changed = None if grid.changed is None else np.array(grid.changed, dtype=np.int64)
+        self.segments.append(Segment(grid.generation, self.head.copy(), list(grid.palette),
+                                     grid.rng.bit_generator.state, changed, grid.step_rules))
+        self.limit()
+
+    # Drops the generations after the current position, they belong to another future once the grid steps from here
+    def truncate(self):
+        while self.segments and self.segments[-1].start > self.position:
+            self.segments.pop()
+        if self.segments:
+            segment = self.segments[-1]
+            dropped = segment.deltas[max(0, self.position - segment.start):]
+            for indices, values, _, _, _ in dropped:
+                segment.delta_bytes -= indices.nbytes + values.nbytes + DELTA_OVERHEAD
+            del segment.deltas[len(segment.deltas) - len(dropped):]
+
+    # Drops the oldest segments while the history is over max_bytes, the last one is always kept
+    def limit(self):
+        while len(self.segments) > 1 and self.memory_usage() > self.max_bytes:
+            self.segments.pop(0)
+
+    def find(self, generation):
+        for segment in reversed(self.segments):
+            if segment.start <= generation <= segment.end:
+                return segment
+        return None
+
+    # Puts the grid back at a recorded generation, from the nearest checkpoint before it and the deltas after
+    def seek(self, grid, generation):
+        segment = self.find(generation)
+        if segment is None:
+            raise ValueError(f"Generation {generation} is not recorded")
+        arrays = segment.arrays.copy()
+        flat = arrays.reshape(3, -1)
+        palette, rng = segment.palette, segment.rng
+        changed, step_rules = segment.changed, segment.step_rules
+        for indices, values, delta_palette, delta_rng, delta_rules in segment.deltas[:generation - segment.start]:
+            changed = indices[flat[0, indices] != values[0]].astype(np.int64)
+            flat[:, indices] = values
+            if delta_palette is not None:
+                palette = delta_palette
+            rng, step_rules = delta_rng, delta_rules
+
+        self.head, self.palette, self.position = arrays, list(palette), generation
+        grid.restore({'state': arrays[0], 'colour_index': arrays[1], 'heights': arrays[2],
+                      'palette': palette, 'generation': generation,
+                      'changed': None if step_rules is None else changed,
+                      'step_rules': step_rules, 'active_count': 0, 'rng': rng})
+
+    # Records the grid from the generation it is at, after the history was loaded
+    def attach(self, grid):
+        grid.history = self
+        if self.find(grid.generation) is None:
+            self.position = None
+            self.restart(grid)
+        else:
+            self.head = stack(grid)
+            self.palette = list(grid.palette)
+            self.position = grid.generation
+
+
+# Packs a history into one compressed npz blob, the head is not kept as it is the grid saved with it
+def pack_history(history):
+    meta = {'max_bytes': history.max_bytes, 'position': history.position, 'segments': []}
+    arrays = {}
+    for i, segment in enumerate(history.segments):
+        deltas = segment.deltas
+        meta['segments'].append({
+            'start': segment.start,
+            'palette': segment.palette,
+            'rng': segment.rng,
+            'step_rules': segment.step_rules,
+            'counts': [len(delta[0]) for delta in deltas],
+            'palettes': {str(j): delta[2] for j, delta in enumerate(deltas) if delta[2] is not None},
+            'rngs': [delta[3] for delta in deltas],
+            'delta_step_rules': [delta[4] for delta in deltas],
+        })
+        arrays[f'{i}_arrays'] = segment.arrays
+        if segment.changed is not None:
+            arrays[f'{i}_changed'] = segment.changed
+        arrays[f'{i}_indices'] = np.concatenate([delta[0] for delta in deltas] or [np.zeros(0, dtype=np.uint32)])
+        arrays[f'{i}_values'] = np.concatenate([delta[1] for delta in deltas] or [np.zeros((3, 0), dtype=np.uint8)],
+                                               axis=1)
+    # The generator states hold integers too large for numpy, so the metadata is stored as JSON text
+    arrays['meta'] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+    body = io.BytesIO()
+    np.savez_compressed(body, **arrays)
+    return body.getvalue()
+
+
+# Step rules come back from JSON as a list, the grid compares them as a tuple
+def step_rules_tuple(step_rules):
+    return None if step_rules is None else tuple(step_rules)
+
+
+def unpack_history(blob):
+    arrays = np.load(io.BytesIO(blob))
+    meta = json.loads(arrays['meta'].tobytes().decode())
+    history = History(meta['max_bytes'])
+    for i, info in enumerate(meta['segments']):
+        changed = arrays[f'{i}_changed'] if f'{i}_changed' in arrays else None
+        segment = Segment(info['start'], arrays[f'{i}_arrays'], info['palette'], info['rng'], changed,
+                          step_rules_tuple(info['step_rules']))
+        edges = np.cumsum([0] + info['counts'])
+        indices, values = arrays[f'{i}_indices'], arrays[f'{i}_values']
+        for j, (lo, hi) in enumerate(zip(edges[:-1], edges[1:])):
+            delta = (indices[lo:hi], values[:, lo:hi], info['palettes'].get(str(j)), info['rngs'][j],
+                     step_rules_tuple(info['delta_step_rules'][j]))
+            segment.deltas.append(delta)
+            segment.delta_bytes += delta[0].nbytes + delta[1].nbytes + DELTA_OVERHEAD
+        history.segments.append(segment)
+    history.position = meta['position']
+    return history
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import bisect
+import threading
+import time
+import unittest
+
+
+class TestMetrics(unittest.TestCase):
+
+    # Test the buckets are rendered cumulative, by label, in the Prometheus text format
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test timings', (0.1, 1), ('route',), registry=[])
+        for value in (0.05, 0.5, 0.5, 3):
+            histogram.observe(value, '/next')
+        histogram.observe(0.2, 'say "hi"')
+        lines = histogram.render().splitlines()
+        self.assertEqual(lines[:2], ['# HELP test_seconds Test timings', '# TYPE test_seconds histogram'])
+        self.assertIn('test_seconds_bucket{route="/next",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{route="/next",le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{route="/next",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_sum{route="/next"} 4.05', lines)
+        self.assertIn('test_seconds_count{route="/next"} 4', lines)
+        self.assertIn('test_seconds_count{route="say \\"hi\\""} 1', lines)
+
+    # Test the phases timed in a thread add up by name in its Server-Timing header, and other threads are not mixed in
+    def test_phases(self):
+        histogram = Histogram('test_phase_seconds', 'Test phases', TIME_BUCKETS, ('kind',), registry=[])
+        start_phases()
+        for _ in range(2):
+            with timed(histogram, 'step', phase='step'):
+                pass
+        thread = threading.Thread(target=lambda: observe(histogram, 1.0, 'other', phase='other'))
+        thread.start()
+        thread.join()
+        observe(histogram, 0.0025, 'encode', phase='serialise')
+        header = server_timing(end_phases(), total=0.01)
+        self.assertRegex(header, r'^step;dur=\d+\.\d{3}, serialise;dur=2\.500, total;dur=10\.000$')
+        self.assertIsNone(end_phases())
+        self.assertIn('test_phase_seconds_count{kind="step"} 2', histogram.render())
+
+    # Test the slowest chunk of a step is compared with the mean one
+    def test_chunks(self):
+        observe_chunks('test', [1.0, 1.0, 4.0])
+        rendered = CHUNK_IMBALANCE.render()
+        self.assertIn('grid_chunk_imbalance_ratio_bucket{executor="test",le="2"} 1', rendered)
+        self.assertIn('grid_chunk_imbalance_ratio_bucket{executor="test",le="1.5"} 0', rendered)
+        self.assertIn('grid_chunk_seconds_count{executor="test"} 3', CHUNK_SECONDS.render())
+
+
+# Upper bounds of the buckets of the histograms, the last bucket (+Inf) holds the rest
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(12))
+RATIO_BUCKETS = (1.05, 1.1, 1.25, 1.5, 2, 3, 5, 10)
+
+# Histograms /metrics lists, in the order they were made
+HISTOGRAMS = []
+
+
+# Prometheus histogram with one series of bucket counts per set of label values. Observing is a bisect
+# and two additions under a lock, cheap enough to stay on in production
+class Histogram:
+    def __init__(self, name, help, buckets, labels=(), registry=HISTOGRAMS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self.series = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self.series.items()]
+        for label_values, counts, total in series:
+            labels = [f'{name}="{escape(value)}"' for name, value in zip(self.labels, label_values)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = 'le="%s"' % (bound if bound == '+Inf' else format_number(bound))
+                lines.append(f'{self.name}_bucket{{{",".join(labels + [le])}}} {cumulative}')
+            suffix = f'{{{",".join(labels)}}}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {format_number(total)}')
+            lines.append(f'{self.name}_count{suffix} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+STEP_SECONDS = Histogram('grid_step_seconds', 'Time to compute one generation of a grid', TIME_BUCKETS,
+                         ('rule', 'mode'))
+RECORD_SECONDS = Histogram('grid_record_seconds', 'Time to record a generation in the history and cycle detection',
+                           TIME_BUCKETS)
+CHUNK_SECONDS = Histogram('grid_chunk_seconds', 'Time a worker took for its part of a generation', TIME_BUCKETS,
+                          ('executor',))
+CHUNK_IMBALANCE = Histogram('grid_chunk_imbalance_ratio', 'Slowest part of a generation over the mean part',
+                            RATIO_BUCKETS, ('executor',))
+SERIALISE_SECONDS = Histogram('serialise_seconds', 'Time to encode the grid (encode) and write the response body '
+                              '(write)', TIME_BUCKETS, ('format', 'stage'))
+MONGO_SECONDS = Histogram('mongo_seconds', 'Round trip of a grid saved to or loaded from MongoDB', TIME_BUCKETS,
+                          ('operation',))
+REQUEST_SECONDS = Histogram('http_request_seconds', 'Time to handle a request, streams only count until they start',
+                            TIME_BUCKETS, ('route', 'method', 'status'))
+RESPONSE_BYTES = Histogram('http_response_bytes', 'Size of the response bodies, before streams', SIZE_BUCKETS,
+                           ('route',))
+
+
+# Phases timed in the request this thread handles, for its Server-Timing header. Threads outside
+# of a request (look-ahead producers, workers) still fill the histograms but keep no phases
+_phases = threading.local()
+
+
+def start_phases():
+    _phases.list = []
+
+
+def end_phases():
+    phases = getattr(_phases, 'list', None)
+    _phases.list = None
+    return phases
+
+
+def observe(histogram, seconds, *label_values, phase=None):
+    histogram.observe(seconds, *label_values)
+    if phase is not None:
+        phases = getattr(_phases, 'list', None)
+        if phases is not None:
+            phases.append((phase, seconds))
+
+
+# Times a block into a histogram and, when given a phase, into the Server-Timing of the request
+class timed:
+    def __init__(self, histogram, *label_values, phase=None):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.histogram, time.perf_counter() - self.start, *self.label_values, phase=self.phase)
+
+
+# Server-Timing header value with the time of each phase, summed by name, in milliseconds
+def server_timing(phases, total=None):
+    durations = {}
+    for name, seconds in phases or []:
+        durations[name] = durations.get(name, 0) + seconds
+    if total is not None:
+        durations['total'] = total
+    return ', '.join(f'{name};dur={seconds * 1000:.3f}' for name, seconds in durations.items())
+
+
+# Time of each part of a generation computed in parallel, and how much longer the slowest part took than the mean
+def observe_chunks(executor, seconds):
+    for chunk in seconds:
+        CHUNK_SECONDS.observe(chunk, executor)
+    mean = sum(seconds) / len(seconds) if seconds else 0
+    if mean > 0:
+        CHUNK_IMBALANCE.observe(max(seconds) / mean, executor)
+
+
+# Every histogram in the Prometheus text format
+def render():
+    return ''.join(histogram.render() for histogram in HISTOGRAMS)
+
+
+if __name__ == '__main__':
+    unittest.main()
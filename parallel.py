@@ -0,0 +1,267 @@
+import engine
+import metrics
+import numpy as np
+import os
+import threading
+import time
+import unittest
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+
+class TestParallel(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = SlabPool(workers=3, min_planes=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    # Builds a random grid with the process pool and the same grid without it
+    def grids(self, size, predefined_update, seed):
+        from grid import Grid
+        rng = np.random.default_rng(seed)
+        if predefined_update == 1:
+            state = rng.choice([0, 0, 0, 0, 2, 3, 4, 5, 6, 8, 9, 11], (size, size, size))
+        else:
+            state = (rng.random((size, size, size)) < 0.3).astype(int)
+        colours = {t: 0x00ff00 for t in range(13)}
+        grids = [Grid(size, state.tolist(), colours, predefined_update, seed=seed) for _ in range(2)]
+        grids[0].pool = self.pool
+        for grid in grids:
+            grid.active_limit = 0
+        return grids
+
+    # Test the slabs cover the grid and their number adapts to the grid size
+    def test_slab_bounds(self):
+        self.assertEqual(slab_bounds(3, 8, 4), [(0, 3)])
+        self.assertEqual(slab_bounds(10, 8, 4), [(0, 5), (5, 10)])
+        bounds = slab_bounds(64, 6, 4)
+        self.assertEqual(len(bounds), 6)
+        self.assertEqual(bounds[0][0], 0)
+        self.assertEqual(bounds[-1][1], 64)
+        for (_, end), (start, _) in zip(bounds, bounds[1:]):
+            self.assertEqual(end, start)
+
+    # Test the process step gives the same life grid as the single process step
+    def test_life_matches(self):
+        for rules, radius, states in [([[2, 3], [3], 'M'], 1, 2), ([[1, 2], [1, 3], 'N'], 2, 2),
+                                      ([[], [], 'M'], 1, 2), ([[6, 7, 8], [7, 8], 'M'], 2, 4)]:
+            pooled, single = self.grids(11, 0, 1)
+            for grid in (pooled, single):
+                grid.edited_rules = rules
+                grid.radius = radius
+                grid.states = states
+            for _ in range(4):
+                pooled.update()
+                single.update()
+                self.assertTrue(np.array_equal(pooled.state, single.state))
+                self.assertTrue(np.array_equal(pooled.colour_state, single.colour_state))
+                self.assertTrue(np.array_equal(pooled.changed, single.changed))
+
+    # Test a pool starts its processes with the first step, and closing it frees the shared memory it made
+    def test_lazy_close(self):
+        pool = SlabPool(workers=2, min_planes=2)
+        self.assertIsNone(pool.executor)
+        grid, _ = self.grids(6, 0, 3)
+        grid.pool = pool
+        grid.update()
+        self.assertIsNotNone(pool.executor)
+        name = grid.buffers.front['state'].spec[0]
+        pool.close()
+        self.assertIsNone(pool.executor)
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+        pool.close()
+
+    # Test the process step gives the same trees as the single process step
+    def test_tree_matches(self):
+        pooled, single = self.grids(9, 1, 2)
+        for _ in range(4):
+            pooled.update()
+            single.update()
+            self.assertTrue(np.array_equal(pooled.state, single.state))
+            self.assertTrue(np.array_equal(pooled.heights, single.heights))
+            self.assertTrue(np.array_equal(pooled.colour_state, single.colour_state))
+
+
+# Fewest planes a slab should have, thinner slabs spend most of their time on the halo
+MIN_SLAB_PLANES = 8
+# Shared memory blocks a worker keeps open between generations
+ATTACHED_LIMIT = 32
+
+
+# Splits the x axis into slabs, at most one per worker and each one at least min_planes thick
+def slab_bounds(size, workers, min_planes=MIN_SLAB_PLANES):
+    count = max(1, min(workers, size // min_planes))
+    edges = [size * i // count for i in range(count + 1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+# Numpy array stored in a shared memory block, freed with the object
+class SharedArray:
+    def __init__(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        nbytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.array = np.ndarray(shape, dtype, buffer=self.shm.buf)
+        self.spec = (self.shm.name, tuple(shape), dtype.str)
+        self.finalizer = weakref.finalize(self, SharedArray.free, self.shm)
+
+    # Frees the block now rather than when the object goes, it is only done once
+    def close(self):
+        self.finalizer()
+
+    # The name is removed first, the memory itself goes once no array uses it anymore
+    @staticmethod
+    def free(shm):
+        shm.unlink()
+        try:
+            shm.close()
+        except BufferError:
+            pass
+
+
+# Double buffered grid arrays in shared memory, workers read the front and write the back
+class GridBuffers:
+    NAMES = {'state': np.uint8, 'colour_index': np.uint8, 'heights': np.uint8}
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.front = {name: SharedArray(shape, dtype) for name, dtype in self.NAMES.items()}
+        self.back = {name: SharedArray(shape, dtype) for name, dtype in self.NAMES.items()}
+        self.draws = None
+
+    # Copies the grid arrays into the front buffers unless they already are the front buffers
+    def load(self, grid):
+        for name in self.NAMES:
+            if getattr(grid, name) is not self.front[name].array:
+                np.copyto(self.front[name].array, getattr(grid, name))
+
+    def swap(self):
+        self.front, self.back = self.back, self.front
+
+    # Shared array for the random draws of a tree step
+    def draws_buffer(self):
+        if self.draws is None:
+            self.draws = SharedArray((engine.TREE_DRAWS,) + self.shape, np.float64)
+        return self.draws
+
+    def close(self):
+        for shared in list(self.front.values()) + list(self.back.values()) + [self.draws]:
+            if shared is not None:
+                shared.close()
+
+
+# Worker side cache of opened shared memory blocks, kept between generations
+_attached = OrderedDict()
+
+
+def _attach(spec):
+    name, shape, dtype = spec
+    if name not in _attached:
+        if len(_attached) >= ATTACHED_LIMIT:
+            _, (shm, _) = _attached.popitem(last=False)
+            shm.close()
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm, np.ndarray(shape, np.dtype(dtype), buffer=shm.buf))
+    _attached.move_to_end(name)
+    return _attached[name][1]
+
+
+# Steps the planes x0 to x1 in a worker, reading halo planes on each side of the slab. Returns the time it took
+def _step_slab(kind, front, back, draws, x0, x1, halo, args):
+    start = time.perf_counter()
+    src = {name: _attach(spec) for name, spec in front.items()}
+    dst = {name: _attach(spec) for name, spec in back.items()}
+    size = src['state'].shape[0]
+    lo, hi = max(0, x0 - halo), min(size, x1 + halo)
+
+    if kind == 'life':
+        stay_alive, get_alive, radius, neighbourhood_type, red, states, kernel, decay = args
+        state, colours = engine.life_step(src['state'][lo:hi], src['colour_index'][lo:hi],
+                                          stay_alive, get_alive, radius, neighbourhood_type, red,
+                                          states, kernel, decay)
+        heights = np.zeros_like(state)
+    else:
+        radius, neighbourhood_type, brown, green = args
+        state, heights, colours = engine.tree_step(src['state'][lo:hi], src['heights'][lo:hi],
+                                                   src['colour_index'][lo:hi], _attach(draws)[:, lo:hi],
+                                                   radius, neighbourhood_type, brown, green)
+    dst['state'][x0:x1] = state[x0 - lo:x1 - lo]
+    dst['colour_index'][x0:x1] = colours[x0 - lo:x1 - lo]
+    dst['heights'][x0:x1] = heights[x0 - lo:x1 - lo]
+    return time.perf_counter() - start
+
+
+# Persistent pool of worker processes stepping grids slab by slab through shared memory. The processes are
+# started by the first step, so a pool made when a module is imported is not forked along with the process
+class SlabPool:
+    def __init__(self, workers=None, min_planes=MIN_SLAB_PLANES):
+        self.workers = workers or os.cpu_count()
+        self.min_planes = min_planes
+        self.executor = None
+        self.lock = threading.Lock()
+        # Shared buffers made for the grids stepped, freed with the pool
+        self.buffers = weakref.WeakSet()
+
+    def start(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.workers)
+        return self.executor
+
+    # Stops the processes and frees the shared memory of the grids stepped, fit for atexit
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+        for buffers in list(self.buffers):
+            buffers.close()
+
+    # Runs one generation over every slab and returns the new state, colour and height arrays
+    def step(self, grid, kind, args, draws=None):
+        buffers = getattr(grid, 'buffers', None)
+        if buffers is None or buffers.shape != grid.state.shape:
+            buffers = grid.buffers = GridBuffers(grid.state.shape)
+            self.buffers.add(buffers)
+        buffers.load(grid)
+        executor = self.start()
+
+        draws_spec = None
+        if draws is not None:
+            draws_buffer = buffers.draws_buffer()
+            np.copyto(draws_buffer.array, draws)
+            draws_spec = draws_buffer.spec
+
+        # The tree rule always looks one plane away, whatever the radius
+        halo = grid.neighbourhood()[0] if kind == 'life' else max(grid.radius, 1)
+        front = {name: shared.spec for name, shared in buffers.front.items()}
+        back = {name: shared.spec for name, shared in buffers.back.items()}
+        futures = [executor.submit(_step_slab, kind, front, back, draws_spec, x0, x1, halo, args)
+                   for x0, x1 in slab_bounds(grid.size, self.workers, self.min_planes)]
+        metrics.observe_chunks('slabs', [future.result() for future in futures])
+        buffers.swap()
+        return tuple(buffers.front[name].array for name in GridBuffers.NAMES)
+
+    # Returns the new state and colour indices of a life grid
+    def life_step(self, grid):
+        args = (list(grid.edited_rules[0]), list(grid.edited_rules[1]), grid.radius, grid.edited_rules[2],
+                grid.palette_index(engine.RED), grid.states, grid.kernel, grid.decay_colours())
+        state, colours, _ = self.step(grid, 'life', args)
+        return state, colours
+
+    # Returns the new state, heights and colour indices of a tree grid
+    def tree_step(self, grid, draws):
+        args = (grid.radius, grid.edited_rules[2], grid.palette_index(engine.BROWN), grid.palette_index(engine.GREEN))
+        state, colours, heights = self.step(grid, 'tree', args, draws)
+        return state, heights, colours
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+import threading
+import time
+import unittest
+import uuid
+from collections import deque
+
+
+class TestLookAhead(unittest.TestCase):
+
+    def setUp(self):
+        from grid import Grid
+        state = [[[1 if (x + y + z) % 3 == 0 else 0 for z in range(6)] for y in range(6)] for x in range(6)]
+        self.grid = Grid(6, state, {0: 0, 1: 0xff0000})
+        self.grid.edited_rules = [[2, 3], [2], 'M']
+
+    # Test the buffered generations are the ones the grid would have computed
+    def test_same_generations(self):
+        expected = self.grid.copy()
+        lookahead = LookAhead(self.grid, depth=3)
+        try:
+            for _ in range(6):
+                self.grid.restore(lookahead.next())
+                expected.update()
+                self.assertEqual(self.grid.generation, expected.generation)
+                self.assertTrue((self.grid.state == expected.state).all())
+                self.assertTrue((self.grid.changed == expected.changed).all())
+        finally:
+            lookahead.stop()
+
+    # Test the producer never holds more than depth generations
+    def test_bounded(self):
+        lookahead = LookAhead(self.grid, depth=2)
+        try:
+            lookahead.wait_full(timeout=5)
+            self.assertEqual(len(lookahead.frames), 2)
+            self.assertEqual(lookahead.grid.generation, 2)
+        finally:
+            lookahead.stop()
+
+    # Test a stopped producer does not change the grid it was started from
+    def test_stop(self):
+        lookahead = LookAhead(self.grid, depth=2)
+        lookahead.stop()
+        self.assertFalse(lookahead.thread.is_alive())
+        self.assertEqual(self.grid.generation, 0)
+        self.assertIsNone(lookahead.next(timeout=0))
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        from grid import Grid
+        state = [[[1 if (x + y + z) % 3 == 0 else 0 for z in range(6)] for y in range(6)] for x in range(6)]
+        self.grid = Grid(6, state, {0: 0, 1: 0xff0000})
+        self.grid.edited_rules = [[2, 3], [2], 'M']
+
+    # Test a reader that keeps up gets every generation in order
+    def test_every_generation(self):
+        stream = Stream(self.grid, rate=0)
+        frames = stream.frames()
+        generations = [next(frames)['generation'] for _ in range(5)]
+        stream.stop()
+        self.assertEqual(generations, [1, 2, 3, 4, 5])
+        self.assertEqual(stream.skipped, 0)
+
+    # Test a slow reader skips generations instead of queueing them
+    def test_slow_reader_skips(self):
+        stream = Stream(self.grid, rate=200)
+        frames = stream.frames()
+        first = next(frames)['generation']
+        time.sleep(0.2)
+        second = next(frames)['generation']
+        stream.stop()
+        self.assertGreater(second, first + 1)
+        self.assertGreater(stream.skipped, 0)
+
+    # Test stopping ends the frames and the rate can change while streaming
+    def test_controls(self):
+        stream = Stream(self.grid, rate=1000)
+        frames = stream.frames()
+        next(frames)
+        stream.set_rate(0.5)
+        stream.stop()
+        self.assertEqual(list(frames), [])
+        self.assertEqual(stream.rate, 0.5)
+        self.assertEqual(self.grid.generation, 0)
+
+
+# Generations computed ahead by default
+DEPTH = 8
+# Generations per second streamed by default, 0 streams as fast as the grid is computed
+RATE = 4
+# Seconds a stream waits for a generation before sending a keep alive
+KEEP_ALIVE = 15
+
+
+# Steps a copy of a grid in a background thread and keeps its next generations in a bounded buffer
+class LookAhead:
+    def __init__(self, grid, depth=DEPTH):
+        self.grid = grid.copy()
+        self.depth = depth
+        self.frames = deque()
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running or len(self.frames) < self.depth)
+                if not self.running:
+                    return
+            self.grid.update()
+            snapshot = self.grid.snapshot()
+            with self.condition:
+                if not self.running:
+                    return
+                self.frames.append(snapshot)
+                self.condition.notify_all()
+
+    # Snapshot of the next generation, waits for it if the producer is behind.
+    # Returns None once the producer is stopped or after the timeout
+    def next(self, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.frames or not self.running, timeout)
+            if not self.frames:
+                return None
+            snapshot = self.frames.popleft()
+            self.condition.notify_all()
+            return snapshot
+
+    def wait_full(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.frames) >= self.depth, timeout)
+
+    # Stops the producer and drops the generations it computed
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.frames.clear()
+            self.condition.notify_all()
+        self.thread.join()
+
+
+# Steps a copy of a grid in a background thread at a given rate for a streaming client.
+# Only the newest generation is kept, a reader that falls behind skips the ones in between
+class Stream:
+    def __init__(self, grid, rate=RATE):
+        self.id = uuid.uuid4().hex
+        self.grid = grid.copy()
+        self.rate = rate
+        self.latest = None
+        self.last_sent = None
+        self.skipped = 0
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        next_time = time.monotonic()
+        while True:
+            self.grid.update()
+            snapshot = self.grid.snapshot()
+            with self.condition:
+                if not self.running:
+                    return
+                if self.latest is not None:
+                    self.skipped += 1
+                self.latest = snapshot
+                self.condition.notify_all()
+
+                if self.rate > 0:
+                    # Waits for the next tick, a rate change starts the wait again
+                    next_time = max(next_time + 1 / self.rate, time.monotonic() - 1 / self.rate)
+                    rate = self.rate
+                    self.condition.wait_for(lambda: not self.running or self.rate != rate,
+                                            max(0, next_time - time.monotonic()))
+                    if self.rate != rate:
+                        next_time = time.monotonic()
+                else:
+                    # As fast as possible, but never more than one generation ahead of the reader
+                    self.condition.wait_for(lambda: not self.running or self.latest is None)
+                if not self.running:
+                    return
+
+    # Snapshots to send, None when there was nothing new for KEEP_ALIVE seconds
+    def frames(self, keep_alive=KEEP_ALIVE):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.latest is not None or not self.running, keep_alive)
+                if not self.running:
+                    return
+                snapshot, self.latest = self.latest, None
+                self.condition.notify_all()
+            if snapshot is not None:
+                self.last_sent = snapshot
+            yield snapshot
+
+    def set_rate(self, rate):
+        with self.condition:
+            self.rate = rate
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.latest = None
+            self.condition.notify_all()
+        self.thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
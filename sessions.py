@@ -0,0 +1,320 @@
+import numpy as np
+import threading
+import unittest
+from collections import OrderedDict
+from grid import Grid
+from storage import pack_grid, unpack_grid
+
+
+class TestRegistry(unittest.TestCase):
+
+    # Spill store kept in a dict, the grids are packed as in MongoDB
+    class DictStore:
+        def __init__(self):
+            self.documents = {}
+
+        def save(self, session_id, grid):
+            self.documents[session_id] = pack_grid(grid)
+
+        def load(self, session_id):
+            document = self.documents.get(session_id)
+            return None if document is None else unpack_grid(*document)
+
+        def delete(self, session_id):
+            self.documents.pop(session_id, None)
+
+        def count(self):
+            return len(self.documents)
+
+    def make_grid(self, size=6):
+        state = [[[1 if (x + y + z) % 3 == 0 else 0 for z in range(size)] for y in range(size)] for x in range(size)]
+        grid = Grid(size, state, {0: 0, 1: 0xff0000})
+        grid.edited_rules = [[2, 3], [2], 'M']
+        return grid
+
+    # Test sessions get their own grid and an unknown session gets none
+    def test_sessions(self):
+        registry = GridRegistry()
+        first = registry.put('a', self.make_grid())
+        registry.put('b', self.make_grid())
+        first.grid.update()
+        self.assertEqual(registry.get('a').grid.generation, 1)
+        self.assertEqual(registry.get('b').grid.generation, 0)
+        self.assertIsNone(registry.get('c'))
+        self.assertEqual(registry.stats()['sessions'], 2)
+
+    # Test the least recently used grids go first once the memory limit is passed
+    def test_lru_eviction(self):
+        size = self.make_grid().memory_usage()
+        registry = GridRegistry(max_bytes=2 * size)
+        registry.put('a', self.make_grid())
+        registry.put('b', self.make_grid())
+        registry.get('a')
+        registry.put('c', self.make_grid())
+        self.assertIsNone(registry.get('b'))
+        self.assertIsNotNone(registry.get('a'))
+        self.assertIsNotNone(registry.get('c'))
+        stats = registry.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertLessEqual(stats['bytes'], stats['max_bytes'])
+
+    # Test a session in use is not evicted, even over the limit
+    def test_busy_not_evicted(self):
+        registry = GridRegistry(max_bytes=1)
+        busy = registry.put('a', self.make_grid())
+        with busy.lock:
+            thread = threading.Thread(target=registry.put, args=('b', self.make_grid()))
+            thread.start()
+            thread.join()
+        self.assertIs(registry.get('a'), busy)
+
+    # Test an evicted grid is spilled and comes back where it was, with the same next generations
+    def test_spill_and_rehydrate(self):
+        store = self.DictStore()
+        registry = GridRegistry(max_bytes=1, store=store)
+        session = registry.put('a', self.make_grid())
+        session.grid.update()
+        expected = session.grid.copy()
+        registry.put('b', self.make_grid())
+        self.assertEqual(store.count(), 1)
+
+        grid = registry.get('a').grid
+        self.assertEqual(grid.generation, 1)
+        self.assertEqual(grid.edited_rules, expected.edited_rules)
+        for _ in range(3):
+            grid.update()
+            expected.update()
+            self.assertTrue(np.array_equal(grid.state, expected.state))
+            self.assertTrue(np.array_equal(grid.colour_state, expected.colour_state))
+        stats = registry.stats()
+        self.assertEqual((stats['spills'], stats['rehydrations']), (2, 1))
+
+    # Test a session evicted between get and taking its lock is marked, and comes back with its changes
+    def test_evicted_before_lock(self):
+        store = self.DictStore()
+        registry = GridRegistry(max_bytes=1, store=store)
+        session = registry.put('a', self.make_grid())
+        session.grid.update()
+        stale = registry.get('a')
+        registry.put('b', self.make_grid())
+        with stale.lock:
+            self.assertTrue(stale.evicted)
+        session = registry.get('a')
+        self.assertFalse(session.evicted)
+        self.assertEqual(session.grid.generation, 1)
+
+    # Test grids are spilled without holding the registry lock, and a get during the spill waits for it
+    def test_spill_outside_lock(self):
+        test = self
+        spilled = threading.Event()
+
+        class SlowStore(self.DictStore):
+            def save(self, session_id, grid):
+                test.assertFalse(registry.lock.locked())
+                if spilled.is_set():
+                    return super().save(session_id, grid)
+                thread = threading.Thread(target=lambda: results.append(registry.get(session_id)))
+                thread.start()
+                thread.join(0.1)
+                test.assertEqual(results, [])
+                super().save(session_id, grid)
+                spilled.set()
+                threads.append(thread)
+
+        results, threads = [], []
+        registry = GridRegistry(max_bytes=1, store=SlowStore())
+        registry.put('a', self.make_grid()).grid.update()
+        registry.put('b', self.make_grid())
+        self.assertTrue(spilled.is_set())
+        threads[0].join()
+        self.assertEqual(results[0].grid.generation, 1)
+
+    # Test a spill older than the store keeps them is not loaded back, the session starts again
+    def test_expired_spill(self):
+        from storage import GridStore, TestStorage
+        store = GridStore(TestStorage.DictCollection(), TestStorage.DictFS(), max_age=60)
+        registry = GridRegistry(max_bytes=1, store=store)
+        registry.put('a', self.make_grid())
+        registry.put('b', self.make_grid())
+        store.collection.documents['a']['saved_at'] -= 120
+        self.assertIsNone(registry.get('a'))
+        self.assertEqual(store.count(), 0)
+
+    # Test replacing the grid of a session stops what was computed for the old one
+    def test_put_stops_playback(self):
+        from playback import LookAhead
+        registry = GridRegistry()
+        session = registry.put('a', self.make_grid())
+        session.lookahead = LookAhead(session.grid, depth=2)
+        lookahead = session.lookahead
+        self.assertIs(registry.put('a', self.make_grid(4)), session)
+        self.assertIsNone(session.lookahead)
+        self.assertFalse(lookahead.running)
+        self.assertEqual(session.grid.size, 4)
+
+
+# Bytes of grids kept in memory by default before the least recently used ones are evicted
+MAX_BYTES = 512 * 1024 * 1024
+
+
+# A client's grid with what is playing it. The lock is held while the grid is read or changed
+class Session:
+    def __init__(self, session_id, grid):
+        self.id = session_id
+        self.grid = grid
+        # Background producer filling a buffer of generations while the client plays
+        self.lookahead = None
+        # Open /stream connections by id
+        self.streams = {}
+        self.lock = threading.RLock()
+        # Set once the registry has dropped the session. Whoever was waiting for its lock should get the
+        # session again, its grid is in the store by the time the lock is released
+        self.evicted = False
+
+    # Drops the generations computed ahead and ends the streams, they are wrong once the grid or its rules change
+    def stop_playback(self):
+        if self.lookahead is not None:
+            self.lookahead.stop()
+            self.lookahead = None
+        for stream in list(self.streams.values()):
+            stream.stop()
+        # The streams no longer carry the grid on from what they sent
+        self.streams.clear()
+
+    # The grid, its history, its cycle detection, its octree, the surface sent of it and the copies stepped ahead
+    # of it for playback
+    def memory_usage(self):
+        size = self.grid.memory_usage()
+        if self.grid.octree is not None:
+            size += self.grid.octree.memory_usage()
+        if self.grid.surface is not None:
+            size += self.grid.surface.memory_usage()
+        if self.grid.history is not None:
+            size += self.grid.history.memory_usage()
+        if self.grid.cycles is not None:
+            size += self.grid.cycles.memory_usage()
+        if self.lookahead is not None:
+            size += self.grid.memory_usage() * (1 + len(self.lookahead.frames))
+        return size + 2 * self.grid.memory_usage() * len(self.streams)
+
+
+# Grids by session id, the least recently used ones are evicted once they take more than max_bytes.
+# Evicted grids are spilled to the store when there is one and loaded back when their session returns
+class GridRegistry:
+    def __init__(self, max_bytes=MAX_BYTES, store=None):
+        self.max_bytes = max_bytes
+        self.store = store
+        self.sessions = OrderedDict()
+        # Evicted sessions whose grid is being written to the store, by id
+        self.spilling = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+        self.rehydrations = 0
+
+    # Session with the given id, None if it has no grid. The session may be evicted before its lock is taken,
+    # callers check Session.evicted once they hold it
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+                self.hits += 1
+                return session
+            spilling = self.spilling.get(session_id)
+        # The evicting thread holds the lock until the grid is in the store
+        if spilling is not None:
+            with spilling.lock:
+                pass
+
+        grid = self.store.load(session_id) if self.store is not None else None
+        with self.lock:
+            if grid is None:
+                self.misses += 1
+                return self.sessions.get(session_id)
+            # Another request may have loaded it in the meantime
+            if session_id in self.sessions:
+                return self.sessions[session_id]
+            session = self.sessions[session_id] = Session(session_id, grid)
+            self.rehydrations += 1
+        self.store.delete(session_id)
+        self.evict(keep=session_id)
+        return session
+
+    # Gives a session a new grid, stopping the playback of the old one
+    def put(self, session_id, grid):
+        while True:
+            with self.lock:
+                session = self.sessions.get(session_id)
+                if session is None:
+                    session = self.sessions[session_id] = Session(session_id, grid)
+                self.sessions.move_to_end(session_id)
+            with session.lock:
+                if session.evicted:
+                    # Spilled meanwhile, the spilled grid is replaced by this one
+                    if self.store is not None:
+                        self.store.delete(session_id)
+                    continue
+                session.stop_playback()
+                session.grid = grid
+            break
+        self.evict(keep=session_id)
+        return session
+
+    def memory_usage(self):
+        with self.lock:
+            return sum(session.memory_usage() for session in self.sessions.values())
+
+    # Evicts the least recently used sessions until the grids fit in max_bytes. Sessions being used or
+    # streaming are skipped. The victims are taken out under the registry lock but spilled outside it, each
+    # holding its own lock until its grid is in the store
+    def evict(self, keep=None):
+        victims = []
+        with self.lock:
+            total = sum(session.memory_usage() for session in self.sessions.values())
+            for session_id, session in list(self.sessions.items()):
+                if total <= self.max_bytes:
+                    break
+                if session_id == keep or session.streams or not session.lock.acquire(blocking=False):
+                    continue
+                total -= session.memory_usage()
+                session.evicted = True
+                del self.sessions[session_id]
+                self.evictions += 1
+                if self.store is not None:
+                    self.spilling[session_id] = session
+                victims.append(session)
+        for session in victims:
+            try:
+                session.stop_playback()
+                if self.store is not None:
+                    self.store.save(session.id, session.grid)
+                    with self.lock:
+                        self.spills += 1
+            finally:
+                with self.lock:
+                    if self.spilling.get(session.id) is session:
+                        del self.spilling[session.id]
+                session.lock.release()
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'sessions': len(self.sessions),
+                'bytes': sum(session.memory_usage() for session in self.sessions.values()),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'spills': self.spills,
+                'rehydrations': self.rehydrations,
+            }
+        if self.store is not None:
+            stats['spilled'] = self.store.count()
+        return stats
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,35 +1,92 @@
 let intervalId;
 let intervalTime = 1000; // Default interval time in milliseconds
 let scene, camera, renderer;
-let cubeGrid = [];
 let gridSize;
 let angle;
 let radius;
 
+// Live cells are drawn as instances of one cube and of its edges, slot i of both holds the same cell.
+// Only the cells whose type or colour changed since the last generation drawn are written
+const cubeGeometry = new THREE.BoxGeometry(1, 1, 1);
+const edgeGeometry = new THREE.EdgesGeometry(cubeGeometry);
+const cubeMaterial = new THREE.MeshBasicMaterial({ color: 0xffffff });
+const edgeMaterial = new THREE.ShaderMaterial({
+    vertexShader: `
+        attribute vec3 offset;
+        void main() {
+            gl_Position = projectionMatrix * modelViewMatrix * vec4(position + offset, 1.0);
+        }`,
+    fragmentShader: `
+        void main() {
+            gl_FragColor = vec4(0.0, 0.0, 0.0, 1.0);
+        }`
+});
+let cubes = null;
+let edges = null;
+let capacity = 0;
+let liveCount = 0;
+// Slot of each cell (-1 when it is not drawn) and cell of each slot
+let slotOfCell = null;
+let cellOfSlot = null;
+// Types and RGB colours of the cells drawn, in the flat order of the frames
+let shownSize = 0;
+let shownTypes = null;
+let shownColours = null;
+// Lowest and highest slot written since the last upload
+let dirtyLow = Infinity;
+let dirtyHigh = -1;
+let animating = false;
+const cellColour = new THREE.Color();
+
+// Binary frames from the server, only the changed cells are sent between generations
+let useBinary = true;
+// Only the cells that can be seen are sent, the ones closed in by their six face neighbours come as empty
+let useSurface = true;
+let generation = null;
+let frameTypes;
+let framePalette;
+let frameColours;
+
+// Generations received while playing but not shown yet, fetched playBatch at a time
+let playQueue = [];
+let playBatch = 4;
+let fetchingPlay = false;
+
+// Generations pushed by the server while playing, polling is only used without EventSource
+let eventSource = null;
+let streamId = null;
+let frameSize;
+let renderPending = false;
+
 // Initialise grid size, fetch initial state, and set up Three.js scene
 function initialiseGrid() {
     gridSize = parseInt(document.getElementById('grid-size').value);
-    fetchInitialState();
-    initialiseThreeJS();
     radius = gridSize * 2; // Radius for the camera's circular path
     angle = 0; 
+    fetchInitialState();
+    initialiseThreeJS();
 }
 
-// Set up Three.js renderer, scene, and camera
+// Set up Three.js renderer, scene, and camera. The renderer and its single render loop are kept
+// when the grid is initialised again, only the cells drawn are dropped
 function initialiseThreeJS() {
-    const gridContainer = document.getElementById('grid-container');
-    gridContainer.innerHTML = '';
-
-    scene = new THREE.Scene();
-    scene.background = new THREE.Color(0xffffff);
-    camera = new THREE.PerspectiveCamera(75, window.innerWidth / window.innerHeight, 0.1, 1000);
-    renderer = new THREE.WebGLRenderer({antialias : true});
-    renderer.setPixelRatio(window.devicePixelRatio);
-    renderer.setSize(window.innerWidth, window.innerHeight);
-    gridContainer.appendChild(renderer.domElement);
-    
-    camera.position.set(gridSize * 1.5, gridSize * 1.5, gridSize * 1.5);
-    camera.lookAt(new THREE.Vector3(((gridSize-1) / 2), ((gridSize-1) / 2), ((gridSize-1) / 2)));
+    if (!renderer) {
+        const gridContainer = document.getElementById('grid-container');
+        gridContainer.innerHTML = '';
+        scene = new THREE.Scene();
+        scene.background = new THREE.Color(0xffffff);
+        camera = new THREE.PerspectiveCamera(75, window.innerWidth / window.innerHeight, 0.1, 1000);
+        renderer = new THREE.WebGLRenderer({antialias : true});
+        renderer.setPixelRatio(window.devicePixelRatio);
+        renderer.setSize(window.innerWidth, window.innerHeight);
+        gridContainer.appendChild(renderer.domElement);
+    }
+    resetCells(0);
+    updateCameraPosition();
+    if (!animating) {
+        animating = true;
+        animate();
+    }
 }
 
 // Updates the camera position depending on the grid size
@@ -38,39 +95,147 @@ function updateCameraPosition() {
     camera.lookAt(new THREE.Vector3(((gridSize-1) / 2), ((gridSize-1) / 2), ((gridSize-1) / 2)));
 }
 
-// Create cubes in 3D based on the cell state array
-function createGrid(state) {
+// Forgets the cells drawn, for a grid of a new size
+function resetCells(size) {
+    const count = size * size * size;
+    shownSize = size;
+    shownTypes = new Uint8Array(count);
+    shownColours = new Uint32Array(count);
+    slotOfCell = new Int32Array(count).fill(-1);
+    liveCount = 0;
+    if (cubes) {
+        cubes.count = 0;
+        edges.geometry.instanceCount = 0;
+    }
+}
 
-    cubeGrid = state.map((plane, x) => 
-        plane.map((row, y) => 
-            row.map((cell, z) => {
-                if (cell.cell_type > 0) {
-                    // Placing the cubes on the scene
-                    const geometry = new THREE.BoxGeometry(1, 1, 1);
-                    const material = new THREE.MeshBasicMaterial({ color: cell.colour });
-                    const cube = new THREE.Mesh(geometry, material);
-                    cube.position.set(x, y, z);
-                    scene.add(cube);
-
-                    // Adding borders to the cube
-                    const edges = new THREE.EdgesGeometry(geometry);
-                    const line = new THREE.LineSegments(edges, new THREE.LineBasicMaterial({ color: 0x000000 }));
-                    line.position.set(x, y, z);
-                    scene.add(line);
-
-                    return cube;
-                }
-                return null;
-            })
-        )
-    );
+// Makes room for at least the given number of instances, the slots in use are copied over
+function reserve(needed) {
+    if (needed <= capacity) return;
+    const newCapacity = Math.max(1024, 2 * needed);
+    const newCubes = new THREE.InstancedMesh(cubeGeometry, cubeMaterial, newCapacity);
+    newCubes.instanceColor = new THREE.InstancedBufferAttribute(new Float32Array(3 * newCapacity), 3);
+    newCubes.instanceMatrix.setUsage(THREE.DynamicDrawUsage);
+    newCubes.instanceColor.setUsage(THREE.DynamicDrawUsage);
+    // The instances are spread over the grid, the bounds of the cube at the origin would cull them
+    newCubes.frustumCulled = false;
 
+    const edgeInstances = new THREE.InstancedBufferGeometry();
+    edgeInstances.setAttribute('position', edgeGeometry.getAttribute('position'));
+    const offsets = new THREE.InstancedBufferAttribute(new Float32Array(3 * newCapacity), 3);
+    offsets.setUsage(THREE.DynamicDrawUsage);
+    edgeInstances.setAttribute('offset', offsets);
+    const newEdges = new THREE.LineSegments(edgeInstances, edgeMaterial);
+    newEdges.frustumCulled = false;
 
-    animate();
+    const newCellOfSlot = new Int32Array(newCapacity);
+    if (cubes) {
+        newCubes.instanceMatrix.array.set(cubes.instanceMatrix.array);
+        newCubes.instanceColor.array.set(cubes.instanceColor.array);
+        offsets.array.set(edges.geometry.getAttribute('offset').array);
+        newCellOfSlot.set(cellOfSlot);
+        scene.remove(cubes, edges);
+        cubes.dispose();
+        edges.geometry.dispose();
+    }
+    cubes = newCubes;
+    edges = newEdges;
+    cellOfSlot = newCellOfSlot;
+    capacity = newCapacity;
+    scene.add(cubes, edges);
+    // Every slot is uploaded to the new buffers
+    dirtyLow = 0;
+    dirtyHigh = Math.max(0, liveCount - 1);
+}
+
+function markDirty(slot) {
+    if (slot < dirtyLow) dirtyLow = slot;
+    if (slot > dirtyHigh) dirtyHigh = slot;
+}
+
+function setSlotColour(slot, colour) {
+    cellColour.setHex(colour);
+    cellColour.toArray(cubes.instanceColor.array, 3 * slot);
+    markDirty(slot);
+}
+
+// Puts a cell in the next free slot, its matrix only holds its position
+function addCell(cell, colour) {
+    reserve(liveCount + 1);
+    const slot = liveCount++;
+    const x = Math.floor(cell / (shownSize * shownSize));
+    const y = Math.floor(cell / shownSize) % shownSize;
+    const z = cell % shownSize;
+    const matrix = cubes.instanceMatrix.array;
+    matrix.fill(0, 16 * slot, 16 * slot + 16);
+    matrix[16 * slot] = matrix[16 * slot + 5] = matrix[16 * slot + 10] = matrix[16 * slot + 15] = 1;
+    matrix[16 * slot + 12] = x;
+    matrix[16 * slot + 13] = y;
+    matrix[16 * slot + 14] = z;
+    const offsets = edges.geometry.getAttribute('offset').array;
+    offsets[3 * slot] = x;
+    offsets[3 * slot + 1] = y;
+    offsets[3 * slot + 2] = z;
+    setSlotColour(slot, colour);
+    slotOfCell[cell] = slot;
+    cellOfSlot[slot] = cell;
+}
+
+// Moves the last slot into the slot of the removed cell so the slots in use stay packed
+function removeCell(cell) {
+    const slot = slotOfCell[cell];
+    const last = --liveCount;
+    if (slot !== last) {
+        const moved = cellOfSlot[last];
+        cubes.instanceMatrix.array.copyWithin(16 * slot, 16 * last, 16 * last + 16);
+        cubes.instanceColor.array.copyWithin(3 * slot, 3 * last, 3 * last + 3);
+        edges.geometry.getAttribute('offset').array.copyWithin(3 * slot, 3 * last, 3 * last + 3);
+        slotOfCell[moved] = slot;
+        cellOfSlot[slot] = moved;
+        markDirty(slot);
+    }
+    slotOfCell[cell] = -1;
+}
+
+// Sends the slots written since the last upload to the GPU
+function uploadCells() {
+    if (!cubes) return;
+    cubes.count = liveCount;
+    edges.geometry.instanceCount = liveCount;
+    if (dirtyHigh < dirtyLow) return;
+    const attributes = [cubes.instanceMatrix, cubes.instanceColor, edges.geometry.getAttribute('offset')];
+    for (const attribute of attributes) {
+        attribute.updateRange.offset = dirtyLow * attribute.itemSize;
+        attribute.updateRange.count = (dirtyHigh - dirtyLow + 1) * attribute.itemSize;
+        attribute.needsUpdate = true;
+    }
+    dirtyLow = Infinity;
+    dirtyHigh = -1;
+}
+
+// Draws a grid state ({size, types, colours} in the flat order of the frames), only the cells that
+// were born, died or changed colour since the last state drawn are written
+function createGrid(state) {
+    if (state.size !== shownSize) resetCells(state.size);
+    const types = state.types;
+    const colours = state.colours;
+    for (let i = 0; i < types.length; i++) {
+        if (types[i] === shownTypes[i] && colours[i] === shownColours[i]) continue;
+        const slot = slotOfCell[i];
+        if (types[i] > 0) {
+            if (slot < 0) addCell(i, colours[i]);
+            else setSlotColour(slot, colours[i]);
+        } else if (slot >= 0) {
+            removeCell(i);
+        }
+        shownTypes[i] = types[i];
+        shownColours[i] = colours[i];
+    }
+    uploadCells();
 }
 
 
-// Renderes scene and camera and updates the camera's position
+// Renderes scene and camera and updates the camera's position, the one loop runs for the life of the page
 function animate() {
 
     // Update the camera's position in a circular path around the grid
@@ -90,50 +255,284 @@ function animate() {
     renderer.render(scene, camera);
 }
 
+// Reads a binary frame (see wire.py) into the current types and colour indices
+function applyFrame(buffer) {
+    const view = new DataView(buffer);
+    const kind = view.getUint8(5);
+    const size = view.getUint16(6, true);
+    const paletteLength = view.getUint16(12, true);
+    let offset = 16;
+    framePalette = new Uint32Array(buffer, offset, paletteLength);
+    offset += 4 * paletteLength;
+
+    if (kind === 0) {
+        const count = size * size * size;
+        frameTypes = new Uint8Array(buffer, offset, count).slice();
+        frameColours = new Uint8Array(buffer, offset + count, count).slice();
+    } else if (kind === 2) {
+        // Bit mask of the non-empty cells, then their types and colours
+        const cells = size * size * size;
+        const mask = new Uint8Array(buffer, offset, Math.ceil(cells / 8));
+        let count = 0;
+        for (let i = 0; i < mask.length; i++) {
+            for (let bits = mask[i]; bits; bits &= bits - 1) count++;
+        }
+        const types = new Uint8Array(buffer, offset + mask.length, count);
+        const colours = new Uint8Array(buffer, offset + mask.length + count, count);
+        frameTypes = new Uint8Array(cells);
+        frameColours = new Uint8Array(cells);
+        let n = 0;
+        for (let i = 0; i < mask.length; i++) {
+            for (let bit = 0; bit < 8; bit++) {
+                if (mask[i] & (1 << bit)) {
+                    frameTypes[8 * i + bit] = types[n];
+                    frameColours[8 * i + bit] = colours[n++];
+                }
+            }
+        }
+    } else {
+        const count = view.getUint32(offset, true);
+        offset += 4;
+        const indices = new Uint32Array(buffer, offset, count);
+        const types = new Uint8Array(buffer, offset + 4 * count, count);
+        const colours = new Uint8Array(buffer, offset + 5 * count, count);
+        for (let i = 0; i < count; i++) {
+            frameTypes[indices[i]] = types[i];
+            frameColours[indices[i]] = colours[i];
+        }
+    }
+    generation = view.getUint32(8, true);
+    frameSize = size;
+    return size;
+}
+
+// Copies the current frame into a state for createGrid, with the RGB colour of every cell
+function frameState(size) {
+    const colours = new Uint32Array(frameTypes.length);
+    for (let i = 0; i < colours.length; i++) {
+        colours[i] = framePalette[frameColours[i]];
+    }
+    return { size: size, types: frameTypes.slice(), colours: colours };
+}
+
+// Flattens the nested JSON list of cells into a state for createGrid, surface states only list the cells seen
+function jsonState(cells) {
+    if (cells.indices) {
+        const count = cells.size * cells.size * cells.size;
+        const types = new Uint8Array(count);
+        const colours = new Uint32Array(count);
+        cells.indices.forEach((cell, i) => {
+            types[cell] = cells.types[i];
+            colours[cell] = cells.colours[i];
+        });
+        return { size: cells.size, types: types, colours: colours };
+    }
+    const size = cells.length;
+    const types = new Uint8Array(size * size * size);
+    const colours = new Uint32Array(size * size * size);
+    let i = 0;
+    for (const plane of cells) {
+        for (const row of plane) {
+            for (const cell of row) {
+                types[i] = cell.cell_type;
+                colours[i++] = cell.colour;
+            }
+        }
+    }
+    return { size: size, types: types, colours: colours };
+}
+
+// Sends a request for a grid state and reads the JSON or binary answer
+async function fetchState(url, body) {
+    if (useBinary) {
+        body = Object.assign({ format: 'binary', generation: generation }, body);
+    }
+    body = Object.assign({ surface: useSurface }, body);
+    const response = await fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(body)
+    });
+    if (!response.ok) {
+        const error = await response.json();
+        throw new Error(error.error);
+    }
+    if (response.headers.get('Content-Type') === 'application/octet-stream') {
+        const size = applyFrame(await response.arrayBuffer());
+        return frameState(size);
+    }
+    return jsonState(await response.json());
+}
+
+// Sends a request for several generations, returns the list of states
+async function fetchStates(url, body) {
+    if (useBinary) {
+        body = Object.assign({ format: 'binary', generation: generation }, body);
+    }
+    body = Object.assign({ surface: useSurface }, body);
+    const response = await fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(body)
+    });
+    if (!response.ok) {
+        const error = await response.json();
+        throw new Error(error.error);
+    }
+    if (response.headers.get('Content-Type') === 'application/octet-stream') {
+        const buffer = await response.arrayBuffer();
+        const view = new DataView(buffer);
+        const states = [];
+        let offset = 0;
+        while (offset < buffer.byteLength) {
+            const length = view.getUint32(offset, true);
+            const size = applyFrame(buffer.slice(offset + 4, offset + 4 + length));
+            states.push(frameState(size));
+            offset += 4 + length;
+        }
+        return states;
+    }
+    const result = await response.json();
+    return result.states.map(jsonState);
+}
+
 // Fetch the initial grid state from the server via POST
 async function fetchInitialState() {
     try {
-        const response = await fetch('/initial_state', {
+        generation = null;
+        const initialState = await fetchState('/initial_state', { size: gridSize });
+        createGrid(initialState);
+        restartPlaying();
+    } catch (error) {
+        console.error('Error:', error);
+    }
+}
+
+// Advance the automaton by one generation
+async function next() {
+    try {
+        const newState = await fetchState('/next', { size: gridSize });
+        createGrid(newState);
+    } catch (error) {
+        console.error('Error:', error);
+    }
+}
+
+// Shows the next generation while playing, fetching a batch of them when none are left
+async function playStep() {
+    if (playQueue.length === 0) {
+        if (fetchingPlay) return;
+        fetchingPlay = true;
+        try {
+            playQueue = await fetchStates('/next', { size: gridSize, steps: playBatch });
+        } catch (error) {
+            console.error('Error:', error);
+        } finally {
+            fetchingPlay = false;
+        }
+        if (playQueue.length === 0) return;
+    }
+    createGrid(playQueue.shift());
+}
+
+// Opens a server-sent event stream of generations at the current speed
+function startStream() {
+    eventSource = new EventSource(`/stream?format=binary&surface=${useSurface}&rate=${1000 / intervalTime}`);
+    eventSource.addEventListener('start', (event) => {
+        streamId = JSON.parse(event.data).id;
+    });
+    eventSource.addEventListener('frame', (event) => {
+        const bytes = Uint8Array.from(atob(event.data), (c) => c.charCodeAt(0));
+        applyFrame(bytes.buffer);
+        // Every frame is applied but only the newest one is drawn
+        if (!renderPending) {
+            renderPending = true;
+            requestAnimationFrame(renderStream);
+        }
+    });
+}
+
+function renderStream() {
+    renderPending = false;
+    createGrid(frameState(frameSize));
+}
+
+// Sends a rate change or a stop to the open stream
+async function controlStream(body) {
+    if (!streamId) return;
+    try {
+        await fetch(`/stream/${streamId}`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({ size: gridSize })
+            body: JSON.stringify(body)
         });
-        const initialState = await response.json();
-        createGrid(initialState);
     } catch (error) {
         console.error('Error:', error);
     }
 }
 
-// Advance the automaton by one generation
-async function next() {
+function stopStream() {
+    if (!eventSource) return;
+    eventSource.close();
+    eventSource = null;
+    controlStream({ stop: true });
+    streamId = null;
+}
+
+// Tells the server to compute generations ahead while playing
+async function setPlaying(playing) {
     try {
-        const response = await fetch('/next', {
+        await fetch('/play', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({ size: gridSize })
+            body: JSON.stringify({ playing: playing })
         });
-        const newState = await response.json();
-        scene.clear();
-        createGrid(newState);
     } catch (error) {
         console.error('Error:', error);
     }
 }
 
+function isPlaying() {
+    return document.getElementById('play-stop-button').textContent === 'Stop';
+}
+
 // Play or stop the automatic progression
 function togglePlay() {
     const playStopButton = document.getElementById('play-stop-button');
     if (playStopButton.textContent === 'Play') {
         playStopButton.textContent = 'Stop';
-        intervalId = setInterval(next, intervalTime);
+        if (window.EventSource) {
+            startStream();
+        } else {
+            setPlaying(true);
+            intervalId = setInterval(playStep, intervalTime);
+        }
     } else {
         playStopButton.textContent = 'Play';
+        stopStream();
         clearInterval(intervalId);
+        playQueue = [];
+        setPlaying(false);
+    }
+}
+
+// Starts playing again after the grid or the rules changed on the server
+function restartPlaying() {
+    playQueue = [];
+    if (!isPlaying()) return;
+    if (eventSource) {
+        stopStream();
+        startStream();
+    } else {
+        setPlaying(true);
     }
 }
 
@@ -143,9 +542,11 @@ function updateSpeed(value) {
     intervalTime = value * 1000;
     document.getElementById('speed-value').textContent = value + 's';
     const playStopButton = document.getElementById('play-stop-button');
-    if (intervalId && playStopButton.textContent === 'Stop') {
+    if (eventSource) {
+        controlStream({ rate: 1000 / intervalTime });
+    } else if (intervalId && playStopButton.textContent === 'Stop') {
         clearInterval(intervalId);
-        intervalId = setInterval(next, intervalTime);
+        intervalId = setInterval(playStep, intervalTime);
     }
 }
 
@@ -169,28 +570,46 @@ async function saveGrid() {
     }
 }
 
+// Lists the saved grids in the load prompt, and has the server decode the first few meanwhile
+async function savedGrids() {
+    try {
+        const response = await fetch('/grids?limit=50');
+        const grids = (await response.json()).grids || [];
+        const names = grids.map(grid => grid.name);
+        fetch('/grids/prefetch', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ names: names.slice(0, 5) })
+        }).catch(() => {});
+        return grids.map(grid => {
+            const live = Object.values(grid.population || {}).reduce((a, b) => a + b, 0);
+            return `${grid.name} (${grid.size}³ ${grid.rule_type}${grid.population ? ', ' + live + ' cells' : ''})`;
+        });
+    } catch (error) {
+        console.error('Listing error:', error);
+        return [];
+    }
+}
+
 // Load grid state from uploaded file
 async function loadGrid() {
-    const filename = prompt("Enter the filename to load:", "grid_state");
+    const grids = await savedGrids();
+    const listed = grids.length ? "Saved grids:\n" + grids.join("\n") + "\n\n" : "";
+    const filename = prompt(listed + "Enter the filename to load:", "grid_state");
     if (!filename) return;
 
     try {
-        const response = await fetch('/load', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ filename })
-        });
-        
-        const newState = await response.json();
+        generation = null;
+        const newState = await fetchState('/load', { filename });
         
         // Update grid size based on loaded data
-        gridSize = newState.length;
+        gridSize = newState.size;
         document.getElementById('grid-size').value = gridSize;
-        
-        // Clear the scene and create new grid
-        scene.clear();
+        radius = gridSize * 2;
+
         createGrid(newState);
         updateCameraPosition();
+        restartPlaying();
         
         console.log('Grid loaded successfully');
     } catch (err) {
@@ -203,10 +622,11 @@ async function loadGrid() {
 // Prompt user to edit automaton rules and send to server
 async function editRules() {
     try {
-    const newrules = prompt(`Rule explanation X/Y/A where:
-X - number of neighbours to stay alive
-Y - number of neighbours to get alive
-Z - neighbourhood type (N - Moore, M - Von Neumann)`, "3/3/M");
+    const newrules = prompt(`Rule explanation X/Y/Z or X/Y/C/Z where:
+X - numbers of neighbours to stay alive (e.g. 2,3 or 4-6)
+Y - numbers of neighbours to get alive
+C - number of states, live cells decay through C - 2 states before dying (optional)
+Z - neighbourhood type and radius (M - Moore, N - Von Neumann, e.g. M2)`, "3/3/M");
 
     const response = await fetch('/edit-rules', {
         method: 'POST',
@@ -215,6 +635,9 @@ Z - neighbourhood type (N - Moore, M - Von Neumann)`, "3/3/M");
         },
         body: JSON.stringify({ rules: newrules })
     });
+
+    // The generations fetched ahead were computed with the old rules
+    restartPlaying();
     } catch (error) {
         console.error('Error:', error);
     }
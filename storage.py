@@ -0,0 +1,718 @@
+import hashlib
+import io
+import json
+import numpy as np
+import re
+import threading
+import time
+import unittest
+import zlib
+from bricks import CACHE_BYTES as BRICK_CACHE_BYTES, BrickGrid
+from bson import Binary
+from collections import OrderedDict
+from grid import Grid
+from hashlife import Universe
+from history import History, pack_history, unpack_history
+
+
+class TestStorage(unittest.TestCase):
+
+    # Collection and GridFS kept in dicts, with the few methods the store uses
+    class DictCollection:
+        def __init__(self):
+            self.documents = {}
+            self.indexes = []
+
+        # Previous documents are returned with the projected fields only, as MongoDB does
+        def find_one_and_replace(self, query, document, projection=None, upsert=False):
+            previous = self.documents.get(query['name'])
+            self.documents[query['name']] = dict(document)
+            return self.project(previous, projection)
+
+        def find_one(self, query):
+            return self.documents.get(query['name'])
+
+        def find_one_and_delete(self, query, projection=None):
+            document = self.documents.get(query['name'])
+            if document is None or not self.matches(document, query):
+                return None
+            return self.project(self.documents.pop(query['name']), projection)
+
+        def project(self, document, projection):
+            if document is None or projection is None:
+                return document
+            return {field: document[field] for field in document if projection.get(field)}
+
+        def count_documents(self, query):
+            return len(self.documents)
+
+        def create_index(self, key, unique=False):
+            self.indexes.append((key, unique))
+
+        # Names given, or matched by $in or $regex, and saved_at not $gte a time
+        def matches(self, document, query):
+            name = query.get('name', {'$regex': ''})
+            if isinstance(name, str):
+                found = document['name'] == name
+            else:
+                found = document['name'] in name['$in'] if '$in' in name else re.match(name['$regex'], document['name'])
+            if 'saved_at' in query:
+                found = found and not document.get('saved_at', float('-inf')) >= query['saved_at']['$not']['$gte']
+            return bool(found)
+
+        # Documents in name order, the projection only keeps the fields set to True
+        def find(self, query=None, projection=None, skip=0, limit=0, sort=None):
+            documents = [document for key, document in sorted(self.documents.items())
+                         if self.matches(dict(document, name=key), query or {})]
+            documents = documents[skip:skip + limit if limit else None]
+            return [self.project(document, projection) for document in documents]
+
+    class DictFS:
+        def __init__(self):
+            self.files = {}
+            self.last_id = 0
+
+        def put(self, data, filename=None):
+            self.last_id += 1
+            file_id = self.last_id
+            self.files[file_id] = data
+            return file_id
+
+        def new_file(self, filename=None):
+            return TestStorage.DictFile(self)
+
+        def get(self, file_id):
+            return io.BytesIO(self.files[file_id])
+
+        def delete(self, file_id):
+            del self.files[file_id]
+
+    # File written piece by piece into a DictFS, like a GridIn
+    class DictFile(io.BytesIO):
+        def __init__(self, fs):
+            super().__init__()
+            self.fs = fs
+            self._id = None
+
+        def close(self):
+            if self._id is None:
+                self._id = self.fs.put(self.getvalue())
+            super().close()
+
+    def setUp(self):
+        size = 6
+        state = [[[1 if (x + y + z) % 3 == 0 else 0 for z in range(size)] for y in range(size)] for x in range(size)]
+        self.grid = Grid(size, state, {0: 0, 1: 0xff0000})
+        self.grid.edited_rules = [[2, 3], [2], 'M']
+        self.grid.update()
+
+    def assertSameGrid(self, grid, expected):
+        self.assertEqual(grid.size, expected.size)
+        self.assertEqual(grid.generation, expected.generation)
+        self.assertEqual(grid.edited_rules, expected.edited_rules)
+        self.assertEqual((grid.radius, grid.states, grid.kernel), (expected.radius, expected.states, expected.kernel))
+        for name in ('state', 'colour_state', 'heights'):
+            self.assertTrue(np.array_equal(getattr(grid, name), getattr(expected, name)))
+
+    # Test a Generations rule with a kernel comes back with its decaying cells
+    def test_generations_round_trip(self):
+        kernel = np.ones((3, 3, 3), dtype=int)
+        kernel[1, 1, 1] = 0
+        self.grid.edit_rules([[4, 5], [2], 'K'], states=5, kernel=kernel)
+        self.grid.update()
+        grid = unpack_grid(*pack_grid(self.grid))
+        self.assertSameGrid(grid, self.grid)
+        grid.update()
+        self.grid.update()
+        self.assertSameGrid(grid, self.grid)
+        self.assertGreater(np.count_nonzero(grid.state >= 2), 0)
+
+    # Test a packed grid comes back as it was and steps the same way
+    def test_pack_round_trip(self):
+        document, blob = pack_grid(self.grid)
+        self.assertEqual(document['shape'], [6, 6, 6])
+        self.assertLess(len(blob), self.grid.memory_usage())
+        grid = unpack_grid(document, blob)
+        self.assertSameGrid(grid, self.grid)
+        grid.update()
+        self.grid.update()
+        self.assertSameGrid(grid, self.grid)
+
+    # Test a grid stepped by the octree is still stepped by it once loaded
+    def test_octree_round_trip(self):
+        self.grid.octree = Universe.from_grid(self.grid, 1024 * 1024)
+        grid = unpack_grid(*pack_grid(self.grid))
+        self.assertEqual(grid.octree.max_bytes, 1024 * 1024)
+        grid.update()
+        self.grid.update()
+        self.assertSameGrid(grid, self.grid)
+
+    # Test a trees grid keeps its random generator, so it grows the same afterwards
+    def test_tree_round_trip(self):
+        state = np.zeros((5, 5, 5), dtype=int)
+        state[2, 0, 2] = 2
+        grid = Grid(5, state.tolist(), {t: 0x00ff00 for t in range(13)}, predefined_update=1, seed=3)
+        grid.update()
+        restored = unpack_grid(*pack_grid(grid))
+        for _ in range(3):
+            grid.update()
+            restored.update()
+            self.assertSameGrid(restored, grid)
+
+    # Test small blobs stay in the document and large ones go to GridFS, which is cleaned up on replace
+    def test_store(self):
+        store = GridStore(self.DictCollection(), self.DictFS(), limit=10)
+        self.assertTrue(store.save('big', self.grid))
+        self.assertNotIn('blob', store.collection.documents['big'])
+        self.assertEqual(len(store.fs.files), 1)
+        self.assertSameGrid(store.load('big'), self.grid)
+        store.limit = DOCUMENT_LIMIT
+        self.assertFalse(store.save('big', self.grid))
+        self.assertIn('blob', store.collection.documents['big'])
+        self.assertEqual(store.fs.files, {})
+        self.assertSameGrid(store.load('big'), self.grid)
+        self.assertIsNone(store.load('missing'))
+        store.delete('big')
+        self.assertEqual(store.count(), 0)
+
+    # Test a recorded history is saved with the grid and can be sought after loading
+    def test_history(self):
+        store = GridStore(self.DictCollection(), self.DictFS(), limit=200)
+        self.grid.history = History()
+        self.grid.history.record(self.grid)
+        expected = self.grid.copy()
+        for _ in range(4):
+            self.grid.update()
+        store.save('history', self.grid)
+        self.assertIn('history_blob_id', store.collection.documents['history'])
+        self.assertNotIn('history_blob', store.collection.documents['history'])
+        grid = store.load('history')
+        self.assertEqual((grid.history.first, grid.history.last), (1, 5))
+        grid.history.seek(grid, 1)
+        self.assertSameGrid(grid, expected)
+        store.save('history', grid, history=False)
+        self.assertIsNone(store.load('history').history)
+        self.assertEqual(store.fs.files, {})
+
+    # Test a brick grid is saved brick by brick, to GridFS or in the document, and loads back without its empty bricks
+    def test_bricks(self):
+        self.grid.edit_rules([[4, 5], [4], 'M'], states=3)
+        self.grid.update()
+        for fs in (self.DictFS(), None):
+            store = GridStore(self.DictCollection(), fs)
+            with BrickGrid.from_grid(self.grid, brick=4) as bricks:
+                bricks.set_region((0, 0, 0), np.zeros((4, 6, 6), dtype=np.uint8), np.zeros((4, 6, 6), dtype=np.uint8))
+                store.save_bricks('bricks', bricks)
+                document = store.collection.documents['bricks']
+                self.assertEqual(document['format'], 'bricks')
+                self.assertEqual(('blob_id' in document, 'blob' in document), (fs is not None, fs is None))
+                with store.load('bricks', brick_cache=2 * 4 ** 3) as loaded:
+                    self.assertEqual(loaded.stored(), bricks.stored())
+                    self.assertLess(loaded.stored(), 8)
+                    self.assertEqual((loaded.generation, loaded.states), (self.grid.generation, 3))
+                    expected, expected_colours = bricks.arrays()
+                    types, colours = loaded.arrays()
+                    self.assertTrue(np.array_equal(types, expected))
+                    self.assertTrue(np.array_equal(colours, expected_colours))
+                    self.assertSameGrid(loaded.to_grid(), bricks.to_grid())
+                with self.assertRaises(GridTooLarge):
+                    store.load('bricks', max_brick_size=5)
+                packed, _ = pack_grid(bricks.to_grid())
+                self.assertEqual((document['population'], document['thumbnail']),
+                                 (packed['population'], packed['thumbnail']))
+            store.delete('bricks')
+            self.assertEqual(fs.files if fs is not None else {}, {})
+
+    # Test the listing reads the metadata of the saved grids only, by prefix, the legacy ones too
+    def test_list(self):
+        store = GridStore(self.DictCollection(), self.DictFS())
+        store.save('life/a', self.grid)
+        store.save('life/b', self.grid.copy())
+        with open('trees.json') as f:
+            document = json.load(f)[0]
+        store.collection.documents[document['name']] = document
+        self.assertEqual(store.collection.indexes, [('name', True)])
+        entries = store.list()
+        self.assertEqual([entry['name'] for entry in entries], sorted([document['name'], 'life/a', 'life/b']))
+        self.assertTrue(all(set(entry) == set(LISTING) for entry in entries))
+        self.assertEqual(store.list(skip=1, limit=1), entries[1:2])
+        a, b = store.list('life/')
+        self.assertEqual((a['name'], a['rule_type'], a['format']), ('life/a', 'life', 'packed'))
+        self.assertEqual(a['population'], {'1': int(np.count_nonzero(self.grid.state == 1))})
+        self.assertEqual(a['thumbnail'], b['thumbnail'])
+        self.grid.update()
+        store.save('life/b', self.grid)
+        self.assertNotEqual(store.list('life/b')[0]['thumbnail'], a['thumbnail'])
+        legacy = store.list(document['name'])[0]
+        self.assertEqual((legacy['rule_type'], legacy['format'], legacy['population']), ('tree', 'cells', None))
+
+    # Test a loaded grid is cached as saved, copied out, and dropped when saved again or over the limit
+    def test_cache(self):
+        store = GridStore(self.DictCollection(), cache=GridCache())
+        store.save('cached', self.grid)
+        expected = self.grid.copy()
+        store.load('cached').update()
+        del store.collection.documents['cached']
+        self.assertSameGrid(store.load('cached'), expected)
+        self.assertEqual(store.cache.stats()['hits'], 1)
+        self.grid.update()
+        store.save('cached', self.grid)
+        self.assertSameGrid(store.load('cached'), self.grid)
+        store.save('other', expected)
+        self.assertEqual(store.prefetch(['cached', 'other', 'missing']), 1)
+        self.assertEqual(store.cache.stats()['grids'], 2)
+        store.cache.max_bytes = self.grid.memory_usage()
+        store.cache.put('last', expected)
+        self.assertEqual(list(store.cache.grids), ['last'])
+
+    # Test documents older than max_age are not loaded, and are swept with their blobs by a later save
+    def test_expire(self):
+        store = GridStore(self.DictCollection(), self.DictFS(), limit=10, max_age=60)
+        store.save('old', self.grid)
+        store.save('older', self.grid)
+        self.assertIn(('saved_at', False), store.collection.indexes)
+        for name in ('old', 'older'):
+            store.collection.documents[name]['saved_at'] -= 120
+        self.assertIsNone(store.load('old'))
+        self.assertNotIn('old', store.collection.documents)
+        self.assertEqual(len(store.fs.files), 1)
+        store.last_expired = 0
+        store.save('new', self.grid)
+        self.assertEqual(sorted(store.collection.documents), ['new'])
+        self.assertEqual(len(store.fs.files), 1)
+        self.assertSameGrid(store.load('new'), self.grid)
+
+    # Test documents with nested cells, like the trees.json seed, can still be loaded
+    def test_legacy_document(self):
+        with open('trees.json') as f:
+            document = json.load(f)[0]
+        store = GridStore(self.DictCollection())
+        store.collection.documents[document['name']] = document
+        grid = store.load(document['name'])
+        self.assertEqual(grid.size, document['size'])
+        self.assertEqual(grid.predefined_update, document['predefined_update'])
+        self.assertEqual(grid.state.tolist(), document['cells'])
+
+
+# Packed blobs larger than this go to GridFS, leaving room under the 16 MB document limit
+DOCUMENT_LIMIT = 15 * 1024 * 1024
+# Arrays in a packed blob, one after the other
+ARRAYS = ('state', 'colour_index', 'heights')
+# zlib level of the blobs, higher levels take several times longer on busy grids for a third less space
+COMPRESSION_LEVEL = 1
+# Blocks a side of the coarse occupancy the thumbnail hash of a grid is taken over
+THUMBNAIL = 8
+# Bytes of decoded grids the cache of saved grids keeps
+CACHE_BYTES = 64 * 1024 * 1024
+# Fields of the documents read to list the saved grids, never their cells
+LISTING = ('name', 'size', 'format', 'rule_type', 'predefined_update', 'edited_rules', 'states', 'generation',
+           'population', 'thumbnail')
+# Most saved grids listed at once
+LIST_LIMIT = 1000
+# Seconds between two sweeps of the documents saved longer ago than the store keeps them
+EXPIRE_INTERVAL = 10 * 60
+
+
+# Kind of rule stepping a grid, named as in the step metrics
+def rule_type(predefined_update):
+    return {0: 'life', 1: 'tree'}.get(predefined_update, 'cells')
+
+
+# Population by cell type and coarse occupancy of a grid, added a block of cells at a time so the bricks of
+# a grid larger than memory are summed one by one. Grids that look the same at THUMBNAIL³ blocks have the
+# same thumbnail hash, so the client draws a thumbnail once for them
+class Summary:
+    def __init__(self, size):
+        self.size = size
+        self.block = -(-size // THUMBNAIL)
+        self.counts = np.zeros(256, dtype=np.int64)
+        self.occupied = np.zeros((THUMBNAIL,) * 3, dtype=bool)
+
+    # Adds the cell types of a block with its lowest corner at origin, the part past the grid is left out
+    def add(self, types, origin=(0, 0, 0)):
+        types = types[tuple(slice(0, self.size - start) for start in origin)]
+        self.counts += np.bincount(types.ravel(), minlength=256)
+        occupied = types != 0
+        blocks = []
+        for axis, (start, length) in enumerate(zip(origin, types.shape)):
+            block = (start + np.arange(length)) // self.block
+            firsts = np.flatnonzero(np.diff(block, prepend=-1))
+            occupied = np.logical_or.reduceat(occupied, firsts, axis=axis)
+            blocks.append(block[firsts])
+        self.occupied[np.ix_(*blocks)] |= occupied
+        return self
+
+    # Fields listed with the saved grid, the population keys are strings for BSON
+    def metadata(self):
+        return {
+            'population': {str(cell_type): int(count) for cell_type, count in enumerate(self.counts)
+                           if cell_type and count},
+            'thumbnail': hashlib.blake2b(np.packbits(self.occupied).tobytes(), digest_size=8).hexdigest(),
+        }
+
+
+# Document holding what is needed to carry on stepping a grid, and its arrays packed and compressed
+def pack_grid(grid):
+    document = {
+        'format': 'packed',
+        'size': grid.size,
+        'shape': list(grid.state.shape),
+        'dtype': 'uint8',
+        'arrays': list(ARRAYS),
+        'compression': 'zlib',
+        'palette': list(grid.palette),
+        'colours': {str(cell_type): hex(colour) for cell_type, colour in grid.colours.items()},
+        'predefined_update': grid.predefined_update,
+        'rule_type': rule_type(grid.predefined_update),
+        'edited_rules': [list(grid.edited_rules[0]), list(grid.edited_rules[1]), grid.edited_rules[2]],
+        'radius': grid.radius,
+        'states': grid.states,
+        'kernel': grid.kernel,
+        'generation': grid.generation,
+        # Memory limit of the octree stepping the grid, None when the arrays step it
+        'octree_max_bytes': None if grid.octree is None else grid.octree.max_bytes,
+        # The generator state holds integers too large for BSON
+        'rng': json.dumps(grid.rng.bit_generator.state),
+    }
+    document.update(Summary(grid.size).add(grid.state).metadata())
+    blob = zlib.compress(b''.join(getattr(grid, name).astype(np.uint8).tobytes() for name in ARRAYS),
+                         COMPRESSION_LEVEL)
+    return document, blob
+
+
+def unpack_grid(document, blob):
+    shape = tuple(document['shape'])
+    arrays = np.frombuffer(zlib.decompress(blob), dtype=document['dtype'])
+    arrays = arrays.reshape((len(document['arrays']),) + shape)
+    grid = Grid(int(document['size']), np.zeros(shape, dtype=np.uint8), read_colours(document),
+                int(document['predefined_update']))
+    for name, array in zip(document['arrays'], arrays):
+        setattr(grid, name, array.copy())
+    grid.palette = list(document['palette'])
+    grid.edited_rules = list(document['edited_rules'])
+    grid.radius = int(document['radius'])
+    # Grids saved before Generations rules and kernels have two states and no kernel
+    grid.states = int(document.get('states', 2))
+    grid.kernel = document.get('kernel')
+    grid.generation = int(document['generation'])
+    grid.rng.bit_generator.state = json.loads(document['rng'])
+    if document.get('octree_max_bytes'):
+        grid.octree = Universe.from_grid(grid, int(document['octree_max_bytes']))
+    return grid
+
+
+# Document describing a brick grid, its bricks are listed and stored apart
+def brick_document(bricks):
+    return {
+        'format': 'bricks',
+        'size': bricks.size,
+        'brick': bricks.brick,
+        'compression': 'zlib',
+        'palette': list(bricks.palette),
+        'colours': {str(cell_type): hex(colour) for cell_type, colour in bricks.colours.items()},
+        'predefined_update': bricks.predefined_update,
+        'rule_type': rule_type(bricks.predefined_update),
+        'edited_rules': [list(bricks.edited_rules[0]), list(bricks.edited_rules[1]), bricks.edited_rules[2]],
+        'radius': bricks.radius,
+        'states': bricks.states,
+        'kernel': bricks.kernel,
+        'generation': bricks.generation,
+    }
+
+
+# Stored bricks compressed one at a time, so a grid larger than memory is never packed whole.
+# Each brick is its types then its colour indices, added to the summary on the way
+def packed_bricks(bricks, summary=None):
+    for key in sorted(bricks.index):
+        types, colours = bricks.brick_arrays(key)
+        if summary is not None:
+            summary.add(types, tuple(k * bricks.brick for k in key))
+        yield key, zlib.compress(types.tobytes() + colours.tobytes(), COMPRESSION_LEVEL)
+
+
+# Brick grid read brick by brick from a stream of compressed bricks, listed as x, y, z and length in the document
+def unpack_bricks(document, stream, cache_bytes=BRICK_CACHE_BYTES, directory=None):
+    bricks = BrickGrid(int(document['size']), read_colours(document), int(document['brick']), cache_bytes, directory)
+    bricks.palette = list(document['palette'])
+    bricks.edited_rules = list(document['edited_rules'])
+    bricks.radius, bricks.states = int(document['radius']), int(document['states'])
+    bricks.kernel = document.get('kernel')
+    bricks.generation = int(document['generation'])
+    shape = (2,) + (bricks.brick,) * 3
+    for x, y, z, length in np.frombuffer(bytes(document['bricks']), dtype=np.int32).reshape(-1, 4).tolist():
+        arrays = np.frombuffer(zlib.decompress(stream.read(length)), dtype=np.uint8).reshape(shape)
+        bricks.store((x, y, z), arrays[0], arrays[1])
+    return bricks
+
+
+# Handle colours - makes them integers, with a colour for the empty cell
+def read_colours(document):
+    colours = {int(k): int(v, 16) if v else 0 for k, v in document['colours'].items()}
+    colours.setdefault(0, 0)
+    return colours
+
+
+# Documents saved before the packed format, with the cell types as nested lists (possibly floats)
+def legacy_grid(document):
+    state = np.array(document['cells']).astype(np.uint8)
+    return Grid(int(document['size']), state, read_colours(document), int(document.get('predefined_update', 0)))
+
+
+# Entry of a saved grid in the listing. Documents saved before the metadata have no population or thumbnail
+def listing(document):
+    entry = {field: document.get(field) for field in LISTING}
+    entry['size'] = int(entry['size'])
+    entry['predefined_update'] = int(entry['predefined_update'] or 0)
+    entry['format'] = entry['format'] or 'cells'
+    entry['rule_type'] = entry['rule_type'] or rule_type(entry['predefined_update'])
+    return entry
+
+
+# Decoded saved grids by name, the least recently used ones are dropped past max_bytes. Grids go in and come
+# out as copies, so a session stepping a loaded grid leaves the cached one as it was saved. Only the saves and
+# deletes of this process invalidate it
+class GridCache:
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.grids = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.grids
+
+    # Copy of the cached grid, None if it is not cached
+    def get(self, name):
+        with self.lock:
+            grid = self.grids.get(name)
+            if grid is None:
+                self.misses += 1
+                return None
+            self.grids.move_to_end(name)
+            self.hits += 1
+        # Cached grids are never stepped, so they are copied outside the lock
+        return grid.copy()
+
+    def put(self, name, grid):
+        grid = grid.copy()
+        with self.lock:
+            self.grids[name] = grid
+            self.grids.move_to_end(name)
+            total = sum(cached.memory_usage() for cached in self.grids.values())
+            while total > self.max_bytes:
+                total -= self.grids.popitem(last=False)[1].memory_usage()
+
+    def discard(self, name):
+        with self.lock:
+            self.grids.pop(name, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'grids': len(self.grids),
+                'bytes': sum(grid.memory_usage() for grid in self.grids.values()),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+# Raised instead of decoding a grid saved as bricks larger than the caller can take
+class GridTooLarge(ValueError):
+    def __init__(self, name, size):
+        super().__init__(f"Grid '{name}' has {size}³ cells")
+        self.name = name
+        self.size = size
+
+
+# Grids saved by name in a MongoDB collection, with the blobs over limit in GridFS.
+# The generation history of a grid is saved with it in its own blob. With a cache, decoded grids are kept
+# so loading one again reads neither MongoDB nor its blob. With max_age, documents saved longer ago than
+# max_age seconds are never loaded and are deleted with their blobs by the saves, every EXPIRE_INTERVAL.
+# A TTL index would leave their GridFS blobs behind
+class GridStore:
+    BLOBS = ('blob', 'history_blob')
+
+    def __init__(self, collection, fs=None, limit=DOCUMENT_LIMIT, cache=None, max_age=None):
+        self.collection = collection
+        self.fs = fs
+        self.limit = limit
+        self.cache = cache
+        self.max_age = max_age
+        self.indexed = False
+        self.last_expired = 0
+
+    # Index on the names, created with the first save or listing rather than when the app starts, in case
+    # MongoDB is not up yet
+    def ensure_indexes(self):
+        if not self.indexed:
+            self.collection.create_index('name', unique=True)
+            if self.max_age is not None:
+                self.collection.create_index('saved_at')
+            self.indexed = True
+
+    # Query of the documents saved before max_age, those saved before the time was kept too
+    def expired_query(self):
+        return {'saved_at': {'$not': {'$gte': time.time() - self.max_age}}}
+
+    def expired(self, document):
+        return self.max_age is not None and not document.get('saved_at', float('-inf')) >= time.time() - self.max_age
+
+    # Deletes the expired documents and their blobs, returns how many. Each one is deleted only if it is still
+    # expired, so a grid saved again meanwhile stays
+    def expire(self):
+        self.last_expired = time.time()
+        expired = 0
+        for document in self.collection.find(self.expired_query(), {'name': True}):
+            previous = self.collection.find_one_and_delete(dict(self.expired_query(), name=document['name']),
+                                                           projection=self.blob_ids())
+            if previous is not None:
+                self.delete_blobs(previous)
+                expired += 1
+        return expired
+
+    # Inserts a new document or replaces an existing one by name, True when it was inserted
+    def save(self, name, grid, history=True):
+        self.ensure_indexes()
+        document, blob = pack_grid(grid)
+        document['name'] = name
+        blobs = {'blob': blob}
+        if history and grid.history is not None:
+            blobs['history_blob'] = pack_history(grid.history)
+        for key, data in blobs.items():
+            if len(data) > self.limit and self.fs is not None:
+                document[key + '_id'] = self.fs.put(data, filename=name)
+            else:
+                document[key] = Binary(data)
+        return self.replace(name, document)
+
+    # Saves a brick grid one brick at a time. With GridFS the bricks are streamed into a file whatever their size,
+    # otherwise they have to fit in the document
+    def save_bricks(self, name, bricks):
+        self.ensure_indexes()
+        document = brick_document(bricks)
+        document['name'] = name
+        directory = []
+        summary = Summary(bricks.size)
+        if self.fs is not None:
+            with self.fs.new_file(filename=name) as f:
+                for key, data in packed_bricks(bricks, summary):
+                    f.write(data)
+                    directory.append(key + (len(data),))
+            document['blob_id'] = f._id
+        else:
+            chunks = []
+            for key, data in packed_bricks(bricks, summary):
+                chunks.append(data)
+                directory.append(key + (len(data),))
+            blob = b''.join(chunks)
+            if len(blob) > self.limit:
+                raise ValueError(f"{len(blob)} bytes of bricks do not fit in a document without GridFS")
+            document['blob'] = Binary(blob)
+        document['bricks'] = Binary(np.array(directory, dtype=np.int32).reshape(-1, 4).tobytes())
+        document.update(summary.metadata())
+        return self.replace(name, document)
+
+    # Swaps the document saved by name, reading back only the GridFS ids of the one replaced, in one round
+    # trip. True when there was none
+    def replace(self, name, document):
+        document['saved_at'] = time.time()
+        if self.max_age is not None and time.time() - self.last_expired > EXPIRE_INTERVAL:
+            self.expire()
+        previous = self.collection.find_one_and_replace({'name': name}, document, projection=self.blob_ids(),
+                                                        upsert=True)
+        self.delete_blobs(previous)
+        if self.cache is not None:
+            self.cache.discard(name)
+        return previous is None
+
+    # Grid saved by name, a BrickGrid for the grids saved as bricks. Their bricks are read from GridFS one
+    # at a time into the brick files, with a brick cache of brick_cache bytes. Grids saved as bricks with more
+    # than max_brick_size cells a side raise GridTooLarge before any brick is read
+    def load(self, name, brick_cache=BRICK_CACHE_BYTES, max_brick_size=None):
+        grid = self.cache.get(name) if self.cache is not None else None
+        if grid is not None:
+            return grid
+        document = self.collection.find_one({'name': name})
+        if document is None:
+            return None
+        if self.expired(document):
+            self.delete(name)
+            return None
+        if document.get('format') == 'bricks' and max_brick_size is not None and \
+                int(document['size']) > max_brick_size:
+            raise GridTooLarge(name, int(document['size']))
+        return self.decode(document, brick_cache)
+
+    # Grid of a document, put in the cache unless it is made of bricks or has a history
+    def decode(self, document, brick_cache=BRICK_CACHE_BYTES):
+        if document.get('format') == 'bricks':
+            stream = self.fs.get(document['blob_id']) if 'blob_id' in document else io.BytesIO(document['blob'])
+            return unpack_bricks(document, stream, brick_cache)
+        if document.get('format') != 'packed':
+            grid = legacy_grid(document)
+        else:
+            grid = unpack_grid(document, self.read_blob(document, 'blob'))
+            history = self.read_blob(document, 'history_blob')
+            if history is not None:
+                unpack_history(history).attach(grid)
+                return grid
+        if self.cache is not None:
+            self.cache.put(document['name'], grid)
+        return grid
+
+    # Decodes the named grids that are not cached yet into the cache, reading their documents in one query.
+    # Returns how many were decoded
+    def prefetch(self, names):
+        if self.cache is None:
+            return 0
+        names = [name for name in names if name not in self.cache]
+        decoded = 0
+        for document in self.collection.find({'name': {'$in': names}}):
+            if document.get('format') == 'bricks' or any(key in document for key in ('history_blob',
+                                                                                       'history_blob_id')):
+                continue
+            self.decode(document)
+            decoded += 1
+        return decoded
+
+    # Names and metadata of the saved grids by name, those starting with prefix if given. Only the listed
+    # fields are read, found through the index on the names
+    def list(self, prefix=None, skip=0, limit=LIST_LIMIT):
+        self.ensure_indexes()
+        query = {'name': {'$regex': '^' + re.escape(prefix)}} if prefix else {}
+        projection = dict.fromkeys(LISTING, True)
+        projection['_id'] = False
+        documents = self.collection.find(query, projection, skip=skip, limit=limit, sort=[('name', 1)])
+        return [listing(document) for document in documents]
+
+    def read_blob(self, document, key):
+        if key + '_id' in document:
+            return self.fs.get(document[key + '_id']).read()
+        if key in document:
+            return bytes(document[key])
+        return None
+
+    def delete(self, name):
+        previous = self.collection.find_one_and_delete({'name': name}, projection=self.blob_ids())
+        self.delete_blobs(previous)
+        if self.cache is not None:
+            self.cache.discard(name)
+
+    # Projection of the GridFS ids of a document's blobs
+    def blob_ids(self):
+        return {key + '_id': True for key in self.BLOBS}
+
+    def delete_blobs(self, document):
+        for key in self.BLOBS:
+            if document is not None and key + '_id' in document:
+                self.fs.delete(document[key + '_id'])
+
+    def count(self):
+        return self.collection.count_documents({})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,314 @@
+import engine
+import gzip
+import numpy as np
+import struct
+import unittest
+import zlib
+from types import SimpleNamespace
+
+
+class TestWire(unittest.TestCase):
+
+    def setUp(self):
+        from grid import Grid
+        state = [[[1 if [x, y, z] == [2, 2, 2] else 0 for z in range(6)] for y in range(6)] for x in range(6)]
+        self.grid = Grid(6, state, {0: 0, 1: 0x00ff00})
+        self.grid.edited_rules = [[1], [1], 'N']
+
+    # Test a full frame gives back the types and colours of every cell
+    def test_full_frame(self):
+        frame = decode_frame(encode_full(self.grid))
+        self.assertEqual(frame['kind'], FULL)
+        self.assertEqual(frame['size'], 6)
+        self.assertEqual(frame['generation'], 0)
+        self.assertTrue(np.array_equal(frame['types'], self.grid.state.ravel()))
+        self.assertTrue(np.array_equal(frame['colours'], self.grid.colour_state.ravel()))
+
+    # Test a delta frame only holds the cells changed by the last step
+    def test_delta_frame(self):
+        before = self.grid.colour_state.ravel()
+        types = self.grid.state.ravel().copy()
+        self.grid.update()
+        body = encode_frame(self.grid, 0)
+        frame = decode_frame(body)
+        self.assertEqual(frame['kind'], DELTA)
+        self.assertEqual(frame['generation'], 1)
+        self.assertEqual(len(frame['indices']), len(self.grid.changed))
+        types[frame['indices']] = frame['types']
+        before[frame['indices']] = frame['colours']
+        self.assertTrue(np.array_equal(types, self.grid.state.ravel()))
+        self.assertTrue(np.array_equal(before, self.grid.colour_state.ravel()))
+        self.assertLess(len(body), len(encode_full(self.grid)))
+
+    # Test a full frame is sent when it is smaller than the delta
+    def test_delta_larger_than_full(self):
+        self.grid.edited_rules = [[], [0], 'M']
+        self.grid.update()
+        self.assertEqual(decode_frame(encode_frame(self.grid, 0))['kind'], FULL)
+
+    # Test a client that missed a generation gets a full frame
+    def test_delta_fallback(self):
+        self.grid.update()
+        self.grid.update()
+        self.assertEqual(decode_frame(encode_frame(self.grid, 0))['kind'], FULL)
+        self.assertEqual(decode_frame(encode_frame(self.grid, None))['kind'], FULL)
+
+    # Test snapshot frames hold the changes since the previous snapshot sent, even across skipped ones
+    def test_encode_snapshot(self):
+        first = self.grid.snapshot()
+        self.grid.update()
+        self.grid.update()
+        second = self.grid.snapshot()
+        self.assertEqual(decode_frame(encode_snapshot(first))['kind'], FULL)
+        frame = decode_frame(encode_snapshot(second, first))
+        self.assertEqual(frame['kind'], DELTA)
+        self.assertEqual(frame['generation'], 2)
+        types = first['state'].ravel().copy()
+        types[frame['indices']] = frame['types']
+        self.assertTrue(np.array_equal(types, second['state'].ravel()))
+
+    # Test several frames can be sent in one body and read back in order
+    def test_join_frames(self):
+        frames = [encode_full(self.grid)]
+        self.grid.update()
+        frames.append(encode_frame(self.grid, 0))
+        self.assertEqual(split_frames(join_frames(frames)), frames)
+
+    # Test the body is compressed with the first encoding the client accepts
+    def test_compress(self):
+        body = encode_full(self.grid)
+        data, encoding = compress(body, 'deflate, gzip;q=0.5')
+        self.assertEqual(encoding, 'gzip')
+        self.assertEqual(gzip.decompress(data), body)
+        data, encoding = compress(body, 'deflate')
+        self.assertEqual(zlib.decompress(data), body)
+        self.assertEqual(compress(body, ''), (body, None))
+        self.assertEqual(compress(body, 'gzip;q=0'), (body, None))
+
+    # Test the surface hides the cells closed in by their six face neighbours and keeps the ones on the faces
+    def test_exposed(self):
+        types = np.zeros((5, 5, 5), dtype=np.uint8)
+        types[:3, :3, :3] = 1
+        types[1, 1, 1] = 4
+        visible = exposed(types)
+        self.assertFalse(visible[1, 1, 1])
+        self.assertTrue(visible[0, 0, 0] and visible[2, 1, 1])
+        self.assertEqual(np.count_nonzero(visible), 26)
+        types[:] = 1
+        self.assertEqual(np.count_nonzero(exposed(types)), 5 ** 3 - 3 ** 3)
+
+    # Test the surface followed from the changed cells is the one computed from scratch, and its deltas rebuild it
+    def test_surface_incremental(self):
+        from grid import Grid
+        state = np.zeros((12, 12, 12), dtype=np.uint8)
+        state[2:10, 2:10, 2:10] = np.random.default_rng(2).random((8, 8, 8)) < 0.9
+        grid = Grid(12, state, {0: 0, 1: 0x00ff00})
+        grid.edited_rules = [[3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17], [6, 7, 8], 'M']
+        surface = Surface()
+        frame = decode_frame(encode_surface(surface.update(grid)))
+        self.assertEqual(frame['kind'], SPARSE)
+        types = np.zeros(grid.state.size, dtype=np.uint8)
+        types[frame['indices']] = frame['types']
+        kinds = []
+        for _ in range(4):
+            grid.update()
+            view = surface.update(grid)
+            expected = grid.state * exposed(grid.state)
+            self.assertTrue(np.array_equal(view.state, expected))
+            frame = decode_frame(encode_surface(view, grid.generation - 1))
+            kinds.append(frame['kind'])
+            if frame['kind'] == SPARSE:
+                types[:] = 0
+            types[frame['indices']] = frame['types']
+            self.assertTrue(np.array_equal(types, expected.ravel()))
+        self.assertIn(DELTA, kinds)
+        self.assertNotEqual(decode_frame(encode_surface(surface.update(grid), 0))['kind'], DELTA)
+        solid = Grid(12, np.ones((12, 12, 12), dtype=np.uint8), {0: 0, 1: 0x00ff00})
+        self.assertLess(len(encode_surface(Surface().update(solid))), len(encode_full(solid)) * 0.6)
+        self.assertEqual(surface_json(Surface().update(solid))['indices'][:2], [0, 1])
+
+
+MIME_TYPE = 'application/octet-stream'
+MAGIC = b'CA3D'
+VERSION = 1
+FULL = 0
+DELTA = 1
+SPARSE = 2
+
+# magic, version, kind, size, generation, palette length, padding so the palette is 4 byte aligned
+HEADER = struct.Struct('<4sBBHIHH')
+
+
+def encode_header(grid, kind):
+    palette = np.array(grid.palette, dtype='<u4')
+    return HEADER.pack(MAGIC, VERSION, kind, grid.size, grid.generation, len(palette), 0) + palette.tobytes()
+
+
+# Packed type and colour index of every cell in x, y, z order
+def encode_full(grid):
+    return (encode_header(grid, FULL) + grid.state.astype(np.uint8).tobytes()
+            + grid.colour_index.astype(np.uint8).tobytes())
+
+
+# Flat index, type and colour index of the cells changed by the last step
+def encode_delta(grid):
+    indices = np.asarray(grid.changed)
+    return (encode_header(grid, DELTA) + struct.pack('<I', len(indices)) + indices.astype('<u4').tobytes()
+            + grid.state.flat[indices].astype(np.uint8).tobytes()
+            + grid.colour_index.flat[indices].astype(np.uint8).tobytes())
+
+
+# A delta when the client holds the generation just before this one and the delta
+# is smaller than the whole grid, a full frame otherwise
+def encode_frame(grid, client_generation=None):
+    if client_generation is not None and grid.changed is not None and client_generation == grid.generation - 1:
+        # A changed cell takes 6 bytes in a delta and every cell takes 2 bytes in a full frame
+        if 6 * len(grid.changed) < 2 * grid.state.size:
+            return encode_delta(grid)
+    return encode_full(grid)
+
+
+# Bit mask of the non-empty cells (bit i & 7 of byte i >> 3 for cell i), then the type and colour index of each of
+# them in flat order, the other cells are empty
+def encode_sparse(grid):
+    occupied = grid.state.ravel() != 0
+    return (encode_header(grid, SPARSE) + np.packbits(occupied, bitorder='little').tobytes()
+            + grid.state.ravel()[occupied].astype(np.uint8).tobytes()
+            + grid.colour_index.ravel()[occupied].astype(np.uint8).tobytes())
+
+
+# Non-empty cells that can be seen: those with an empty face neighbour or on a face of the grid
+def exposed(types):
+    return (types != 0) & (engine.count_neighbours(types != 0, 1, 'N') < 6)
+
+
+# Follows what a client sees of a grid when it is only sent the surface: the cells hidden behind their six face
+# neighbours are sent as empty. After a single step only the changed cells and their face neighbours are looked
+# at again, otherwise the whole grid is. update returns a view of the grid to encode, with the cells whose
+# visible type or colour changed since the generation in base
+class Surface:
+    def __init__(self):
+        self.generation = None
+        self.types = None
+        self.colours = None
+
+    def update(self, grid):
+        state, colour_index = grid.state, grid.colour_index
+        changed = grid.changed
+        base = self.generation
+        if self.types is None or self.types.shape != state.shape:
+            self.types = np.zeros(state.shape, dtype=np.uint8)
+            self.colours = np.zeros(state.shape, dtype=np.uint8)
+            base = None
+        if base is not None and changed is not None and grid.generation == base + 1:
+            cells = engine.active_cells(changed, state.shape, 1, 'N')
+            live = state.flat[cells] != 0
+            hidden = engine.count_neighbours_at(state != 0, cells, 1, 'N') == 6
+            types = np.where(live & ~hidden, state.flat[cells], 0).astype(np.uint8)
+            colours = colour_index.flat[cells]
+            differs = (types != self.types.flat[cells]) | ((types != 0) & (colours != self.colours.flat[cells]))
+            cells = cells[differs]
+            self.types.flat[cells] = types[differs]
+            self.colours.flat[cells] = colours[differs]
+        else:
+            types = np.where(exposed(state), state, 0).astype(np.uint8)
+            cells = np.flatnonzero((types != self.types) | ((types != 0) & (colour_index != self.colours)))
+            self.types = types
+            self.colours = colour_index.copy()
+        self.generation = grid.generation
+        return SimpleNamespace(size=grid.size, palette=grid.palette, generation=grid.generation, base=base,
+                               state=self.types, colour_index=self.colours, changed=cells)
+
+    def memory_usage(self):
+        return 0 if self.types is None else self.types.nbytes + self.colours.nbytes
+
+
+# Frame of a surface view: a delta when the client holds the generation the view was followed from and the delta
+# is smaller, otherwise the non-empty cells. A changed cell takes 6 bytes in a delta, a sparse frame takes a bit
+# for every cell and 2 bytes for each non-empty one
+def encode_surface(view, client_generation=None):
+    if client_generation is not None and client_generation == view.base:
+        if 6 * len(view.changed) < view.state.size / 8 + 2 * np.count_nonzero(view.state):
+            return encode_delta(view)
+    return encode_sparse(view)
+
+
+# JSON of a surface view: the flat index, type and RGB colour of the cells that can be seen
+def surface_json(view):
+    indices = np.flatnonzero(view.state)
+    palette = np.array(view.palette, dtype=np.uint32)
+    return {'size': view.size, 'generation': view.generation, 'indices': indices.tolist(),
+            'types': view.state.flat[indices].tolist(), 'colours': palette[view.colour_index.flat[indices]].tolist()}
+
+
+# Frame for a Grid.snapshot, a delta against the previous snapshot when one is given and it is smaller
+def encode_snapshot(snapshot, previous=None):
+    view = SimpleNamespace(size=snapshot['state'].shape[0], palette=snapshot['palette'],
+                           generation=snapshot['generation'], state=snapshot['state'],
+                           colour_index=snapshot['colour_index'], changed=None)
+    if previous is not None:
+        view.changed = np.flatnonzero((snapshot['state'] != previous['state'])
+                                      | (snapshot['colour_index'] != previous['colour_index']))
+        if 6 * len(view.changed) < 2 * view.state.size:
+            return encode_delta(view)
+    return encode_full(view)
+
+
+# Reads a frame back into arrays, the colours are RGB values
+def decode_frame(body):
+    magic, version, kind, size, generation, palette_length, _ = HEADER.unpack_from(body)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a grid frame")
+    offset = HEADER.size
+    palette = np.frombuffer(body, '<u4', palette_length, offset)
+    offset += 4 * palette_length
+    frame = {'kind': kind, 'size': size, 'generation': generation, 'palette': palette.tolist()}
+    if kind == FULL:
+        count = size ** 3
+    elif kind == SPARSE:
+        occupied = np.unpackbits(np.frombuffer(body, np.uint8, -(-size ** 3 // 8), offset), count=size ** 3,
+                                 bitorder='little')
+        offset += -(-size ** 3 // 8)
+        frame['indices'] = np.flatnonzero(occupied)
+        count = len(frame['indices'])
+    else:
+        count, = struct.unpack_from('<I', body, offset)
+        offset += 4
+        frame['indices'] = np.frombuffer(body, '<u4', count, offset).astype(np.int64)
+        offset += 4 * count
+    frame['types'] = np.frombuffer(body, np.uint8, count, offset)
+    frame['colours'] = palette[np.frombuffer(body, np.uint8, count, offset + count)]
+    return frame
+
+
+# Puts several frames in one body, each one after its length
+def join_frames(frames):
+    return b''.join(struct.pack('<I', len(frame)) + frame for frame in frames)
+
+
+def split_frames(body):
+    frames = []
+    offset = 0
+    while offset < len(body):
+        length, = struct.unpack_from('<I', body, offset)
+        frames.append(body[offset + 4:offset + 4 + length])
+        offset += 4 + length
+    return frames
+
+
+# Compresses the body with gzip or deflate if the client accepts one of them
+def compress(body, accept_encoding):
+    accepted = []
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0'):
+            accepted.append(name.strip().lower())
+    if 'gzip' in accepted:
+        return gzip.compress(body, compresslevel=5), 'gzip'
+    if 'deflate' in accepted:
+        return zlib.compress(body, 5), 'deflate'
+    return body, None
+
+
+if __name__ == '__main__':
+    unittest.main()